@@ -3,6 +3,10 @@ import requests
 from requests.auth import HTTPBasicAuth
 from database.users import sync_user_from_wordpress, get_user_by_id
 import os
+import copy
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 
 # Config
@@ -21,17 +25,101 @@ PREMIUM_MEMBERSHIP_IDS = [2508, 2500]
 PREMIUM_NAME = "Premium"
 
 
+# ========================================
+# CACHE VERIFICA MEMBERSHIP
+# ========================================
+
+# TTL risultati positivi/negativi (secondi)
+MEMBERSHIP_CACHE_TTL = int(os.getenv("MEMBERSHIP_CACHE_TTL", "900"))
+MEMBERSHIP_NEGATIVE_TTL = int(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "60"))
+
+# Timeout singola chiamata MemberPress
+MP_TIMEOUT = 15
+
+# Ri-verifica periodica in background (secondi)
+MEMBERSHIP_RECHECK_INTERVAL = int(os.getenv("MEMBERSHIP_RECHECK_INTERVAL", "1800"))
+MEMBERSHIP_RETRY_INTERVAL = int(os.getenv("MEMBERSHIP_RETRY_INTERVAL", "60"))
+MEMBERSHIP_GRACE_PERIOD = int(os.getenv("MEMBERSHIP_GRACE_PERIOD", "7200"))
+
+_membership_cache = {}  # 'email:...' / 'member:...' -> (risultato, scadenza)
+_membership_inflight = {}  # email -> Future della verifica in corso
+_membership_lock = threading.Lock()
+_mp_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="memberpress")
+_reverify_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="membership-recheck")
+_mp_session = requests.Session()
+
+
+def _mp_get(url, params=None):
+    """GET autenticata verso le API MemberPress (connessione keep-alive)."""
+    return _mp_session.get(
+        url,
+        auth=HTTPBasicAuth(MP_CONSUMER_KEY, MP_CONSUMER_SECRET),
+        params=params,
+        timeout=MP_TIMEOUT
+    )
+
+
+def _cache_get(key):
+    """Risultato in cache non scaduto, o None."""
+    with _membership_lock:
+        entry = _membership_cache.get(key)
+        if entry is None:
+            return None
+        result, expires_at = entry
+        if time.monotonic() > expires_at:
+            del _membership_cache[key]
+            return None
+        return copy.deepcopy(result)
+
+
+def _cache_put(email, result):
+    """Salva il risultato per email (e member id). Gli errori API non vengono salvati."""
+    if result is None or result.get('_error'):
+        return
+
+    ttl = MEMBERSHIP_CACHE_TTL if result.get('has_active') else MEMBERSHIP_NEGATIVE_TTL
+    expires_at = time.monotonic() + ttl
+
+    with _membership_lock:
+        _membership_cache[f"email:{email}"] = (result, expires_at)
+        member_id = result.get('member_id') or result.get('membership', {}).get('member_id')
+        if member_id:
+            _membership_cache[f"member:{member_id}"] = (result, expires_at)
+
+
+def get_cached_membership(email=None, member_id=None):
+    """Ultima verifica in cache per email o member id (senza chiamate API)."""
+    if email:
+        return _cache_get(f"email:{email.strip().lower()}")
+    if member_id:
+        return _cache_get(f"member:{member_id}")
+    return None
+
+
+def invalidate_membership_cache(email=None, member_id=None):
+    """Rimuove dalla cache la verifica di un utente (o tutte se nessun argomento)."""
+    with _membership_lock:
+        if email is None and member_id is None:
+            _membership_cache.clear()
+            return
+        cached = _membership_cache.pop(f"email:{email.strip().lower()}", None) if email else None
+        if member_id is None and cached:
+            member_id = cached[0].get('member_id')
+        if member_id:
+            _membership_cache.pop(f"member:{member_id}", None)
+
+
 # ========================================
 # FUNZIONI MEMBERPRESS API
 # ========================================
 
-def check_membership_by_email(email):
+def _fetch_membership(email):
     """
-    Verifica se l'email ha una membership PREMIUM attiva (ID: 2508 o 2500).
-    Blocca accesso per membership Basic o altre.
+    Interroga MemberPress per l'email (nessuna chiamata Streamlit: può girare
+    in qualsiasi thread). Gli errori API sono ritornati come {'_error': ...}.
     
     Args:
-        email (str): Email dell'utente
+        email (str): Email dell'utente (normalizzata)
         
     Returns:
         dict: Risultato della verifica con dati utente e membership
@@ -39,22 +127,14 @@ def check_membership_by_email(email):
     try:
         # STEP 1: Cerca membro per email
         url = f"{WORDPRESS_URL}/wp-json/mp/v1/members"
-        response = requests.get(
-            url,
-            auth=HTTPBasicAuth(MP_CONSUMER_KEY, MP_CONSUMER_SECRET),
-            params={'search': email},
-            timeout=15
-        )
+        response = _mp_get(url, params={'search': email})
         
         # Gestione errori API
         if response.status_code == 401:
-            st.error("❌ API Keys MemberPress non valide!")
-            st.info("Verifica Consumer Key e Secret in MemberPress → Settings → Developer Tools")
-            return None
+            return {'_error': 'auth'}
         
         if response.status_code != 200:
-            st.warning(f"⚠️ Errore API MemberPress: {response.status_code}")
-            return None
+            return {'_error': 'status', 'status_code': response.status_code}
         
         members = response.json()
         
@@ -69,14 +149,15 @@ def check_membership_by_email(email):
         member_id = member.get('id')
         user_id = member.get('user_id')
         
-        # STEP 2: Ottieni info utente WordPress
+        # STEP 2 e 3 dipendono solo dallo STEP 1: in parallelo
         user_url = f"{WORDPRESS_URL}/wp-json/wp/v2/users/{user_id}"
+        subs_url = f"{WORDPRESS_URL}/wp-json/mp/v1/members/{member_id}/subscriptions"
         
-        user_response = requests.get(
-            user_url,
-            auth=HTTPBasicAuth(MP_CONSUMER_KEY, MP_CONSUMER_SECRET),
-            timeout=15
-        )
+        user_future = _mp_executor.submit(_mp_get, user_url)
+        subs_future = _mp_executor.submit(_mp_get, subs_url)
+        
+        user_response = user_future.result()
+        subs_response = subs_future.result()
         
         # Dati utente
         if user_response.status_code == 200:
@@ -88,19 +169,11 @@ def check_membership_by_email(email):
             user_name = email.split('@')[0].title()
             user_slug = email.split('@')[0]
         
-        # STEP 3: Verifica subscriptions attive
-        subs_url = f"{WORDPRESS_URL}/wp-json/mp/v1/members/{member_id}/subscriptions"
-        
-        subs_response = requests.get(
-            subs_url,
-            auth=HTTPBasicAuth(MP_CONSUMER_KEY, MP_CONSUMER_SECRET),
-            timeout=15
-        )
-        
         if subs_response.status_code != 200:
             return {
                 'found': True,
                 'has_active': False,
+                'member_id': member_id,
                 'message': 'Impossibile verificare subscriptions'
             }
         
@@ -179,6 +252,7 @@ def check_membership_by_email(email):
                 'found': True,
                 'has_active': False,
                 'is_other': True,
+                'member_id': member_id,
                 'other_membership_name': other_membership_name,
                 'message': f'Membership "{other_membership_name}" rilevata - serve Premium per accedere'
             }
@@ -188,18 +262,96 @@ def check_membership_by_email(email):
             return {
                 'found': True,
                 'has_active': False,
+                'member_id': member_id,
                 'message': 'Nessuna membership attiva o tutte scadute'
             }
         
     except requests.exceptions.Timeout:
-        st.error("⏱️ Timeout connessione - Riprova tra poco")
-        return None
+        return {'_error': 'timeout'}
     except requests.exceptions.ConnectionError:
-        st.error("🔌 Impossibile connettersi al server WordPress")
-        return None
+        return {'_error': 'connection'}
     except Exception as e:
-        st.error(f"❌ Errore imprevisto: {e}")
+        return {'_error': 'unexpected', 'detail': str(e)}
+
+
+def _verify_membership_single_flight(email):
+    """
+    Verifica membership condividendo le chiamate in corso: se più rerun o
+    sessioni verificano la stessa email insieme, parte una sola verifica.
+    """
+    with _membership_lock:
+        future = _membership_inflight.get(email)
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            _membership_inflight[email] = future
+    
+    if not is_leader:
+        return copy.deepcopy(future.result())
+    
+    try:
+        result = _fetch_membership(email)
+        _cache_put(email, result)
+        future.set_result(result)
+        return copy.deepcopy(result)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _membership_lock:
+            _membership_inflight.pop(email, None)
+
+
+def _show_membership_error(result):
+    """Mostra all'utente l'errore API della verifica."""
+    error = result.get('_error')
+    
+    if error == 'auth':
+        st.error("❌ API Keys MemberPress non valide!")
+        st.info("Verifica Consumer Key e Secret in MemberPress → Settings → Developer Tools")
+    elif error == 'status':
+        st.warning(f"⚠️ Errore API MemberPress: {result.get('status_code')}")
+    elif error == 'timeout':
+        st.error("⏱️ Timeout connessione - Riprova tra poco")
+    elif error == 'connection':
+        st.error("🔌 Impossibile connettersi al server WordPress")
+    else:
+        st.error(f"❌ Errore imprevisto: {result.get('detail')}")
+
+
+def check_membership_by_email(email, use_cache=True, show_errors=True):
+    """
+    Verifica se l'email ha una membership PREMIUM attiva (ID: 2508 o 2500).
+    Blocca accesso per membership Basic o altre.
+    
+    I risultati sono in cache per MEMBERSHIP_CACHE_TTL secondi (positivi) o
+    MEMBERSHIP_NEGATIVE_TTL secondi (email sconosciute / senza Premium);
+    verifiche concorrenti della stessa email condividono un'unica chiamata.
+    
+    Args:
+        email (str): Email dell'utente
+        use_cache (bool): Se False, forza una nuova verifica
+        show_errors (bool): Se True, mostra gli errori API con st.error
+        
+    Returns:
+        dict: Risultato della verifica con dati utente e membership
+              (None in caso di errore API)
+    """
+    email = email.strip().lower()
+    
+    if use_cache:
+        cached = _cache_get(f"email:{email}")
+        if cached is not None:
+            return cached
+    
+    result = _verify_membership_single_flight(email)
+    
+    if result.get('_error'):
+        if show_errors:
+            _show_membership_error(result)
         return None
+    
+    return result
 
 
 # ========================================
@@ -597,11 +749,87 @@ def show_login_page():
 # PROTEZIONE APP
 # ========================================
 
+def _reverify_membership(email):
+    """Verifica membership per il controllo periodico (eseguita in background)."""
+    return check_membership_by_email(email, show_errors=False)
+
+
+def _clear_session():
+    """Pulisce tutti i dati della sessione."""
+    keys_to_delete = list(st.session_state.keys())
+    for key in keys_to_delete:
+        del st.session_state[key]
+
+
+def _revoke_access(result):
+    """
+    Revoca l'accesso dopo una verifica negativa: pulisce la sessione e
+    mostra il motivo insieme alla pagina di login (senza attese bloccanti).
+    """
+    _clear_session()
+    
+    if result and result.get('is_other'):
+        # Downgrade a membership non-Premium
+        other_name = result.get('other_membership_name', 'Basic')
+        
+        st.error(f"❌ Downgrade rilevato a membership \"{other_name}\"")
+        st.warning("""
+        **Accesso alla piattaforma revocato**
+        
+        La tua membership è stata modificata e non include più 
+        l'accesso a questa piattaforma.
+        
+        Per continuare ad usarla, riattiva la membership Premium.
+        """)
+        st.markdown("""
+        <a href="https://tuosito.com/upgrade-premium" target="_blank">
+            <button style="background-color: #FFD700; color: black; 
+            padding: 12px 24px; border: none; border-radius: 5px; 
+            cursor: pointer; margin-top: 10px; font-size: 16px;
+            font-weight: bold;">
+                ⭐ Riattiva Premium
+            </button>
+        </a>
+        """, unsafe_allow_html=True)
+    
+    elif result:
+        # Membership Premium non più attiva
+        st.error("❌ La tua membership Premium non è più attiva")
+        st.warning("""
+        **Accesso revocato**
+        
+        Per continuare ad usare la piattaforma, rinnova la tua membership Premium.
+        """)
+        st.markdown("""
+        <a href="https://tuosito.com/membership" target="_blank">
+            <button style="background-color: #FF4B4B; color: white; 
+            padding: 12px 24px; border: none; border-radius: 5px; 
+            cursor: pointer; margin-top: 10px; font-size: 16px;">
+                ⭐ Rinnova Premium
+            </button>
+        </a>
+        """, unsafe_allow_html=True)
+    
+    else:
+        # Nessuna verifica riuscita entro il periodo di grazia
+        st.error("❌ Impossibile verificare la tua membership Premium")
+        st.warning("Il servizio di verifica non risponde. Effettua di nuovo l'accesso.")
+    
+    st.markdown("---")
+    show_login_page()
+
+
 def require_auth():
     """
     Richiedi autenticazione Premium per accedere all'app.
     Verifica periodicamente che la membership Premium sia ancora attiva.
     
+    La ri-verifica gira in background: finché non arriva il risultato resta
+    valida l'ultima membership nota, quindi il rendering della pagina non
+    dipende mai dai tempi di risposta di WordPress. Se la verifica continua
+    a fallire per errori API, l'accesso resta valido per
+    MEMBERSHIP_GRACE_PERIOD secondi oltre l'intervallo di controllo.
+    
     Returns:
         bool: True se autenticato con Premium, False altrimenti
     """
@@ -613,81 +841,53 @@ def require_auth():
     if st.session_state.authenticated:
         last_check = st.session_state.get('last_check', 0)
         current_time = datetime.now().timestamp()
+        future = st.session_state.get('membership_future')
         
-        # Re-verifica ogni 30 minuti (1800 secondi)
-        if current_time - last_check > 1800:
-            email = st.session_state.user_data.get('email')
+        # Risultato della verifica in background disponibile
+        if future is not None and future.done():
+            st.session_state.membership_future = None
             
-            with st.spinner("🔄 Verifica stato membership Premium..."):
-                result = check_membership_by_email(email)
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Errore verifica membership in background: {e}")
+                result = None
+            
+            if result and result.get('has_active'):
+                # Membership Premium ancora attiva - aggiorna dati
+                st.session_state.membership = result['membership']
+                st.session_state.last_check = current_time
+                last_check = current_time
                 
-                if result and result.get('has_active'):
-                    # Membership Premium ancora attiva - aggiorna dati
-                    st.session_state.membership = result['membership']
-                    st.session_state.last_check = current_time
-                    
-                    # Aggiorna anche il database locale
-                    try:
-                        sync_user_from_wordpress(
-                            st.session_state.user_data,
-                            result['membership']
-                        )
-                    except:
-                        pass  # Non bloccare se sync fallisce
-                        
-                elif result and result.get('is_other'):
-                    # Downgrade a membership non-Premium
-                    other_name = result.get('other_membership_name', 'Basic')
-                    
-                    st.error(f"❌ Downgrade rilevato a membership \"{other_name}\"")
-                    st.warning("""
-                    **Accesso alla piattaforma revocato**
-                    
-                    La tua membership è stata modificata e non include più 
-                    l'accesso a questa piattaforma.
-                    
-                    Per continuare ad usarla, riattiva la membership Premium.
-                    """)
-                    st.markdown("""
-                    <a href="https://tuosito.com/upgrade-premium" target="_blank">
-                        <button style="background-color: #FFD700; color: black; 
-                        padding: 12px 24px; border: none; border-radius: 5px; 
-                        cursor: pointer; margin-top: 10px; font-size: 16px;
-                        font-weight: bold;">
-                            ⭐ Riattiva Premium
-                        </button>
-                    </a>
-                    """, unsafe_allow_html=True)
-                    
-                    # Attendi 3 secondi e poi logout
-                    import time
-                    time.sleep(3)
-                    logout()
-                    return False
-                    
-                else:
-                    # Membership Premium non più attiva - forza logout
-                    st.error("❌ La tua membership Premium non è più attiva")
-                    st.warning("""
-                    **Accesso revocato**
-                    
-                    Per continuare ad usare la piattaforma, rinnova la tua membership Premium.
-                    """)
-                    st.markdown("""
-                    <a href="https://tuosito.com/membership" target="_blank">
-                        <button style="background-color: #FF4B4B; color: white; 
-                        padding: 12px 24px; border: none; border-radius: 5px; 
-                        cursor: pointer; margin-top: 10px; font-size: 16px;">
-                            ⭐ Rinnova Premium
-                        </button>
-                    </a>
-                    """, unsafe_allow_html=True)
-                    
-                    # Attendi 3 secondi e poi logout
-                    import time
-                    time.sleep(3)
-                    logout()
-                    return False
+                # Aggiorna anche il database locale
+                try:
+                    sync_user_from_wordpress(
+                        st.session_state.user_data,
+                        result['membership']
+                    )
+                except:
+                    pass  # Non bloccare se sync fallisce
+            
+            elif result:
+                # Downgrade o membership non più attiva
+                _revoke_access(result)
+                return False
+            
+            else:
+                # Errore API: mantieni l'ultima membership nota e riprova più tardi
+                st.session_state.membership_retry_at = current_time + MEMBERSHIP_RETRY_INTERVAL
+        
+        # Re-verifica ogni MEMBERSHIP_RECHECK_INTERVAL secondi (in background)
+        elif (future is None
+              and current_time - last_check > MEMBERSHIP_RECHECK_INTERVAL
+              and current_time >= st.session_state.get('membership_retry_at', 0)):
+            email = st.session_state.user_data.get('email')
+            st.session_state.membership_future = _reverify_executor.submit(_reverify_membership, email)
+        
+        # Periodo di grazia scaduto senza verifiche riuscite
+        if current_time - last_check > MEMBERSHIP_RECHECK_INTERVAL + MEMBERSHIP_GRACE_PERIOD:
+            _revoke_access(None)
+            return False
         
         return True
     
@@ -770,9 +970,7 @@ def logout():
     Pulisce tutta la sessione e ricarica la pagina.
     """
     # Pulisci tutti i dati della sessione
-    keys_to_delete = list(st.session_state.keys())
-    for key in keys_to_delete:
-        del st.session_state[key]
+    _clear_session()
     
     st.success("✅ Logout effettuato con successo")
     st.info("Grazie per aver usato DIRAMCO Platform! 👋")
@@ -860,7 +1058,7 @@ def test_membership_check():
     if st.button("🔍 Verifica"):
         if test_email:
             with st.spinner("Verifica in corso..."):
-                result = check_membership_by_email(test_email)
+                result = check_membership_by_email(test_email, use_cache=False)
                 
                 st.write("**Risultato verifica:**")
                 
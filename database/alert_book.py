@@ -0,0 +1,269 @@
+import threading
+import numpy as np
+from database.db_connection import execute_query
+
+SIDES = ('PRICE_ABOVE', 'PRICE_BELOW')
+
+# Registro delle modifiche agli alert, scritto da un trigger su alerts:
+# qualunque processo (app Streamlit, evaluator, SQL manuale) crei, elimini
+# o aggiorni un alert, l'evaluator lo vede al sync successivo. xid è la
+# transazione che ha scritto la riga: il sync legge solo le transazioni
+# già concluse (sotto l'orizzonte xmin), quindi un id assegnato prima ma
+# confermato dopo non viene mai saltato.
+ALERT_CHANGES_DDL = """
+    CREATE TABLE IF NOT EXISTS alert_changes (
+        id BIGSERIAL PRIMARY KEY,
+        alert_id INTEGER NOT NULL,
+        xid BIGINT NOT NULL DEFAULT txid_current(),
+        changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_alert_changes_xid ON alert_changes (xid);
+    CREATE INDEX IF NOT EXISTS idx_alert_changes_changed_at ON alert_changes (changed_at);
+
+    CREATE OR REPLACE FUNCTION log_alert_change() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO alert_changes (alert_id)
+        VALUES (CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_alert_changes') THEN
+            CREATE TRIGGER trg_alert_changes
+                AFTER INSERT OR DELETE OR UPDATE OF is_active, ticker, alert_type, target_value
+                ON alerts
+                FOR EACH ROW EXECUTE PROCEDURE log_alert_change();
+        END IF;
+    END
+    $$;
+"""
+
+# Modifiche lette dall'ultimo orizzonte: stato attuale degli alert toccati
+# più il nuovo orizzonte (una riga anche senza modifiche)
+ALERT_CHANGES_QUERY = """
+    WITH horizon AS (
+        SELECT txid_snapshot_xmin(txid_current_snapshot()) AS xmin
+    ),
+    changed AS (
+        SELECT DISTINCT c.alert_id
+        FROM alert_changes c, horizon h
+        WHERE c.xid >= %s AND c.xid < h.xmin
+    )
+    SELECT h.xmin, ch.alert_id, a.ticker, a.alert_type, a.target_value, a.is_active
+    FROM horizon h
+    LEFT JOIN changed ch ON TRUE
+    LEFT JOIN alerts a ON a.id = ch.alert_id
+"""
+
+# Righe del registro conservate (già applicate dall'evaluator)
+ALERT_CHANGES_RETENTION = "1 day"
+
+
+def ensure_alert_changes_table():
+    """Crea registro modifiche e trigger sulla tabella alerts (idempotente)."""
+    execute_query(ALERT_CHANGES_DDL, fetch=False)
+
+
+class AlertBook:
+    """
+    Indice in memoria degli alert attivi, raggruppati per ticker.
+
+    Per ogni ticker e lato (PRICE_ABOVE / PRICE_BELOW) mantiene due array
+    NumPy allineati: target_value ordinati e id alert. Trovare gli alert
+    superati da un nuovo prezzo è una ricerca binaria (np.searchsorted).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # ticker -> side -> (targets ordinati, ids)
+        self._book = {}
+        # alert_id -> (ticker, side)
+        self._index = {}
+        # Orizzonte delle transazioni già applicate (per sync incrementale)
+        self._synced_xid = None
+
+    def __len__(self):
+        return len(self._index)
+
+    def tickers(self):
+        """Ticker con almeno un alert attivo."""
+        with self._lock:
+            return list(self._book.keys())
+
+    def _empty_side(self):
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64)
+
+    def _insert(self, alert_id, ticker, side, target):
+        """Inserisce mantenendo l'ordinamento (lock già acquisito)."""
+        if side not in SIDES or alert_id in self._index:
+            return
+
+        sides = self._book.setdefault(ticker, {s: self._empty_side() for s in SIDES})
+        targets, ids = sides[side]
+        pos = np.searchsorted(targets, target)
+        sides[side] = (np.insert(targets, pos, target), np.insert(ids, pos, alert_id))
+
+        self._index[alert_id] = (ticker, side)
+
+    def _remove(self, alert_id):
+        """Rimuove un alert (lock già acquisito)."""
+        location = self._index.pop(alert_id, None)
+        if location is None:
+            return
+
+        ticker, side = location
+        sides = self._book[ticker]
+        targets, ids = sides[side]
+        keep = ids != alert_id
+        sides[side] = (targets[keep], ids[keep])
+
+        if not any(len(sides[s][1]) for s in SIDES):
+            del self._book[ticker]
+
+    def load(self, alerts):
+        """
+        Carica in blocco una lista di alert (id, ticker, alert_type, target_value).
+        Ogni lato viene ordinato una sola volta con argsort.
+        """
+        with self._lock:
+            grouped = {}
+            for alert in alerts:
+                side = alert['alert_type']
+                if side not in SIDES or int(alert['id']) in self._index:
+                    continue
+                ticker = alert['ticker'].upper()
+                bucket = grouped.setdefault((ticker, side), ([], []))
+                bucket[0].append(float(alert['target_value']))
+                bucket[1].append(int(alert['id']))
+
+            for (ticker, side), (targets, ids) in grouped.items():
+                sides = self._book.setdefault(ticker, {s: self._empty_side() for s in SIDES})
+                old_targets, old_ids = sides[side]
+
+                all_targets = np.concatenate([old_targets, np.asarray(targets, dtype=np.float64)])
+                all_ids = np.concatenate([old_ids, np.asarray(ids, dtype=np.int64)])
+                order = np.argsort(all_targets, kind='stable')
+                sides[side] = (all_targets[order], all_ids[order])
+
+                for alert_id in ids:
+                    self._index[alert_id] = (ticker, side)
+
+    def add(self, alert):
+        """Aggiunge un alert (dict con id, ticker, alert_type, target_value)."""
+        with self._lock:
+            self._insert(int(alert['id']), alert['ticker'].upper(),
+                         alert['alert_type'], float(alert['target_value']))
+
+    def remove(self, alert_id):
+        """Rimuove un alert (eliminato o già scattato)."""
+        with self._lock:
+            self._remove(int(alert_id))
+
+    def remove_many(self, alert_ids):
+        """Rimuove più alert."""
+        with self._lock:
+            for alert_id in alert_ids:
+                self._remove(int(alert_id))
+
+    def crossed(self, ticker, price):
+        """
+        Id degli alert superati dal prezzo corrente.
+
+        PRICE_ABOVE scatta per target <= prezzo, PRICE_BELOW per target >= prezzo.
+        Un prezzo mancante (<= 0) non fa scattare nulla.
+
+        Returns:
+            np.ndarray: Id alert (int64)
+        """
+        if not price or price <= 0:
+            return np.empty(0, dtype=np.int64)
+
+        with self._lock:
+            sides = self._book.get(ticker.upper())
+            if sides is None:
+                return np.empty(0, dtype=np.int64)
+
+            above_targets, above_ids = sides['PRICE_ABOVE']
+            below_targets, below_ids = sides['PRICE_BELOW']
+
+            n_above = np.searchsorted(above_targets, price, side='right')
+            first_below = np.searchsorted(below_targets, price, side='left')
+
+            return np.concatenate([above_ids[:n_above], below_ids[first_below:]])
+
+    def load_all(self):
+        """
+        Caricamento completo degli alert attivi (all'avvio dell'evaluator).
+
+        L'orizzonte viene letto prima del caricamento: le transazioni sotto
+        l'orizzonte sono già concluse e quindi incluse nel caricamento, le
+        altre verranno rilette dal registro (applicarle due volte è innocuo).
+        """
+        horizon = execute_query("SELECT txid_snapshot_xmin(txid_current_snapshot()) AS xmin")
+        alerts = execute_query("""
+            SELECT id, ticker, alert_type, target_value
+            FROM alerts
+            WHERE is_active = TRUE
+        """) or []
+
+        self.load(alerts)
+        self._synced_xid = horizon[0]['xmin']
+        return {'added': len(alerts), 'removed': 0, 'size': len(self)}
+
+    def sync(self):
+        """
+        Allinea il book alla tabella alerts senza ricaricarlo tutto: legge
+        dal registro alert_changes solo gli alert toccati da transazioni
+        concluse dopo l'ultimo sync e ne applica lo stato attuale (attivo =
+        reinserito con il target aggiornato, altrimenti rimosso).
+        """
+        if self._synced_xid is None:
+            return self.load_all()
+
+        rows = execute_query(ALERT_CHANGES_QUERY, (self._synced_xid,)) or []
+        changed = [row for row in rows if row['alert_id'] is not None]
+
+        added = removed = 0
+        with self._lock:
+            for row in changed:
+                alert_id = int(row['alert_id'])
+                if alert_id in self._index:
+                    self._remove(alert_id)
+                    removed += 1
+                if row['is_active']:
+                    self._insert(alert_id, row['ticker'].upper(), row['alert_type'],
+                                 float(row['target_value']))
+                    added += 1
+
+        if rows:
+            self._synced_xid = rows[0]['xmin']
+
+        execute_query(f"""
+            DELETE FROM alert_changes
+            WHERE changed_at < CURRENT_TIMESTAMP - INTERVAL '{ALERT_CHANGES_RETENTION}'
+        """, fetch=False)
+
+        return {'added': added, 'removed': removed, 'size': len(self)}
+
+
+# Book condiviso dal processo evaluator
+_alert_book = None
+_alert_book_lock = threading.Lock()
+
+
+def get_alert_book():
+    """Ottieni il book degli alert del processo (caricato al primo utilizzo)."""
+    global _alert_book
+
+    if _alert_book is None:
+        with _alert_book_lock:
+            if _alert_book is None:
+                ensure_alert_changes_table()
+                book = AlertBook()
+                book.load_all()
+                _alert_book = book
+
+    return _alert_book
+
@@ -0,0 +1,140 @@
+from database.db_connection import execute_query, execute_values_query
+from database.quotes import get_price_vector
+from database.alert_book import get_alert_book
+from datetime import datetime
+import numpy as np
+import time
+
+# Storico trigger: una riga per ogni alert scattato
+ALERT_EVENTS_DDL = """
+    CREATE TABLE IF NOT EXISTS alert_events (
+        id SERIAL PRIMARY KEY,
+        alert_id INTEGER NOT NULL REFERENCES alerts(id) ON DELETE CASCADE,
+        user_id INTEGER NOT NULL,
+        ticker VARCHAR(20) NOT NULL,
+        alert_type VARCHAR(20) NOT NULL,
+        target_value NUMERIC NOT NULL,
+        trigger_price NUMERIC NOT NULL,
+        triggered_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        acknowledged_at TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_alert_events_user_pending
+        ON alert_events (user_id) WHERE acknowledged_at IS NULL;
+"""
+
+
+def ensure_alert_events_table():
+    """Crea la tabella alert_events se non esiste."""
+    execute_query(ALERT_EVENTS_DDL, fetch=False)
+
+
+def trigger_alerts(triggered):
+    """
+    Disattiva gli alert scattati e registra gli eventi con un solo statement.
+
+    Args:
+        triggered: Lista di (alert_id, prezzo)
+
+    Returns:
+        list: Eventi inseriti in alert_events
+    """
+    if not triggered:
+        return []
+
+    query = """
+        WITH hit (id, price) AS (VALUES %s),
+        updated AS (
+            UPDATE alerts a SET
+                is_active = FALSE,
+                current_value = hit.price,
+                triggered_at = CURRENT_TIMESTAMP
+            FROM hit
+            WHERE a.id = hit.id AND a.is_active = TRUE
+            RETURNING a.id, a.user_id, a.ticker, a.alert_type, a.target_value, a.current_value
+        )
+        INSERT INTO alert_events (alert_id, user_id, ticker, alert_type, target_value, trigger_price)
+        SELECT id, user_id, ticker, alert_type, target_value, current_value
+        FROM updated
+        RETURNING id, alert_id, user_id, ticker, alert_type, target_value, trigger_price, triggered_at
+    """
+    return execute_values_query(
+        query, triggered,
+        template="(%s::integer, %s::numeric)"
+    ) or []
+
+
+def evaluate_all_alerts(verbose=True):
+    """
+    Valuta tutti gli alert attivi di tutti gli utenti.
+
+    Il book in memoria viene sincronizzato in modo incrementale; poi un solo
+    fetch prezzi per i ticker con alert, una ricerca binaria per ticker e
+    un solo UPDATE/INSERT per tutti gli alert scattati.
+
+    Returns:
+        dict: Report con conteggi e tempi
+    """
+    start = time.perf_counter()
+    book = get_alert_book()
+    book.sync()
+
+    tickers = book.tickers()
+    prices = get_price_vector(tickers) if tickers else np.empty(0)
+
+    triggered = []
+    for ticker, price in zip(tickers, prices.tolist()):
+        triggered.extend((int(alert_id), price) for alert_id in book.crossed(ticker, price))
+
+    events = trigger_alerts(triggered)
+    book.remove_many(alert_id for alert_id, _ in triggered)
+
+    report = {
+        'alerts': len(book) + len(triggered),
+        'tickers': len(tickers),
+        'triggered': len(events),
+        'seconds': time.perf_counter() - start
+    }
+
+    if verbose:
+        print(f"[{datetime.now()}] Alert valutati: {report['alerts']} "
+              f"({report['tickers']} ticker), triggerati: {report['triggered']} "
+              f"in {report['seconds']:.2f}s")
+
+    return report
+
+
+def get_pending_alert_events(user_id, limit=20):
+    """
+    Eventi di trigger non ancora visti dall'utente (per la sidebar).
+
+    currency è la valuta del titolo nei portafogli dell'utente (None se non
+    lo detiene): trigger_price è nella valuta di quotazione.
+    """
+    try:
+        query = """
+            SELECT e.id, e.alert_id, e.ticker, e.alert_type, e.target_value, e.trigger_price,
+                   e.triggered_at,
+                   (SELECT p.currency
+                    FROM positions p
+                    JOIN portfolios pf ON pf.id = p.portfolio_id
+                    WHERE pf.user_id = e.user_id AND p.ticker = e.ticker
+                    LIMIT 1) AS currency
+            FROM alert_events e
+            WHERE e.user_id = %s AND e.acknowledged_at IS NULL
+            ORDER BY e.triggered_at DESC
+            LIMIT %s
+        """
+        return execute_query(query, (user_id, limit)) or []
+        
+    except Exception as e:
+        print(f"Errore recupero eventi alert: {e}")
+        return []
+
+
+def acknowledge_alert_events(user_id):
+    """Segna come visti tutti gli eventi dell'utente."""
+    query = """
+        UPDATE alert_events SET acknowledged_at = CURRENT_TIMESTAMP
+        WHERE user_id = %s AND acknowledged_at IS NULL
+    """
+    execute_query(query, (user_id,), fetch=False)
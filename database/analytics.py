@@ -1,35 +1,46 @@
-from database.db_connection import execute_query
+from database.db_connection import execute_query, bulk_upsert
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta, date
-import yfinance as yf
+from database.quotes import get_price_vector, normalize_tickers
+from database.valuation import value_positions, summarize_valuation, rollup, value_portfolios
+from database.fx import BASE_CURRENCY, get_fx_vector, missing_currencies
+from database.ledger import get_cost_fx
 import json
+import time
 
 
 def get_current_prices(tickers):
-    """Ottieni prezzi correnti per lista ticker."""
-    prices = {}
-    for ticker in tickers:
-        try:
-            stock = yf.Ticker(ticker)
-            info = stock.info
-            prices[ticker] = info.get('currentPrice') or info.get('regularMarketPrice', 0)
-        except:
-            prices[ticker] = 0
-    return prices
-
-
-def calculate_portfolio_performance(portfolio_id):
+    """Ottieni prezzi correnti per lista ticker (una sola chiamata bulk)."""
+    tickers = list(tickers)
+    prices = get_price_vector(tickers)
+    return {ticker: float(price) for ticker, price in zip(tickers, prices)}
+
+
+def calculate_portfolio_performance(portfolio_id, base_currency=None):
     """
     Calcola performance completa del portafoglio.
     
+    Prezzi e costi di ogni posizione sono nella valuta della posizione e
+    vengono convertiti nella valuta base in un unico passaggio vettoriale:
+    il valore al cambio corrente, il costo al cambio delle date di acquisto
+    dei lotti aperti (il P/L include quindi l'effetto valuta).
+    
+    Args:
+        portfolio_id: ID del portafoglio
+        base_currency: Valuta dei totali (default: BASE_CURRENCY)
+    
     Returns:
         dict con metriche: total_cost, current_value, gain_loss, gain_loss_pct, etc.
     """
+    base_currency = base_currency or BASE_CURRENCY
+    
     # Ottieni posizioni
     query = """
         SELECT ticker, shares, avg_price, currency, company_name, sector
         FROM positions
         WHERE portfolio_id = %s
+        ORDER BY ticker
     """
     positions = execute_query(query, (portfolio_id,))
     
@@ -41,64 +52,40 @@ def calculate_portfolio_performance(portfolio_id):
             'gain_loss_pct': 0,
             'positions': [],
             'current_prices': {},
-            'positions_performance': []
+            'positions_performance': [],
+            'positions_df': value_positions([], []),
+            'sector_allocation': rollup(value_positions([], [])),
+            'currency_allocation': rollup(value_positions([], []), 'currency'),
+            'base_currency': base_currency,
+            'missing_fx': []
         }
     
     # Ottieni prezzi correnti
     tickers = [p['ticker'] for p in positions]
-    current_prices = get_current_prices(tickers)
+    price_vector = get_price_vector(tickers)
+    current_prices = dict(zip(tickers, price_vector.tolist()))
     
-    # Calcola metriche
-    total_cost = 0
-    current_value = 0
-    positions_performance = []
+    # Cambi verso la valuta base (una sola lettura dalla matrice in cache)
+    fx_rates = get_fx_vector([p['currency'] for p in positions], base_currency)
+    cost_fx = get_cost_fx([portfolio_id], base_currency)
+    cost_fx_rates = [cost_fx.get((portfolio_id, t), np.nan) for t in tickers]
     
-    for pos in positions:
-        ticker = pos['ticker']
-        shares = float(pos['shares'])
-        avg_price = float(pos['avg_price'])
-        current_price = current_prices.get(ticker, 0)
-        
-        position_cost = shares * avg_price
-        position_value = shares * current_price
-        position_gain_loss = position_value - position_cost
-        position_gain_loss_pct = (position_gain_loss / position_cost * 100) if position_cost > 0 else 0
-        
-        total_cost += position_cost
-        current_value += position_value
-        
-        positions_performance.append({
-            'ticker': ticker,
-            'company_name': pos.get('company_name'),
-            'sector': pos.get('sector'),
-            'shares': shares,
-            'avg_price': avg_price,
-            'current_price': current_price,
-            'invested': position_cost,
-            'current_value': position_value,
-            'gain_loss': position_gain_loss,
-            'gain_loss_pct': position_gain_loss_pct,
-            'weight': 0  # Calcolato dopo
-        })
-    
-    # Calcola i pesi
-    for perf in positions_performance:
-        perf['weight'] = (perf['current_value'] / current_value * 100) if current_value > 0 else 0
-    
-    gain_loss = current_value - total_cost
-    gain_loss_pct = (gain_loss / total_cost * 100) if total_cost > 0 else 0
+    # Valorizzazione vettoriale di tutte le posizioni
+    positions_df = value_positions(positions, price_vector, fx_rates, cost_fx_rates)
+    totals = summarize_valuation(positions_df)
     
     return {
-        'total_cost': total_cost,
-        'current_value': current_value,
-        'gain_loss': gain_loss,
-        'gain_loss_pct': gain_loss_pct,
+        **totals,
         'positions': positions,
         'current_prices': current_prices,
-        'positions_performance': positions_performance,
-        'total_invested': total_cost,  # Alias per compatibilità
-        'total_gain_loss': gain_loss,  # Alias per compatibilità
-        'total_gain_loss_pct': gain_loss_pct  # Alias per compatibilità
+        'positions_df': positions_df,
+        'positions_performance': positions_df.to_dict('records'),
+        'sector_allocation': rollup(positions_df, 'sector'),
+        'currency_allocation': rollup(positions_df, 'currency'),
+        'base_currency': base_currency,
+        'total_invested': totals['total_cost'],  # Alias per compatibilità
+        'total_gain_loss': totals['gain_loss'],  # Alias per compatibilità
+        'total_gain_loss_pct': totals['gain_loss_pct']  # Alias per compatibilità
     }
 
 
@@ -143,6 +130,47 @@ def save_analysis(portfolio_id, analysis_data, analysis_type='snapshot'):
         return None
 
 
+def find_recent_analysis(portfolio_id, fingerprint, max_age_hours=24):
+    """
+    Cerca un'analisi recente con lo stesso fingerprint.
+    
+    Args:
+        portfolio_id: ID del portafoglio
+        fingerprint: Hash dei dati usati per generare l'analisi
+        max_age_hours: Età massima dell'analisi in ore
+        
+    Returns:
+        dict: Analisi (id, analysis_type, analysis_data, created_at) o None
+    """
+    try:
+        query = """
+            SELECT id, analysis_type, analysis_data, created_at
+            FROM portfolio_analyses
+            WHERE portfolio_id = %s
+                AND analysis_data::jsonb ->> 'fingerprint' = %s
+                AND created_at >= %s
+            ORDER BY created_at DESC
+            LIMIT 1
+        """
+        
+        result = execute_query(
+            query,
+            (portfolio_id, fingerprint, datetime.now() - timedelta(hours=max_age_hours))
+        )
+        
+        if not result:
+            return None
+        
+        analysis = dict(result[0])
+        if isinstance(analysis['analysis_data'], str):
+            analysis['analysis_data'] = json.loads(analysis['analysis_data'])
+        return analysis
+        
+    except Exception as e:
+        print(f"Errore ricerca analisi in cache: {e}")
+        return None
+
+
 def get_portfolio_analyses(portfolio_id, limit=10):
     """
     Recupera le analisi storiche di un portafoglio.
@@ -187,11 +215,22 @@ def get_portfolio_analyses(portfolio_id, limit=10):
 
 
 def save_portfolio_snapshot(portfolio_id):
-    """Salva snapshot giornaliero del portafoglio."""
+    """
+    Salva snapshot giornaliero del portafoglio.
+    
+    Returns:
+        bool: False se non salvato (portafoglio vuoto o cambio mancante:
+              un totale parziale non va scritto nello storico)
+    """
     perf = calculate_portfolio_performance(portfolio_id)
     
     if not perf or perf['total_cost'] == 0:
-        return
+        return False
+    
+    if perf['missing_fx']:
+        print(f"Snapshot portafoglio {portfolio_id} non salvato: "
+              f"cambio non disponibile per {perf['missing_fx']}")
+        return False
     
     query = """
         INSERT INTO portfolio_snapshots (
@@ -213,8 +252,129 @@ def save_portfolio_snapshot(portfolio_id):
         perf['total_cost'],
         perf['gain_loss'],
         perf['gain_loss_pct'],
-        'USD'  # TODO: gestire multi-currency
+        perf['base_currency']
     ), fetch=False)
+    return True
+
+
+def save_all_portfolio_snapshots(workers=4, snapshot_date=None, verbose=True):
+    """
+    Salva lo snapshot di tutti i portafogli attivi in un'unica passata.
+
+    - Una sola query per tutte le posizioni dei portafogli attivi
+    - Un solo fetch bulk per l'insieme dei ticker univoci (richieste del
+      provider in parallelo su `workers` thread)
+    - Valorizzazione vettoriale NumPy per portafoglio
+    - Un solo INSERT ... ON CONFLICT batch per tutti gli snapshot
+
+    I portafogli con una posizione senza cambio verso la valuta base
+    vengono saltati (e segnalati) invece di salvare un totale sbagliato.
+
+    Args:
+        workers: Richieste parallele al provider quotazioni nel fetch bulk
+        snapshot_date: Data snapshot (default: oggi)
+        verbose: Se True, stampa avanzamento e tempi
+
+    Returns:
+        dict: Report con conteggi e tempi per fase
+    """
+    timings = {}
+    start = time.perf_counter()
+
+    def log(msg):
+        if verbose:
+            print(f"[{datetime.now()}] {msg}")
+
+    # 1. Posizioni di tutti i portafogli attivi
+    query = """
+        SELECT pos.portfolio_id, pos.ticker, pos.shares, pos.avg_price, pos.currency
+        FROM positions pos
+        JOIN portfolios p ON p.id = pos.portfolio_id
+        WHERE p.is_active = TRUE
+    """
+    rows = execute_query(query) or []
+    timings['load_positions'] = time.perf_counter() - start
+    log(f"Posizioni caricate: {len(rows)} in {timings['load_positions']:.2f}s")
+
+    report = {
+        'positions': len(rows),
+        'tickers': 0,
+        'portfolios': 0,
+        'snapshots': 0,
+        'skipped': [],
+        'timings': timings
+    }
+
+    if not rows:
+        return report
+
+    portfolio_ids = np.fromiter((r['portfolio_id'] for r in rows), dtype=np.int64, count=len(rows))
+    tickers = [r['ticker'].upper() for r in rows]
+    shares = np.fromiter((float(r['shares']) for r in rows), dtype=np.float64, count=len(rows))
+    avg_prices = np.fromiter((float(r['avg_price']) for r in rows), dtype=np.float64, count=len(rows))
+
+    # 2. Prezzi: un solo fetch bulk per i ticker univoci
+    t0 = time.perf_counter()
+    unique_tickers = normalize_tickers(tickers)
+    unique_prices = get_price_vector(unique_tickers, workers=workers)
+    ticker_index = {t: i for i, t in enumerate(unique_tickers)}
+    prices = unique_prices[[ticker_index[t] for t in tickers]]
+
+    timings['fetch_prices'] = time.perf_counter() - t0
+    report['tickers'] = len(unique_tickers)
+    log(f"Prezzi recuperati: {len(unique_tickers)} ticker univoci in {timings['fetch_prices']:.2f}s "
+        f"({workers} richieste parallele)")
+
+    # 3. Valorizzazione vettoriale per portafoglio (convertita nella valuta base)
+    t0 = time.perf_counter()
+    currencies = [r['currency'] for r in rows]
+    fx_rates = get_fx_vector(currencies, BASE_CURRENCY)
+    cost_fx = get_cost_fx(np.unique(portfolio_ids).tolist(), BASE_CURRENCY)
+    cost_fx_rates = [cost_fx.get((r['portfolio_id'], r['ticker']), np.nan) for r in rows]
+    totals = value_portfolios(portfolio_ids, shares, avg_prices, prices, fx_rates, cost_fx_rates)
+    ids = totals['portfolio_id']
+    total_value = totals['total_value']
+    total_cost = totals['total_cost']
+    gain_loss = totals['gain_loss']
+    gain_loss_pct = totals['gain_loss_pct']
+    timings['valuation'] = time.perf_counter() - t0
+    report['portfolios'] = len(ids)
+
+    for pid in ids[~totals['complete']].tolist():
+        in_portfolio = portfolio_ids == pid
+        missing = missing_currencies([c for c, keep in zip(currencies, in_portfolio) if keep],
+                                     fx_rates[in_portfolio])
+        report['skipped'].append((pid, missing))
+        print(f"[{datetime.now()}] Portafoglio {pid} saltato: cambio non disponibile per {missing}")
+
+    # 4. Upsert batch di tutti gli snapshot
+    t0 = time.perf_counter()
+    snapshot_date = snapshot_date or date.today()
+    mask = (total_cost != 0) & totals['complete']
+    values = [
+        (int(pid), snapshot_date, float(v), float(c), float(gl), float(glp), BASE_CURRENCY)
+        for pid, v, c, gl, glp in zip(
+            ids[mask], total_value[mask], total_cost[mask], gain_loss[mask], gain_loss_pct[mask]
+        )
+    ]
+
+    if values:
+        bulk_upsert(
+            'portfolio_snapshots',
+            ['portfolio_id', 'snapshot_date', 'total_value', 'total_cost',
+             'gain_loss', 'gain_loss_pct', 'currency'],
+            values,
+            conflict_columns=['portfolio_id', 'snapshot_date'],
+            update_columns=['total_value', 'total_cost', 'gain_loss', 'gain_loss_pct']
+        )
+
+    timings['upsert'] = time.perf_counter() - t0
+    timings['total'] = time.perf_counter() - start
+    report['snapshots'] = len(values)
+    log(f"Snapshot salvati: {len(values)}/{len(ids)} in {timings['upsert']:.2f}s "
+        f"(totale {timings['total']:.2f}s)")
+
+    return report
 
 
 def get_portfolio_history(portfolio_id, days=90):
@@ -276,6 +436,68 @@ def get_position_pl(portfolio_id, ticker):
     }
 
 
+def get_portfolio_pl(portfolio_id, current_prices=None):
+    """
+    Calcola P&L di tutte le posizioni del portafoglio.
+
+    Due sole query (posizioni + transazioni) e nessun fetch prezzi se
+    `current_prices` è già disponibile (es. da calculate_portfolio_performance).
+
+    Args:
+        portfolio_id: ID del portafoglio
+        current_prices: dict {ticker: prezzo}; se None, un solo fetch bulk
+
+    Returns:
+        list: Dizionari come get_position_pl (importi nella valuta del
+              titolo, indicata in 'currency'), ordinati per ticker
+    """
+    query = """
+        SELECT ticker, shares, avg_price, currency
+        FROM positions
+        WHERE portfolio_id = %s
+        ORDER BY ticker
+    """
+    positions = execute_query(query, (portfolio_id,))
+
+    if not positions:
+        return []
+
+    query_tx = """
+        SELECT ticker, transaction_type, shares, price, transaction_date
+        FROM transactions
+        WHERE portfolio_id = %s
+        ORDER BY ticker, transaction_date
+    """
+    transactions = execute_query(query_tx, (portfolio_id,)) or []
+
+    tx_by_ticker = {}
+    for tx in transactions:
+        ticker = tx.pop('ticker')
+        tx_by_ticker.setdefault(ticker, []).append(tx)
+
+    tickers = [p['ticker'] for p in positions]
+    if current_prices is None:
+        current_prices = get_current_prices(tickers)
+
+    df = value_positions(positions, [current_prices.get(t, 0) for t in tickers])
+
+    return [
+        {
+            'ticker': row['ticker'],
+            'currency': row['currency'],
+            'shares': row['shares'],
+            'avg_price': row['avg_price'],
+            'current_price': row['current_price'],
+            'total_cost': row['invested'],
+            'current_value': row['current_value'],
+            'gain_loss': row['gain_loss'],
+            'gain_loss_pct': row['gain_loss_pct'],
+            'transactions': tx_by_ticker.get(row['ticker'], [])
+        }
+        for row in df.to_dict('records')
+    ]
+
+
 def delete_analysis(analysis_id):
     """
     Elimina un'analisi specifica.
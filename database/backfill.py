@@ -0,0 +1,285 @@
+from database.db_connection import execute_query, bulk_upsert
+from database.price_store import get_close_matrix
+from database.fx import BASE_CURRENCY, get_fx_history, lookup_fx, normalize_currency
+from datetime import datetime, date, timedelta
+import numpy as np
+import pandas as pd
+import time
+
+# Tipi di transazione che modificano le quantità detenute
+SHARE_SIGNS = {'BUY': 1.0, 'SELL': -1.0}
+
+SNAPSHOT_COLUMNS = [
+    'portfolio_id', 'snapshot_date', 'total_value', 'total_cost',
+    'gain_loss', 'gain_loss_pct', 'currency'
+]
+
+
+def load_transactions(portfolio_ids=None):
+    """
+    Transazioni BUY/SELL dei portafogli attivi (o di quelli indicati),
+    ordinate per portafoglio, ticker e data.
+
+    Returns:
+        pd.DataFrame: portfolio_id, ticker, transaction_type, shares, price,
+                      currency, transaction_date
+    """
+    query = """
+        SELECT t.id, t.portfolio_id, UPPER(t.ticker) AS ticker, t.transaction_type,
+               t.shares, t.price, t.currency, t.transaction_date
+        FROM transactions t
+        JOIN portfolios p ON p.id = t.portfolio_id
+        WHERE p.is_active = TRUE
+            AND t.transaction_type IN ('BUY', 'SELL')
+    """
+    params = None
+
+    if portfolio_ids:
+        query += " AND t.portfolio_id = ANY(%s)"
+        params = (list(portfolio_ids),)
+
+    query += " ORDER BY t.portfolio_id, ticker, t.transaction_date, t.id"
+
+    rows = execute_query(query, params) or []
+    df = pd.DataFrame(rows, columns=['id', 'portfolio_id', 'ticker', 'transaction_type',
+                                     'shares', 'price', 'currency', 'transaction_date'])
+    df['shares'] = df['shares'].astype(np.float64)
+    df['price'] = df['price'].astype(np.float64)
+    df['transaction_date'] = pd.to_datetime(df['transaction_date'])
+    return df
+
+
+def load_snapshot_dates(portfolio_ids):
+    """Date già presenti in portfolio_snapshots: {portfolio_id: set(date)}."""
+    rows = execute_query("""
+        SELECT portfolio_id, snapshot_date
+        FROM portfolio_snapshots
+        WHERE portfolio_id = ANY(%s)
+    """, (list(portfolio_ids),)) or []
+
+    existing = {}
+    for row in rows:
+        existing.setdefault(row['portfolio_id'], set()).add(pd.Timestamp(row['snapshot_date']))
+    return existing
+
+
+def cost_basis_deltas(transactions, fx_rates=None):
+    """
+    Variazione di quantità e costo di carico per ogni transazione.
+
+    Le vendite riducono il costo al prezzo medio di carico corrente:
+    è l'unico passaggio sequenziale (lineare nel numero di transazioni).
+
+    Args:
+        transactions: DataFrame ordinato per portafoglio, ticker, data
+        fx_rates: Cambio alla data di ogni transazione (opzionale): gli
+                  acquisti entrano nel costo già convertiti, e il costo
+                  resta fermo finché non ci sono nuove transazioni
+
+    Returns:
+        tuple: (delta azioni, delta costo) come array allineati
+    """
+    signs = transactions['transaction_type'].map(SHARE_SIGNS).to_numpy(dtype=np.float64)
+    shares = transactions['shares'].to_numpy(dtype=np.float64)
+    prices = transactions['price'].to_numpy(dtype=np.float64)
+    if fx_rates is not None:
+        prices = prices * np.asarray(fx_rates, dtype=np.float64)
+    keys = list(zip(transactions['portfolio_id'], transactions['ticker']))
+
+    share_deltas = signs * shares
+    cost_deltas = np.empty(len(shares), dtype=np.float64)
+
+    held = cost = 0.0
+    previous_key = None
+
+    for i, key in enumerate(keys):
+        if key != previous_key:
+            held = cost = 0.0
+            previous_key = key
+
+        if signs[i] > 0:
+            cost_deltas[i] = shares[i] * prices[i]
+        else:
+            sold = min(shares[i], held)
+            cost_deltas[i] = -cost * sold / held if held > 0 else 0.0
+
+        held = max(held + share_deltas[i], 0.0)
+        cost += cost_deltas[i]
+        if held == 0:
+            cost = 0.0
+
+    return share_deltas, cost_deltas
+
+
+def build_daily_values(transactions, closes, fx_history=None):
+    """
+    Valore e costo giornaliero per portafoglio su una matrice date x ticker.
+
+    Ogni colonna è una coppia (portafoglio, ticker): le transazioni vengono
+    sparse sul calendario di borsa e cumulate lungo le date, poi moltiplicate
+    per le chiusure e sommate per portafoglio.
+
+    Args:
+        transactions: DataFrame di load_transactions
+        closes: DataFrame di get_close_matrix (date x ticker)
+        fx_history: DataFrame di get_fx_history (date x valuta), opzionale:
+                    il valore di ogni giorno viene convertito al cambio di
+                    quel giorno, il costo al cambio della data di acquisto
+
+    Returns:
+        tuple: (portfolio_ids, calendar, total_value, total_cost, valid)
+               dove le matrici sono date x portafoglio e `valid` è False nei
+               giorni in cui manca il prezzo (o il cambio) di un titolo detenuto
+    """
+    calendar = closes.index.to_numpy(dtype='datetime64[ns]')
+    n_dates = len(calendar)
+
+    # Transazioni ordinate per portafoglio: le coppie restano contigue per portafoglio
+    pair_index, pairs = pd.MultiIndex.from_frame(
+        transactions[['portfolio_id', 'ticker']]
+    ).factorize()
+    pair_portfolios = pairs.get_level_values(0).to_numpy(dtype=np.int64)
+    pair_tickers = pairs.get_level_values(1)
+
+    # Transazioni in giorni non di borsa contano dal primo giorno di borsa successivo
+    date_index = np.searchsorted(calendar, transactions['transaction_date'].to_numpy(dtype='datetime64[ns]'))
+    in_range = date_index < n_dates
+
+    tx_fx = None
+    if fx_history is not None:
+        tx_fx = lookup_fx(fx_history, transactions['currency'].tolist(), transactions['transaction_date'])
+    share_deltas, cost_deltas = cost_basis_deltas(transactions, tx_fx)
+
+    shares = np.zeros((n_dates, len(pairs)), dtype=np.float64)
+    cost = np.zeros((n_dates, len(pairs)), dtype=np.float64)
+    np.add.at(shares, (date_index[in_range], pair_index[in_range]), share_deltas[in_range])
+    np.add.at(cost, (date_index[in_range], pair_index[in_range]), cost_deltas[in_range])
+    shares = np.maximum(np.cumsum(shares, axis=0), 0.0)
+    cost = np.cumsum(cost, axis=0)
+
+    pair_closes = closes.reindex(columns=pair_tickers).ffill().to_numpy(dtype=np.float64)
+    missing = (shares > 0) & np.isnan(pair_closes)
+    values = shares * np.nan_to_num(pair_closes)
+
+    if fx_history is not None:
+        pair_currencies = (transactions['currency'].groupby(pair_index).first()
+                           .map(normalize_currency).reindex(range(len(pairs))))
+        fx = (fx_history.reindex(fx_history.index.union(closes.index)).ffill().bfill()
+              .reindex(index=closes.index, columns=pair_currencies.tolist())
+              .to_numpy(dtype=np.float64))
+        # Giorni senza cambio per un titolo detenuto: non validi, come i prezzi mancanti
+        missing |= (shares > 0) & (np.isnan(fx) | np.isnan(cost))
+        values = values * np.nan_to_num(fx, nan=0.0)
+        cost = np.nan_to_num(cost, nan=0.0)
+
+    # Le coppie sono ordinate per portafoglio: somma per blocchi di colonne
+    portfolio_ids, starts = np.unique(pair_portfolios, return_index=True)
+    total_value = np.add.reduceat(values, starts, axis=1)
+    total_cost = np.add.reduceat(cost, starts, axis=1)
+    valid = ~np.logical_or.reduceat(missing, starts, axis=1)
+
+    return portfolio_ids, calendar, total_value, total_cost, valid
+
+
+def backfill_snapshots(portfolio_ids=None, start=None, end=None, overwrite=False, verbose=True):
+    """
+    Ricostruisce gli snapshot giornalieri dal registro transazioni.
+
+    - Una query per le transazioni e una per le date già salvate
+    - Chiusure dall'archivio locale (price_store), scaricando in un solo
+      download bulk solo le barre mancanti
+    - Calcolo vettoriale su matrice date x (portafoglio, ticker)
+    - Un solo upsert batch, solo per le date mancanti (salvo overwrite)
+
+    Args:
+        portfolio_ids: Portafogli da ricostruire (default: tutti gli attivi)
+        start: Prima data (default: prima transazione)
+        end: Ultima data (default: ieri; lo snapshot di oggi lo salva il cron)
+        overwrite: Se True riscrive anche le date già presenti
+        verbose: Se True, stampa avanzamento e tempi
+
+    Returns:
+        dict: Report con conteggi e tempi per fase
+    """
+    timings = {}
+    t0 = time.perf_counter()
+
+    def log(msg):
+        if verbose:
+            print(f"[{datetime.now()}] {msg}")
+
+    report = {'transactions': 0, 'portfolios': 0, 'tickers': 0, 'dates': 0,
+              'snapshots': 0, 'timings': timings}
+
+    # 1. Transazioni e date già presenti
+    transactions = load_transactions(portfolio_ids)
+    report['transactions'] = len(transactions)
+    if transactions.empty:
+        log("Nessuna transazione da elaborare")
+        return report
+
+    existing = {} if overwrite else load_snapshot_dates(transactions['portfolio_id'].unique().tolist())
+    timings['load'] = time.perf_counter() - t0
+
+    # 2. Chiusure storiche dall'archivio locale (solo barre mancanti scaricate)
+    t1 = time.perf_counter()
+    start = pd.Timestamp(start) if start else transactions['transaction_date'].min()
+    end = pd.Timestamp(end) if end else pd.Timestamp(date.today() - timedelta(days=1))
+    tickers = sorted(transactions['ticker'].unique())
+    closes = get_close_matrix(tickers, start, end)
+    timings['fetch_prices'] = time.perf_counter() - t1
+    report['tickers'] = len(tickers)
+    log(f"Chiusure storiche: {len(tickers)} ticker, {len(closes)} giorni "
+        f"in {timings['fetch_prices']:.2f}s")
+
+    if closes.empty:
+        return report
+
+    # Le transazioni precedenti a `start` confluiscono nel primo giorno del calendario
+    closes = closes.loc[(closes.index >= start) & (closes.index <= end)]
+
+    # 3. Valori giornalieri vettoriali in valuta base (valore al cambio del giorno,
+    #    costo al cambio della data di acquisto)
+    t1 = time.perf_counter()
+    # Cambi dalla prima transazione: servono anche per il costo degli acquisti precedenti a `start`
+    fx_history = get_fx_history(transactions['currency'].unique().tolist(),
+                                min(start, transactions['transaction_date'].min()), end)
+    ids, calendar, total_value, total_cost, valid = build_daily_values(transactions, closes, fx_history)
+    timings['valuation'] = time.perf_counter() - t1
+    report['portfolios'] = len(ids)
+    report['dates'] = len(calendar)
+
+    # 4. Solo date mancanti con posizioni aperte e prezzi completi
+    dates = pd.DatetimeIndex(calendar)
+    values = []
+    for j, portfolio_id in enumerate(ids.tolist()):
+        saved = existing.get(portfolio_id, set())
+        keep = valid[:, j] & (total_cost[:, j] != 0)
+        if saved:
+            keep &= ~dates.isin(list(saved))
+
+        cost = total_cost[keep, j]
+        value = total_value[keep, j]
+        gain_loss = value - cost
+        gain_loss_pct = np.divide(gain_loss * 100, cost, out=np.zeros_like(cost), where=cost > 0)
+
+        values.extend(
+            (portfolio_id, d.date(), float(v), float(c), float(gl), float(glp), BASE_CURRENCY)
+            for d, v, c, gl, glp in zip(dates[keep], value, cost, gain_loss, gain_loss_pct)
+        )
+
+    # 5. Upsert batch
+    t1 = time.perf_counter()
+    if values:
+        bulk_upsert(
+            'portfolio_snapshots', SNAPSHOT_COLUMNS, values,
+            conflict_columns=['portfolio_id', 'snapshot_date'],
+            update_columns=None if overwrite else []
+        )
+    timings['upsert'] = time.perf_counter() - t1
+    timings['total'] = time.perf_counter() - t0
+    report['snapshots'] = len(values)
+    log(f"Snapshot ricostruiti: {len(values)} ({len(ids)} portafogli, {len(calendar)} giorni) "
+        f"in {timings['total']:.2f}s")
+
+    return report
@@ -1,31 +1,71 @@
 import os
+import io
+import csv
+import math
+import time
+import threading
+from itertools import islice
+import numpy as np
+import pandas as pd
 import psycopg2
-from psycopg2 import pool
+from psycopg2 import pool, sql
+from psycopg2.extras import execute_values
 from contextlib import contextmanager
 import streamlit as st
 
 # Database URL da secrets
 DATABASE_URL = os.getenv("DATABASE_URL", "")
 
+# Dimensionamento pool (un thread per sessione Streamlit)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))      # attesa massima checkout (s)
+DB_POOL_RECYCLE = float(os.getenv("DB_POOL_RECYCLE", "1800"))    # età massima connessione (s)
+DB_POOL_PING_IDLE = float(os.getenv("DB_POOL_PING_IDLE", "30"))  # ping se inattiva da più di (s)
+
 # Connection pool globale
 _connection_pool = None
+_pool_lock = threading.Lock()
+_pool_slots = None  # semaforo: una slot per connessione disponibile
+
+# Metadati connessioni (protetti da _pool_lock): id(conn) -> {'conn', 'created', 'last_used'}.
+# Il riferimento a conn impedisce il riuso dell'id finché la voce esiste.
+_conn_meta = {}
+
+# Gauge e contatori del pool
+_pool_stats = {
+    'in_use': 0,
+    'waiting': 0,
+    'acquired': 0,
+    'timeouts': 0,
+    'recycled': 0,
+    'broken': 0,
+    'acquire_time_total': 0.0,
+    'acquire_time_max': 0.0,
+}
+
+
+class PoolTimeoutError(Exception):
+    """Nessuna connessione disponibile entro DB_POOL_TIMEOUT."""
 
 
 def init_connection_pool():
-    """Inizializza connection pool PostgreSQL."""
-    global _connection_pool
+    """Inizializza connection pool PostgreSQL (thread-safe)."""
+    global _connection_pool, _pool_slots
     
-    if _connection_pool is None:
-        try:
-            _connection_pool = pool.SimpleConnectionPool(
-                minconn=1,
-                maxconn=10,
-                dsn=DATABASE_URL
-            )
-            print("✅ Connection pool PostgreSQL inizializzato")
-        except Exception as e:
-            print(f"❌ Errore inizializzazione pool: {e}")
-            raise
+    with _pool_lock:
+        if _connection_pool is None:
+            try:
+                _connection_pool = pool.ThreadedConnectionPool(
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    dsn=DATABASE_URL
+                )
+                _pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+                print(f"✅ Connection pool PostgreSQL inizializzato (max {DB_POOL_MAX})")
+            except Exception as e:
+                print(f"❌ Errore inizializzazione pool: {e}")
+                raise
 
 
 def get_connection_pool():
@@ -35,20 +75,162 @@ def get_connection_pool():
     return _connection_pool
 
 
+def _is_alive(conn, now):
+    """
+    Verifica la connessione: chiusa, troppo vecchia o (se inattiva) ping fallito.
+    Una connessione senza metadati (mai vista da questo modulo) viene pingata subito.
+    """
+    if conn.closed:
+        return False
+
+    with _pool_lock:
+        meta = _conn_meta.get(id(conn))
+        if meta is not None and meta['conn'] is not conn:
+            meta = None
+        created, last_used = (meta['created'], meta['last_used']) if meta else (None, None)
+
+    if created is not None and now - created > DB_POOL_RECYCLE:
+        with _pool_lock:
+            _pool_stats['recycled'] += 1
+        return False
+
+    if last_used is None or now - last_used > DB_POOL_PING_IDLE:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except Exception:
+            with _pool_lock:
+                _pool_stats['broken'] += 1
+            return False
+
+    return True
+
+
+def _touch_connection(conn, now):
+    """Registra (alla prima vista) e aggiorna i metadati di una connessione."""
+    with _pool_lock:
+        meta = _conn_meta.get(id(conn))
+        if meta is None or meta['conn'] is not conn:
+            meta = _conn_meta[id(conn)] = {'conn': conn, 'created': now, 'last_used': now}
+        meta['last_used'] = now
+
+
+def _forget_connection(conn):
+    with _pool_lock:
+        meta = _conn_meta.get(id(conn))
+        if meta is not None and meta['conn'] is conn:
+            del _conn_meta[id(conn)]
+
+
+def acquire_connection(timeout=None):
+    """
+    Preleva una connessione dal pool, attendendo se sono tutte in uso.
+
+    Args:
+        timeout: Secondi massimi di attesa (default: DB_POOL_TIMEOUT)
+
+    Returns:
+        Connessione psycopg2 verificata
+
+    Raises:
+        PoolTimeoutError: se nessuna connessione si libera in tempo
+    """
+    db_pool = get_connection_pool()
+    timeout = DB_POOL_TIMEOUT if timeout is None else timeout
+    start = time.monotonic()
+
+    with _pool_lock:
+        _pool_stats['waiting'] += 1
+    try:
+        acquired = _pool_slots.acquire(timeout=timeout)
+    finally:
+        with _pool_lock:
+            _pool_stats['waiting'] -= 1
+
+    if not acquired:
+        with _pool_lock:
+            _pool_stats['timeouts'] += 1
+        raise PoolTimeoutError(f"Nessuna connessione disponibile dopo {timeout:.0f}s")
+
+    try:
+        while True:
+            conn = db_pool.getconn()
+            now = time.monotonic()
+
+            if _is_alive(conn, now):
+                break
+
+            # Connessione scaduta o rotta: chiudi e riprova con una nuova
+            _forget_connection(conn)
+            db_pool.putconn(conn, close=True)
+
+        _touch_connection(conn, now)
+    except Exception:
+        _pool_slots.release()
+        raise
+
+    elapsed = time.monotonic() - start
+    with _pool_lock:
+        _pool_stats['in_use'] += 1
+        _pool_stats['acquired'] += 1
+        _pool_stats['acquire_time_total'] += elapsed
+        _pool_stats['acquire_time_max'] = max(_pool_stats['acquire_time_max'], elapsed)
+
+    return conn
+
+
+def release_connection(conn):
+    """Restituisce una connessione al pool (chiudendola se rotta)."""
+    close = bool(conn.closed)
+
+    if close:
+        _forget_connection(conn)
+    else:
+        _touch_connection(conn, time.monotonic())
+
+    try:
+        get_connection_pool().putconn(conn, close=close)
+    finally:
+        _pool_slots.release()
+        with _pool_lock:
+            _pool_stats['in_use'] -= 1
+
+
+def get_pool_stats():
+    """
+    Gauge del connection pool.
+
+    Returns:
+        dict: in_use, waiting, max_size, acquired, timeouts, recycled,
+              broken, avg_acquire_ms, max_acquire_ms
+    """
+    with _pool_lock:
+        stats = dict(_pool_stats)
+
+    acquired = stats.pop('acquired')
+    total = stats.pop('acquire_time_total')
+    stats['acquired'] = acquired
+    stats['max_size'] = DB_POOL_MAX
+    stats['avg_acquire_ms'] = (total / acquired * 1000) if acquired else 0
+    stats['max_acquire_ms'] = stats.pop('acquire_time_max') * 1000
+    return stats
+
+
 @contextmanager
 def get_db_connection():
     """Context manager per connessioni database."""
-    pool = get_connection_pool()
-    conn = pool.getconn()
+    conn = acquire_connection()
     
     try:
         yield conn
         conn.commit()
     except Exception as e:
-        conn.rollback()
+        if not conn.closed:
+            conn.rollback()
         raise e
     finally:
-        pool.putconn(conn)
+        release_connection(conn)
 
 
 def execute_query(query, params=None, fetch=True):
@@ -76,9 +258,194 @@ def execute_query(query, params=None, fetch=True):
         return None
 
 
+def execute_values_query(query, rows, template=None, fetch=True, conn=None):
+    """
+    Esegue una query con un unico placeholder VALUES %s espanso con tutte le righe
+    (psycopg2.extras.execute_values), in un solo statement.
+
+    Args:
+        query: Query SQL con un solo %s per la lista VALUES
+        rows: Lista di tuple
+        template: Template per riga (es. '(%s::integer, %s::numeric)')
+        fetch: Se True, ritorna i risultati (RETURNING)
+        conn: Connessione esistente (default: una nuova dal pool)
+
+    Returns:
+        Lista di dizionari con risultati o None
+    """
+    rows = list(rows)
+
+    def run(connection):
+        cursor = connection.cursor()
+        results = execute_values(
+            cursor, query, rows, template=template,
+            page_size=max(len(rows), 1), fetch=fetch
+        )
+
+        if fetch and cursor.description:
+            columns = [desc[0] for desc in cursor.description]
+            return [dict(zip(columns, row)) for row in results]
+
+        return None
+
+    if conn is not None:
+        return run(conn)
+
+    with get_db_connection() as connection:
+        return run(connection)
+
+
 def execute_many(query, params_list):
     """Esegue query multiple (batch insert/update)."""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.executemany(query, params_list)
         conn.commit()
+
+
+# ========================================
+# BULK WRITE
+# ========================================
+
+def _identifier(name):
+    """Identificatore SQL quotato (supporta 'schema.tabella')."""
+    return sql.Identifier(*name.split('.'))
+
+
+def _clean_value(value):
+    """Converte NaN/NaT in None e scalari NumPy in tipi Python."""
+    if isinstance(value, np.datetime64):
+        value = pd.Timestamp(value)
+    elif isinstance(value, np.generic):
+        value = value.item()
+
+    if value is pd.NaT:
+        return None
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def _iter_rows(rows, columns):
+    """Righe come tuple da DataFrame o iterabile di tuple/dict."""
+    if hasattr(rows, 'itertuples'):  # DataFrame
+        for row in rows[list(columns)].itertuples(index=False, name=None):
+            yield tuple(_clean_value(v) for v in row)
+        return
+
+    for row in rows:
+        if isinstance(row, dict):
+            yield tuple(_clean_value(row.get(c)) for c in columns)
+        else:
+            yield tuple(_clean_value(v) for v in row)
+
+
+def _iter_chunks(rows, chunk_size):
+    """Suddivide un iterabile in liste da chunk_size senza materializzarlo tutto."""
+    iterator = iter(rows)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def bulk_upsert(table, columns, rows, conflict_columns=None, update_columns=None,
+                template=None, chunk_size=5000, conn=None):
+    """
+    Insert/upsert batch con psycopg2.extras.execute_values.
+
+    Ogni chunk è un unico statement multi-VALUES; tutti i chunk vengono
+    eseguiti nella stessa transazione.
+
+    Args:
+        table: Nome tabella
+        columns: Colonne da scrivere (ordine delle tuple)
+        rows: DataFrame o iterabile di tuple/dict
+        conflict_columns: Colonne ON CONFLICT (None = semplice INSERT)
+        update_columns: Colonne da aggiornare in conflitto
+                        (default: tutte tranne conflict_columns; [] = DO NOTHING)
+        template: Template execute_values (es. '(%s, %s::date)')
+        chunk_size: Righe per statement
+        conn: Connessione esistente (default: una nuova dal pool)
+
+    Returns:
+        int: Numero di righe inviate
+    """
+    query = sql.SQL("INSERT INTO {} ({}) VALUES %s").format(
+        _identifier(table),
+        sql.SQL(', ').join(map(sql.Identifier, columns))
+    )
+
+    if conflict_columns:
+        if update_columns is None:
+            update_columns = [c for c in columns if c not in conflict_columns]
+
+        conflict = sql.SQL(', ').join(map(sql.Identifier, conflict_columns))
+
+        if update_columns:
+            updates = sql.SQL(', ').join(
+                sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(c)) for c in update_columns
+            )
+            query = sql.SQL("{} ON CONFLICT ({}) DO UPDATE SET {}").format(query, conflict, updates)
+        else:
+            query = sql.SQL("{} ON CONFLICT ({}) DO NOTHING").format(query, conflict)
+
+    def run(connection):
+        cursor = connection.cursor()
+        query_str = query.as_string(connection)
+        total = 0
+        for chunk in _iter_chunks(_iter_rows(rows, columns), chunk_size):
+            execute_values(cursor, query_str, chunk, template=template, page_size=len(chunk))
+            total += len(chunk)
+        return total
+
+    if conn is not None:
+        return run(conn)
+
+    with get_db_connection() as connection:
+        return run(connection)
+
+
+def copy_rows(table, columns, rows, chunk_size=50000, conn=None):
+    """
+    Insert massivo con COPY ... FROM STDIN (formato CSV).
+
+    Le righe vengono serializzate e inviate a blocchi di chunk_size,
+    così anche file da centinaia di migliaia di righe restano in streaming.
+    Tutti i blocchi sono nella stessa transazione.
+
+    Args:
+        table: Nome tabella
+        columns: Colonne da scrivere (ordine delle tuple)
+        rows: DataFrame o iterabile di tuple/dict
+        chunk_size: Righe per blocco COPY
+        conn: Connessione esistente (default: una nuova dal pool)
+
+    Returns:
+        int: Numero di righe copiate
+    """
+    copy_sql = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')").format(
+        _identifier(table),
+        sql.SQL(', ').join(map(sql.Identifier, columns))
+    )
+
+    def run(connection):
+        cursor = connection.cursor()
+        copy_str = copy_sql.as_string(connection)
+        total = 0
+        for chunk in _iter_chunks(_iter_rows(rows, columns), chunk_size):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in chunk:
+                writer.writerow(['\\N' if v is None else v for v in row])
+            buffer.seek(0)
+            cursor.copy_expert(copy_str, buffer)
+            total += len(chunk)
+        return total
+
+    if conn is not None:
+        return run(conn)
+
+    with get_db_connection() as connection:
+        return run(connection)
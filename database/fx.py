@@ -0,0 +1,203 @@
+import os
+import time
+import threading
+import numpy as np
+import pandas as pd
+from database.quotes import get_price_vector, QUOTE_PROVIDER
+from database.price_store import get_close_matrix
+
+# Valuta in cui vengono espressi totali e snapshot
+BASE_CURRENCY = os.getenv("BASE_CURRENCY", "USD").upper()
+
+# Secondi di validità della matrice dei cambi
+FX_CACHE_TTL = int(os.getenv("FX_CACHE_TTL", "900"))
+
+# Valuta pivot: ogni cambio viene scaricato come <VALUTA>USD
+PIVOT_CURRENCY = "USD"
+
+# Sottounità quotate da alcune borse (es. Londra in pence): (valuta, divisore)
+CURRENCY_SUBUNITS = {
+    'GBX': ('GBP', 100.0),
+    'ZAC': ('ZAR', 100.0),
+    'ILA': ('ILS', 100.0),
+}
+
+CURRENCY_SYMBOLS = {'USD': '$', 'EUR': '€', 'GBP': '£', 'CHF': 'CHF ', 'JPY': '¥'}
+
+_fx_cache = {}  # tuple valute -> (matrice, indice valuta -> posizione, timestamp)
+_fx_cache_lock = threading.Lock()
+
+
+def normalize_currency(currency):
+    """Codice valuta maiuscolo; None/vuoto -> valuta base. 'GBp' -> 'GBX'."""
+    if not currency:
+        return BASE_CURRENCY
+    if currency == 'GBp':
+        return 'GBX'
+    return str(currency).strip().upper()
+
+
+def currency_symbol(currency):
+    """Simbolo per la formattazione degli importi (es. '$', '€')."""
+    code = normalize_currency(currency)
+    return CURRENCY_SYMBOLS.get(code, f"{code} ")
+
+
+def pair_symbol(currency):
+    """Simbolo del cambio <VALUTA>USD per il provider quotazioni in uso."""
+    if QUOTE_PROVIDER == 'fmp':
+        return f"{currency}{PIVOT_CURRENCY}"
+    return f"{currency}{PIVOT_CURRENCY}=X"
+
+
+def _split_subunits(currencies):
+    """(valute principali, divisori) per un elenco di codici normalizzati."""
+    majors = []
+    divisors = np.ones(len(currencies), dtype=np.float64)
+    for i, currency in enumerate(currencies):
+        major, divisor = CURRENCY_SUBUNITS.get(currency, (currency, 1.0))
+        majors.append(major)
+        divisors[i] = divisor
+    return majors, divisors
+
+
+# ========================================
+# MATRICE CAMBI (CACHE TTL)
+# ========================================
+
+def get_rate_matrix(currencies):
+    """
+    Matrice densa dei cambi tra le valute richieste (più la valuta base).
+
+    Tutti i cambi vengono scaricati verso USD con un solo fetch bulk del
+    motore quotazioni; la matrice è il rapporto esterno
+    M[i, j] = usd_per[i] / usd_per[j] (1 unità di i espressa in j).
+
+    Una matrice con cambi mancanti non va in cache: il fetch successivo
+    riprova invece di riusare il buco per tutto FX_CACHE_TTL.
+
+    Returns:
+        tuple: (matrice n x n, dict valuta -> indice). NaN dove manca un cambio.
+    """
+    codes = tuple(sorted({normalize_currency(c) for c in currencies} | {BASE_CURRENCY}))
+    now = time.monotonic()
+
+    with _fx_cache_lock:
+        cached = _fx_cache.get(codes)
+        if cached and now - cached[2] < FX_CACHE_TTL:
+            return cached[0], cached[1]
+
+    majors, divisors = _split_subunits(codes)
+    to_fetch = sorted({m for m in majors if m != PIVOT_CURRENCY})
+
+    usd_per_major = {PIVOT_CURRENCY: 1.0}
+    if to_fetch:
+        rates = get_price_vector([pair_symbol(c) for c in to_fetch])
+        usd_per_major.update({
+            currency: (rate if rate > 0 else np.nan) for currency, rate in zip(to_fetch, rates.tolist())
+        })
+
+    usd_per = np.array([usd_per_major.get(m, np.nan) for m in majors], dtype=np.float64) / divisors
+    matrix = usd_per[:, None] / usd_per[None, :]
+    index = {currency: i for i, currency in enumerate(codes)}
+
+    if np.isfinite(matrix).all():
+        with _fx_cache_lock:
+            _fx_cache[codes] = (matrix, index, now)
+
+    return matrix, index
+
+
+def get_fx_vector(currencies, base=None):
+    """
+    Tassi di conversione verso la valuta base allineati a `currencies`
+    (un elemento per posizione): una sola lettura vettoriale della matrice.
+
+    Un cambio mancante resta NaN (e viene segnalato): i chiamanti escludono
+    quelle posizioni dai totali invece di valorizzarle 1:1.
+
+    Returns:
+        np.ndarray: float64, stessa lunghezza di currencies
+    """
+    base = normalize_currency(base or BASE_CURRENCY)
+    codes = [normalize_currency(c) for c in currencies]
+    if not codes:
+        return np.empty(0, dtype=np.float64)
+
+    matrix, index = get_rate_matrix(codes + [base])
+    rows = np.fromiter((index[c] for c in codes), dtype=np.int64, count=len(codes))
+    rates = matrix[rows, index[base]]
+
+    missing = ~np.isfinite(rates)
+    if missing.any():
+        print(f"Cambio non disponibile per {missing_currencies(codes, rates)} -> {base}")
+
+    return rates
+
+
+def missing_currencies(currencies, rates):
+    """Valute (ordinate, senza duplicati) il cui tasso in `rates` è NaN."""
+    return sorted({normalize_currency(c) for c, r in zip(currencies, rates) if not np.isfinite(r)})
+
+
+def convert(amounts, currencies, base=None):
+    """Converte importi (array) dalle rispettive valute alla valuta base."""
+    return np.asarray(amounts, dtype=np.float64) * get_fx_vector(currencies, base)
+
+
+def clear_fx_cache():
+    """Svuota la cache della matrice cambi."""
+    with _fx_cache_lock:
+        _fx_cache.clear()
+
+
+# ========================================
+# STORICO CAMBI
+# ========================================
+
+def get_fx_history(currencies, start, end=None, base=None):
+    """
+    Cambi giornalieri verso la valuta base dall'archivio prezzi locale.
+
+    Returns:
+        pd.DataFrame: Indice date, una colonna per valuta (ffill, 1 per la base)
+    """
+    base = normalize_currency(base or BASE_CURRENCY)
+    codes = sorted({normalize_currency(c) for c in currencies} | {base})
+    majors, divisors = _split_subunits(codes)
+
+    to_fetch = sorted({m for m in majors if m != PIVOT_CURRENCY})
+    closes = get_close_matrix([pair_symbol(c) for c in to_fetch], start, end) if to_fetch else pd.DataFrame()
+
+    index = closes.index if not closes.empty else pd.DatetimeIndex([pd.Timestamp(start)])
+    usd_per = pd.DataFrame(index=index)
+    for code, major, divisor in zip(codes, majors, divisors):
+        if major == PIVOT_CURRENCY:
+            usd_per[code] = 1.0 / divisor
+        else:
+            usd_per[code] = closes.get(pair_symbol(major), np.nan) / divisor
+
+    usd_per = usd_per.ffill().bfill()
+    return usd_per.div(usd_per[base], axis=0)
+
+
+def lookup_fx(fx_history, currencies, dates):
+    """
+    Cambio di ogni riga alla propria data da una tabella di get_fx_history
+    (ultimo cambio disponibile a quella data, il primo per le date precedenti).
+
+    Returns:
+        np.ndarray: float64 allineato a currencies/dates, NaN se la valuta manca
+    """
+    codes = [normalize_currency(c) for c in currencies]
+    if not codes or fx_history.empty:
+        return np.full(len(codes), np.nan, dtype=np.float64)
+
+    calendar = fx_history.index.to_numpy(dtype='datetime64[ns]')
+    rows = np.searchsorted(calendar, pd.to_datetime(pd.Series(dates)).to_numpy(dtype='datetime64[ns]'),
+                           side='right') - 1
+    rows = np.clip(rows, 0, len(calendar) - 1)
+    columns = fx_history.columns.get_indexer(codes)
+
+    rates = fx_history.to_numpy(dtype=np.float64)[rows, np.maximum(columns, 0)]
+    return np.where(columns >= 0, rates, np.nan)
@@ -0,0 +1,606 @@
+from database.db_connection import get_db_connection, copy_rows
+from database.ledger import ensure_ledger_tables, rebuild_positions, POSITION_TYPES, LEDGER_EPSILON
+from database.fx import normalize_currency
+from datetime import datetime
+import csv
+import os
+import re
+import time
+import numpy as np
+import pandas as pd
+
+# Righe lette per blocco: il file non viene mai caricato per intero
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "50000"))
+
+# Errori di riga riportati (il conteggio resta completo)
+IMPORT_MAX_ERRORS = 1000
+
+# Nomi colonna accettati (intestazioni normalizzate: minuscole, senza spazi/simboli)
+COLUMN_ALIASES = {
+    'ticker': ['ticker', 'symbol', 'simbolo', 'titolo', 'instrument', 'strumento', 'codice'],
+    'shares': ['shares', 'quantity', 'qty', 'quantita', 'quantità', 'azioni', 'units', 'quote'],
+    'price': ['price', 'prezzo', 'avgprice', 'prezzomedio', 'unitprice', 'prezzounitario', 'cost'],
+    'currency': ['currency', 'valuta', 'ccy', 'divisa'],
+    'transaction_date': ['transactiondate', 'date', 'data', 'tradedate', 'dataoperazione',
+                         'purchasedate', 'dataacquisto'],
+    'transaction_type': ['transactiontype', 'type', 'tipo', 'side', 'action', 'operazione', 'segno'],
+    'fees': ['fees', 'fee', 'commission', 'commissions', 'commissioni'],
+    'notes': ['notes', 'note', 'description', 'descrizione'],
+}
+REQUIRED_COLUMNS = ('ticker', 'shares', 'price')
+
+TYPE_ALIASES = {
+    'BUY': 'BUY', 'B': 'BUY', 'BOUGHT': 'BUY', 'PURCHASE': 'BUY', 'ACQUISTO': 'BUY', 'A': 'BUY',
+    'SELL': 'SELL', 'S': 'SELL', 'SOLD': 'SELL', 'VENDITA': 'SELL', 'V': 'SELL',
+}
+
+TICKER_PATTERN = r'[A-Z0-9][A-Z0-9.\-^=]{0,19}'
+
+LOT_COLUMNS = ['row_number', 'ticker', 'transaction_type', 'shares', 'price',
+               'currency', 'transaction_date', 'fees', 'notes']
+AGGREGATE_COLUMNS = ['ticker', 'bought', 'sold', 'lots']
+ERROR_COLUMNS = ['riga', 'campo', 'valore', 'errore']
+
+STAGING_DDL = """
+    CREATE TEMP TABLE import_lots (
+        row_number INTEGER,
+        ticker VARCHAR(20),
+        transaction_type VARCHAR(10),
+        shares NUMERIC,
+        price NUMERIC,
+        currency VARCHAR(10),
+        transaction_date DATE,
+        fees NUMERIC,
+        notes TEXT
+    ) ON COMMIT DROP;
+"""
+
+# Transazioni dallo staging e timestamp del portafoglio in un solo statement
+INSERT_QUERY = """
+    WITH recorded AS (
+        INSERT INTO transactions (
+            portfolio_id, ticker, transaction_type, shares, price,
+            currency, transaction_date, fees, notes
+        )
+        SELECT %(portfolio_id)s, ticker, transaction_type, shares, price,
+               currency, COALESCE(transaction_date, CURRENT_DATE), COALESCE(fees, 0), notes
+        FROM import_lots
+        ORDER BY row_number
+        RETURNING id
+    ),
+    touched AS (
+        UPDATE portfolios SET updated_at = CURRENT_TIMESTAMP WHERE id = %(portfolio_id)s
+    )
+    SELECT COUNT(*) FROM recorded
+"""
+
+# Registro esistente e righe importate dei ticker indicati, nell'ordine di
+# riesecuzione (data, poi transazioni già registrate, poi righe del file)
+OVERSOLD_QUERY = """
+    SELECT NULL::integer AS row_number, UPPER(ticker) AS ticker, transaction_type,
+           shares, transaction_date, 0 AS imported, id
+    FROM transactions
+    WHERE portfolio_id = %(portfolio_id)s
+        AND UPPER(ticker) = ANY(%(tickers)s)
+        AND transaction_type = ANY(%(types)s)
+    UNION ALL
+    SELECT row_number, ticker, transaction_type, shares,
+           COALESCE(transaction_date, CURRENT_DATE), 1, NULL
+    FROM import_lots
+    WHERE ticker = ANY(%(tickers)s)
+    ORDER BY ticker, transaction_date, imported, id, row_number
+"""
+
+POSITIONS_QUERY = """
+    SELECT ticker, shares, avg_price
+    FROM positions
+    WHERE portfolio_id = %s AND ticker = ANY(%s)
+"""
+
+
+# ========================================
+# LETTURA A BLOCCHI
+# ========================================
+
+def _normalize_header(name):
+    return re.sub(r'[\s_\-./()]+', '', str(name).strip().lower())
+
+
+def map_columns(columns):
+    """
+    Rinomina delle intestazioni del file nei nomi canonici.
+
+    Raises:
+        ValueError: Se manca una colonna obbligatoria
+    """
+    lookup = {alias: canonical for canonical, aliases in COLUMN_ALIASES.items() for alias in aliases}
+    mapping = {}
+    for column in columns:
+        canonical = lookup.get(_normalize_header(column))
+        if canonical and canonical not in mapping.values():
+            mapping[column] = canonical
+
+    missing = [c for c in REQUIRED_COLUMNS if c not in mapping.values()]
+    if missing:
+        raise ValueError(f"Colonne obbligatorie mancanti: {', '.join(missing)} "
+                         f"(trovate: {', '.join(map(str, columns))})")
+    return mapping
+
+
+def _detect_separator(source):
+    """Separatore dal primo blocco del file (',' ';' tab '|'), default ','."""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            sample = f.read(4096)
+    else:
+        position = source.tell()
+        sample = source.read(4096)
+        source.seek(position)
+
+    if isinstance(sample, bytes):
+        sample = sample.decode('utf-8', errors='ignore')
+
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=',;\t|').delimiter
+    except csv.Error:
+        return ','
+
+
+def read_import_chunks(source, chunk_size=IMPORT_CHUNK_SIZE, sep=None, encoding='utf-8-sig'):
+    """
+    Legge un CSV (percorso o file caricato) a blocchi, tutto come testo.
+
+    Yields:
+        pd.DataFrame: Blocco con colonne canoniche (indice = riga del file - 2)
+    """
+    sep = sep or _detect_separator(source)
+    reader = pd.read_csv(
+        source, sep=sep, chunksize=chunk_size, dtype=str,
+        skipinitialspace=True, encoding=encoding, keep_default_na=False
+    )
+
+    mapping = None
+    for chunk in reader:
+        if mapping is None:
+            mapping = map_columns(chunk.columns)
+        yield chunk[list(mapping)].rename(columns=mapping)
+
+
+# ========================================
+# VALIDAZIONE E NORMALIZZAZIONE
+# ========================================
+
+# Numeri con un solo separatore seguito da esattamente tre cifre ('1,234',
+# '12.500'): migliaia o decimali a seconda della convenzione del file
+AMBIGUOUS_NUMBER_PATTERN = r'-?[1-9]\d{0,2}[.,]\d{3}'
+
+NUMERIC_COLUMNS = ('shares', 'price', 'fees')
+
+
+def _number_text(values):
+    return values.fillna('').astype(str).str.replace(r'[^\d,.\-]', '', regex=True)
+
+
+def _comma_decimal(text):
+    """True dove la virgola è il separatore decimale ('1.234,56', '12,5', '1.234.567')."""
+    commas = text.str.count(',')
+    dots = text.str.count(r'\.')
+    return (((text.str.rfind(',') > text.str.rfind('.')) & (commas == 1))
+            | ((dots > 1) & (commas == 0)))
+
+
+def ambiguous_numbers(values):
+    """Maschera dei valori leggibili sia come migliaia sia come decimali (vedi AMBIGUOUS_NUMBER_PATTERN)."""
+    return _number_text(values).str.fullmatch(AMBIGUOUS_NUMBER_PATTERN).fillna(False)
+
+
+def infer_decimal(values):
+    """
+    Voti per separatore decimale dai valori non ambigui di una colonna.
+
+    Returns:
+        tuple: (valori con decimale ',', valori con decimale '.')
+    """
+    text = _number_text(values)
+    decisive = text.str.contains(r'[,.]') & ~text.str.fullmatch(AMBIGUOUS_NUMBER_PATTERN).fillna(False)
+    comma = _comma_decimal(text)
+    return int((decisive & comma).sum()), int((decisive & ~comma).sum())
+
+
+def detect_decimal(source, sep, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Separatore decimale del file dalle colonne numeriche, una volta per file.
+
+    I blocchi vengono letti finché uno contiene valori non ambigui
+    ('1.234,56', '12,5', '1,234.56'); vince la convenzione più frequente.
+    Il file caricato viene riportato alla posizione iniziale.
+
+    Returns:
+        str: ',' o '.', None se tutti i valori sono interi o ambigui
+    """
+    position = None if isinstance(source, (str, os.PathLike)) else source.tell()
+    decimal = None
+
+    try:
+        for chunk in read_import_chunks(source, chunk_size=chunk_size, sep=sep):
+            comma = dot = 0
+            for name in NUMERIC_COLUMNS:
+                if name in chunk:
+                    votes = infer_decimal(chunk[name])
+                    comma += votes[0]
+                    dot += votes[1]
+            if comma or dot:
+                decimal = ',' if comma > dot else '.'
+                break
+    finally:
+        if position is not None:
+            source.seek(position)
+
+    return decimal
+
+
+def parse_numbers(values, decimal=None):
+    """
+    Numeri da testo in formato italiano o anglosassone ('1.234,56', '1,234.56',
+    '€ 12,5'), vettoriale. Testo non numerico -> NaN.
+
+    Args:
+        decimal: ',' o '.' se noto (vedi detect_decimal); None = dedotto per
+                 valore, con i valori ambigui ('1,234') -> NaN
+    """
+    text = _number_text(values)
+    italian = text.str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
+    english = text.str.replace(',', '', regex=False)
+
+    if decimal == ',':
+        text = italian
+    elif decimal == '.':
+        text = english
+    else:
+        ambiguous = text.str.fullmatch(AMBIGUOUS_NUMBER_PATTERN).fillna(False)
+        text = italian.where(_comma_decimal(text), english).where(~ambiguous, '')
+
+    return pd.to_numeric(text, errors='coerce')
+
+
+def parse_dates(values):
+    """
+    Date ISO (AAAA-MM-GG, anche con orario) o giorno/mese/anno, vettoriale.
+    Testo vuoto o non valido -> NaT.
+    """
+    text = values.fillna('').astype(str).str.strip()
+    iso = text.str.match(r'\d{4}-\d{2}-\d{2}')
+
+    dates = pd.to_datetime(text.where(iso).str[:10], format='%Y-%m-%d', errors='coerce')
+    other = (text != '') & ~iso
+    if other.any():
+        dates = dates.where(iso, pd.to_datetime(text.where(other), errors='coerce', dayfirst=True))
+    return dates
+
+
+def normalize_chunk(chunk, default_currency='USD', decimal=None):
+    """
+    Valida e normalizza un blocco del file.
+
+    - Ticker maiuscoli senza prefisso di borsa ('NASDAQ:AAPL' -> 'AAPL')
+    - Quantità negative senza tipo -> vendite
+    - Prezzi e quantità in formato italiano o anglosassone (vedi parse_numbers);
+      senza separatore decimale noto i valori ambigui ('1,234') sono errori
+    - Date in formato giorno/mese/anno o ISO
+
+    Returns:
+        tuple: (DataFrame lotti validi con LOT_COLUMNS, DataFrame errori ERROR_COLUMNS)
+    """
+    rows = chunk.index.to_numpy() + 2  # riga 1 = intestazione
+    errors = []
+
+    def flag(mask, field, message):
+        mask = np.array(mask, dtype=bool)
+        if mask.any():
+            source = chunk[field] if field in chunk else pd.Series('', index=chunk.index)
+            errors.append(pd.DataFrame({
+                'riga': rows[mask],
+                'campo': field,
+                'valore': source.to_numpy()[mask],
+                'errore': message,
+            }))
+        return mask
+
+    def column(name):
+        return chunk[name].str.strip() if name in chunk else pd.Series('', index=chunk.index)
+
+    ticker = column('ticker').str.upper().str.split(':').str[-1].str.strip()
+    bad = flag(~ticker.str.fullmatch(TICKER_PATTERN).fillna(False), 'ticker', 'Ticker non valido')
+
+    def ambiguous(name):
+        if decimal is not None:
+            return pd.Series(False, index=chunk.index)
+        mask = ambiguous_numbers(column(name))
+        flag(mask, name, "Separatore decimale ambiguo (indica ',' o '.' come decimale)")
+        return mask
+
+    shares = parse_numbers(column('shares'), decimal)
+    shares_ambiguous = ambiguous('shares')
+    bad |= shares_ambiguous | flag((shares.isna() | (shares == 0)) & ~shares_ambiguous,
+                                   'shares', 'Quantità non valida')
+
+    price = parse_numbers(column('price'), decimal)
+    price_ambiguous = ambiguous('price')
+    bad |= price_ambiguous | flag((price.isna() | (price < 0)) & ~price_ambiguous,
+                                  'price', 'Prezzo non valido')
+
+    raw_type = column('transaction_type').str.upper()
+    tx_type = raw_type.map(TYPE_ALIASES)
+    tx_type = tx_type.where(raw_type != '', np.where(shares < 0, 'SELL', 'BUY'))
+    bad |= flag(tx_type.isna(), 'transaction_type', 'Tipo operazione non riconosciuto (BUY/SELL)')
+
+    raw_date = column('transaction_date')
+    tx_date = parse_dates(raw_date)
+    bad |= flag((raw_date != '') & tx_date.isna(), 'transaction_date', 'Data non valida')
+
+    fees = parse_numbers(column('fees'), decimal)
+    bad |= ambiguous('fees')
+    fees = fees.fillna(0.0)
+
+    currency = column('currency').replace('', default_currency).map(normalize_currency)
+
+    valid = ~bad
+    lots = pd.DataFrame({
+        'row_number': rows[valid],
+        'ticker': ticker[valid],
+        'transaction_type': tx_type[valid],
+        'shares': shares[valid].abs(),
+        'price': price[valid],
+        'currency': currency[valid],
+        'transaction_date': tx_date[valid].dt.strftime('%Y-%m-%d'),
+        'fees': fees[valid].abs(),
+        'notes': column('notes').where(column('notes') != '')[valid],
+    }, columns=LOT_COLUMNS)
+
+    errors = pd.concat(errors, ignore_index=True) if errors else pd.DataFrame(columns=ERROR_COLUMNS)
+    return lots, errors
+
+
+def aggregate_lots(lots):
+    """
+    Aggregato per ticker (group-by vettoriale): quantità acquistate e
+    vendute e numero di lotti. Combinabile tra blocchi.
+    """
+    if lots.empty:
+        return pd.DataFrame(columns=AGGREGATE_COLUMNS)
+
+    buy = lots['transaction_type'].to_numpy() == 'BUY'
+    frame = pd.DataFrame({
+        'ticker': lots['ticker'].to_numpy(),
+        'bought': np.where(buy, lots['shares'], 0.0),
+        'sold': np.where(buy, 0.0, lots['shares']),
+        'lots': 1,
+    })
+    return combine_aggregates([frame])
+
+
+def combine_aggregates(frames):
+    """Somma degli aggregati parziali dei blocchi."""
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame(columns=AGGREGATE_COLUMNS)
+
+    return (pd.concat(frames, ignore_index=True)
+            .groupby('ticker', sort=True)[AGGREGATE_COLUMNS[1:]].sum()
+            .reset_index()[AGGREGATE_COLUMNS])
+
+
+def positions_diff(aggregates, before, after):
+    """
+    Confronto per ticker tra le posizioni prima e dopo l'import.
+
+    Returns:
+        pd.DataFrame: ticker, bought, sold, lots, shares_before, avg_price_before,
+                      shares_after, avg_price_after, action
+    """
+    diff = (aggregates
+            .merge(before, on='ticker', how='left')
+            .merge(after, on='ticker', how='left', suffixes=('_before', '_after')))
+
+    for column in ('shares_before', 'avg_price_before', 'shares_after', 'avg_price_after'):
+        diff[column] = pd.to_numeric(diff[column], errors='coerce').astype(np.float64)
+    diff[['shares_before', 'shares_after']] = diff[['shares_before', 'shares_after']].fillna(0.0)
+
+    opened = diff['shares_after'] > 0
+    held = diff['shares_before'] > 0
+    diff['action'] = np.select(
+        [opened & ~held, opened, held],
+        ['nuova', 'aggiornata', 'chiusa'],
+        default='vendita senza posizione'
+    )
+    return diff
+
+
+# ========================================
+# IMPORT (STAGING + REGISTRO)
+# ========================================
+
+def _fetch_positions(cursor, portfolio_id, tickers):
+    cursor.execute(POSITIONS_QUERY, (portfolio_id, tickers))
+    return pd.DataFrame(cursor.fetchall(), columns=['ticker', 'shares', 'avg_price'])
+
+
+def find_oversold_rows(cursor, portfolio_id, tickers):
+    """
+    Righe SELL del file che venderebbero più della quantità detenuta a
+    quella data (registro esistente più righe precedenti del file).
+
+    Un passaggio lineare per ticker: le righe scartate non muovono la
+    quantità, quindi le vendite successive vengono valutate senza di esse.
+
+    Returns:
+        pd.DataFrame: row_number, ticker, shares, held
+    """
+    rejected = []
+    if not tickers:
+        return pd.DataFrame(rejected, columns=['row_number', 'ticker', 'shares', 'held'])
+
+    cursor.execute(OVERSOLD_QUERY, {'portfolio_id': portfolio_id, 'tickers': list(tickers),
+                                    'types': list(POSITION_TYPES)})
+    held = 0.0
+    current = None
+    for row_number, ticker, tx_type, shares, _, imported, _ in cursor.fetchall():
+        if ticker != current:
+            held = 0.0
+            current = ticker
+
+        shares = float(shares)
+        if tx_type == 'BUY':
+            held += shares
+        elif tx_type == 'SELL':
+            if imported and shares - held > LEDGER_EPSILON:
+                rejected.append((int(row_number), ticker, shares, held))
+                continue
+            held = max(held - shares, 0.0)
+            if held <= LEDGER_EPSILON:
+                held = 0.0
+
+    return pd.DataFrame(rejected, columns=['row_number', 'ticker', 'shares', 'held'])
+
+
+def import_positions_csv(portfolio_id, source, dry_run=False, default_currency='USD',
+                         decimal=None, chunk_size=IMPORT_CHUNK_SIZE, verbose=False):
+    """
+    Importa transazioni da un CSV o da un export del broker.
+
+    - Lettura a blocchi di chunk_size righe, validazione vettoriale
+    - Lotti validi in COPY su una tabella temporanea di staging, blocco per blocco
+    - Aggregato per ticker (group-by) per il riepilogo
+    - Vendite oltre la quantità detenuta scartate come errori di riga
+      (come record_transaction, che le rifiuta)
+    - Transazioni inserite dallo staging in un solo statement, poi posizioni
+      e lotti dei ticker coinvolti ricostruiti dal registro (rebuild_positions)
+
+    Tutto avviene in una transazione: le tabelle di staging spariscono al
+    commit. Con dry_run la stessa procedura viene annullata (rollback) dopo
+    aver calcolato il diff, che coincide quindi con l'import reale.
+
+    Args:
+        portfolio_id: ID portafoglio di destinazione
+        source: Percorso o file-like (es. st.file_uploader)
+        dry_run: Se True restituisce solo il diff
+        default_currency: Valuta per le righe senza colonna valuta
+        decimal: Separatore decimale (default: dedotto dal file con
+                 detect_decimal, ',' per i file separati da ';' senza
+                 valori decisivi; altrimenti i valori ambigui sono errori)
+
+    Returns:
+        dict: rows, valid, error_count, errors (DataFrame), diff (DataFrame),
+              decimal (separatore decimale usato, None se non determinato),
+              positions_updated, positions_closed, transactions, rejected
+              (vendite scartate perché oltre la quantità detenuta), oversold
+              (ticker già venduti oltre la quantità nel registro), dry_run, timings
+
+    Raises:
+        ValueError: Se il file non ha le colonne obbligatorie
+    """
+    timings = {}
+    t0 = time.perf_counter()
+
+    def log(msg):
+        if verbose:
+            print(f"[{datetime.now()}] {msg}")
+
+    report = {'rows': 0, 'valid': 0, 'error_count': 0, 'errors': pd.DataFrame(columns=ERROR_COLUMNS),
+              'diff': pd.DataFrame(), 'positions_updated': 0, 'positions_closed': 0,
+              'transactions': 0, 'rejected': 0, 'oversold': [], 'dry_run': dry_run, 'timings': timings}
+
+    ensure_ledger_tables()
+
+    sep = _detect_separator(source)
+    if decimal is None:
+        decimal = detect_decimal(source, sep, chunk_size)
+    if decimal is None and sep == ';':
+        decimal = ','
+    report['decimal'] = decimal
+
+    errors = []
+    aggregates = []
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(STAGING_DDL)
+
+        # 1. Lettura, validazione e COPY dei lotti blocco per blocco
+        for chunk in read_import_chunks(source, chunk_size=chunk_size, sep=sep):
+            lots, chunk_errors = normalize_chunk(chunk, default_currency, decimal)
+            report['rows'] += len(chunk)
+            report['valid'] += len(lots)
+            report['error_count'] += len(chunk_errors)
+
+            if not chunk_errors.empty and sum(map(len, errors)) < IMPORT_MAX_ERRORS:
+                errors.append(chunk_errors)
+
+            if not lots.empty:
+                copy_rows('import_lots', LOT_COLUMNS, lots, conn=conn)
+                aggregates.append(aggregate_lots(lots))
+
+            log(f"Righe lette: {report['rows']} (valide {report['valid']}, errori {report['error_count']})")
+
+        timings['parse_copy'] = time.perf_counter() - t0
+
+        # 2. Aggregato per ticker
+        summary = combine_aggregates(aggregates)
+
+        # 3. Vendite oltre la quantità detenuta: righe scartate, nulla viene scritto
+        rejected = find_oversold_rows(cursor, portfolio_id,
+                                      summary.loc[summary['sold'] > 0, 'ticker'].tolist())
+        if not rejected.empty:
+            cursor.execute("DELETE FROM import_lots WHERE row_number = ANY(%s)",
+                           (rejected['row_number'].tolist(),))
+            report['rejected'] = len(rejected)
+            report['valid'] -= len(rejected)
+            report['error_count'] += len(rejected)
+            errors.append(pd.DataFrame({
+                'riga': rejected['row_number'],
+                'campo': 'shares',
+                'valore': [f"{shares:g}" for shares in rejected['shares']],
+                'errore': [f"Vendita oltre la quantità detenuta ({held:g} disponibili)"
+                           for held in rejected['held']],
+            }))
+
+            removed = aggregate_lots(rejected.assign(transaction_type='SELL'))
+            removed[AGGREGATE_COLUMNS[1:]] *= -1
+            summary = combine_aggregates([summary, removed])
+            summary = summary[summary['lots'] > 0].reset_index(drop=True)
+            log(f"Vendite oltre la quantità detenuta scartate: {len(rejected)}")
+
+        if errors:
+            report['errors'] = (pd.concat(errors, ignore_index=True)
+                                .sort_values('riga', kind='stable')
+                                .head(IMPORT_MAX_ERRORS).reset_index(drop=True))
+
+        if summary.empty:
+            timings['total'] = time.perf_counter() - t0
+            return report
+
+        tickers = summary['ticker'].tolist()
+        before = _fetch_positions(cursor, portfolio_id, tickers)
+
+        # 4. Transazioni nel registro e posizioni ricostruite per i ticker coinvolti
+        t1 = time.perf_counter()
+        cursor.execute(INSERT_QUERY, {'portfolio_id': portfolio_id})
+        report['transactions'] = int(cursor.fetchone()[0])
+
+        rebuild = rebuild_positions(portfolio_ids=[portfolio_id], tickers=tickers, conn=conn)
+        report['positions_updated'] = rebuild['positions_updated']
+        report['positions_closed'] = rebuild['positions_closed']
+        report['oversold'] = [ticker for _, ticker in rebuild['oversold']]
+        timings['merge'] = time.perf_counter() - t1
+
+        report['diff'] = positions_diff(summary, before, _fetch_positions(cursor, portfolio_id, tickers))
+
+        # 5. Anteprima: nessuna modifica resta salvata
+        if dry_run:
+            conn.rollback()
+
+    timings['total'] = time.perf_counter() - t0
+    log(f"Import {'simulato' if dry_run else 'completato'}: {report['valid']} lotti, "
+        f"{len(report['diff'])} titoli, {report['error_count']} errori in {timings['total']:.2f}s")
+
+    return report
@@ -0,0 +1,242 @@
+from database.db_connection import execute_query
+import socket
+import os
+
+# Coda job per le analisi AI: la UI accoda, scripts/analysis_worker.py esegue
+ANALYSIS_JOBS_DDL = """
+    CREATE TABLE IF NOT EXISTS analysis_jobs (
+        id SERIAL PRIMARY KEY,
+        portfolio_id INTEGER NOT NULL REFERENCES portfolios(id) ON DELETE CASCADE,
+        user_id INTEGER NOT NULL,
+        analysis_type VARCHAR(100) NOT NULL,
+        include_macro BOOLEAN NOT NULL DEFAULT TRUE,
+        force_refresh BOOLEAN NOT NULL DEFAULT FALSE,
+        status VARCHAR(20) NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        worker VARCHAR(100),
+        analysis_id INTEGER REFERENCES portfolio_analyses(id) ON DELETE SET NULL,
+        error TEXT,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_analysis_jobs_queued
+        ON analysis_jobs (created_at) WHERE status = 'queued';
+    CREATE INDEX IF NOT EXISTS idx_analysis_jobs_portfolio
+        ON analysis_jobs (portfolio_id, created_at DESC);
+
+    -- Un solo job attivo per portafoglio e tipo: i duplicati già presenti
+    -- (accodati prima dell'indice) vengono chiusi tenendo il più recente
+    UPDATE analysis_jobs j SET
+        status = 'failed', error = 'Job duplicato', finished_at = CURRENT_TIMESTAMP
+    WHERE j.status IN ('queued', 'running')
+        AND EXISTS (
+            SELECT 1 FROM analysis_jobs k
+            WHERE k.portfolio_id = j.portfolio_id AND k.analysis_type = j.analysis_type
+                AND k.status IN ('queued', 'running') AND k.id > j.id
+        );
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_analysis_jobs_active
+        ON analysis_jobs (portfolio_id, analysis_type) WHERE status IN ('queued', 'running');
+
+    -- Heartbeat dei worker: la UI smette di attendere se nessun worker è vivo
+    CREATE TABLE IF NOT EXISTS analysis_workers (
+        worker VARCHAR(100) PRIMARY KEY,
+        heartbeat_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+JOB_STATUSES = ('queued', 'running', 'done', 'failed')
+ACTIVE_STATUSES = ('queued', 'running')
+
+# Tentativi massimi prima di marcare un job come fallito
+ANALYSIS_JOB_MAX_ATTEMPTS = int(os.getenv("ANALYSIS_JOB_MAX_ATTEMPTS", "3"))
+
+# Secondi senza heartbeat dopo i quali un worker è considerato terminato
+ANALYSIS_WORKER_TIMEOUT = int(os.getenv("ANALYSIS_WORKER_TIMEOUT", "60"))
+
+_jobs_table_ready = False
+
+
+def ensure_analysis_jobs_table():
+    """Crea le tabelle analysis_jobs/analysis_workers se non esistono (una volta per processo)."""
+    global _jobs_table_ready
+    if _jobs_table_ready:
+        return
+
+    execute_query(ANALYSIS_JOBS_DDL, fetch=False)
+    _jobs_table_ready = True
+
+
+def worker_name():
+    """Identificativo del worker (host:pid) registrato sui job presi in carico."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue_analysis_job(portfolio_id, user_id, analysis_type, include_macro=True, force_refresh=False):
+    """
+    Accoda un'analisi. Se per lo stesso portafoglio e tipo esiste già un job
+    in coda o in esecuzione, ritorna quello invece di crearne un altro
+    (indice univoco parziale: sicuro anche tra sessioni concorrenti).
+    
+    Returns:
+        int: ID del job o None se errore
+    """
+    try:
+        ensure_analysis_jobs_table()
+        
+        inserted = execute_query("""
+            INSERT INTO analysis_jobs (portfolio_id, user_id, analysis_type, include_macro, force_refresh)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (portfolio_id, analysis_type) WHERE status IN ('queued', 'running')
+            DO NOTHING
+            RETURNING id
+        """, (portfolio_id, user_id, analysis_type, include_macro, force_refresh))
+        
+        if inserted:
+            return inserted[0]['id']
+        
+        # Conflitto: il job attivo esiste (anche se confermato da un'altra sessione
+        # dopo l'inizio dell'INSERT), lo legge una nuova query
+        existing = execute_query("""
+            SELECT id FROM analysis_jobs
+            WHERE portfolio_id = %s AND analysis_type = %s AND status IN ('queued', 'running')
+        """, (portfolio_id, analysis_type))
+        return existing[0]['id'] if existing else None
+        
+    except Exception as e:
+        print(f"Errore accodamento analisi: {e}")
+        return None
+
+
+def claim_analysis_jobs(limit=1, worker=None):
+    """
+    Prende in carico fino a `limit` job in coda (i più vecchi).
+    FOR UPDATE SKIP LOCKED permette più worker in parallelo senza
+    che due worker prendano lo stesso job.
+    
+    Returns:
+        list: Job presi in carico (status 'running')
+    """
+    query = """
+        UPDATE analysis_jobs j SET
+            status = 'running',
+            attempts = j.attempts + 1,
+            worker = %s,
+            started_at = CURRENT_TIMESTAMP
+        FROM (
+            SELECT id FROM analysis_jobs
+            WHERE status = 'queued'
+            ORDER BY created_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ) next_jobs
+        WHERE j.id = next_jobs.id
+        RETURNING j.id, j.portfolio_id, j.user_id, j.analysis_type,
+                  j.include_macro, j.force_refresh, j.attempts
+    """
+    return execute_query(query, (worker or worker_name(), limit)) or []
+
+
+def complete_analysis_job(job_id, analysis_id):
+    """Segna il job come completato con l'analisi prodotta."""
+    query = """
+        UPDATE analysis_jobs SET
+            status = 'done', analysis_id = %s, error = NULL, finished_at = CURRENT_TIMESTAMP
+        WHERE id = %s
+    """
+    execute_query(query, (analysis_id, job_id), fetch=False)
+
+
+def fail_analysis_job(job_id, error, retry=True):
+    """
+    Registra un errore. Il job torna in coda finché non esaurisce
+    ANALYSIS_JOB_MAX_ATTEMPTS tentativi, poi resta 'failed'.
+    """
+    query = """
+        UPDATE analysis_jobs SET
+            status = CASE WHEN %s AND attempts < %s THEN 'queued' ELSE 'failed' END,
+            error = %s,
+            finished_at = CASE WHEN %s AND attempts < %s THEN NULL ELSE CURRENT_TIMESTAMP END
+        WHERE id = %s
+    """
+    execute_query(query, (
+        retry, ANALYSIS_JOB_MAX_ATTEMPTS, str(error)[:2000],
+        retry, ANALYSIS_JOB_MAX_ATTEMPTS, job_id
+    ), fetch=False)
+
+
+def requeue_stale_jobs(timeout_minutes=15):
+    """
+    Rimette in coda i job 'running' da troppo tempo il cui worker non dà
+    più segni di vita (terminato durante l'esecuzione). Chiamata
+    periodicamente dai worker: un job lungo di un worker vivo non viene
+    ripreso da un altro.
+    
+    Returns:
+        int: Numero di job rimessi in coda
+    """
+    query = """
+        UPDATE analysis_jobs j SET
+            status = CASE WHEN attempts < %s THEN 'queued' ELSE 'failed' END,
+            error = 'Timeout worker',
+            finished_at = CASE WHEN attempts < %s THEN NULL ELSE CURRENT_TIMESTAMP END
+        WHERE j.status = 'running'
+            AND j.started_at < CURRENT_TIMESTAMP - make_interval(mins => %s)
+            AND NOT EXISTS (
+                SELECT 1 FROM analysis_workers w
+                WHERE w.worker = j.worker
+                    AND w.heartbeat_at > CURRENT_TIMESTAMP - make_interval(secs => %s)
+            )
+        RETURNING j.id
+    """
+    result = execute_query(query, (ANALYSIS_JOB_MAX_ATTEMPTS, ANALYSIS_JOB_MAX_ATTEMPTS,
+                                   timeout_minutes, ANALYSIS_WORKER_TIMEOUT))
+    return len(result or [])
+
+
+def record_worker_heartbeat(worker=None):
+    """Registra che il worker è vivo (upsert su analysis_workers)."""
+    execute_query("""
+        INSERT INTO analysis_workers (worker, heartbeat_at)
+        VALUES (%s, CURRENT_TIMESTAMP)
+        ON CONFLICT (worker) DO UPDATE SET heartbeat_at = EXCLUDED.heartbeat_at
+    """, (worker or worker_name(),), fetch=False)
+
+
+def get_worker_heartbeat_age():
+    """
+    Secondi dall'ultimo heartbeat di un qualunque worker.
+    
+    Returns:
+        float: Età in secondi, None se nessun worker si è mai registrato
+    """
+    try:
+        result = execute_query("""
+            SELECT EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - MAX(heartbeat_at)) AS age
+            FROM analysis_workers
+        """)
+        age = result[0]['age'] if result else None
+        return float(age) if age is not None else None
+        
+    except Exception as e:
+        print(f"Errore lettura heartbeat worker: {e}")
+        return None
+
+
+def get_analysis_jobs(portfolio_id, limit=5):
+    """Job più recenti di un portafoglio (per il polling dalla UI)."""
+    try:
+        query = """
+            SELECT id, analysis_type, status, attempts, analysis_id, error,
+                   created_at, started_at, finished_at,
+                   EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - created_at) AS age_seconds
+            FROM analysis_jobs
+            WHERE portfolio_id = %s
+            ORDER BY created_at DESC
+            LIMIT %s
+        """
+        return execute_query(query, (portfolio_id, limit)) or []
+        
+    except Exception as e:
+        print(f"Errore recupero job analisi: {e}")
+        return []
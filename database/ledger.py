@@ -0,0 +1,773 @@
+from database.db_connection import execute_query, execute_values_query, get_db_connection, copy_rows
+from database.lots import LotBook, LOT_METHOD, LOT_METHODS, LOT_EPSILON
+from database.fx import get_fx_history, lookup_fx
+from datetime import date, datetime
+import time
+import numpy as np
+import pandas as pd
+
+# Le posizioni sono una vista materializzata del registro transazioni:
+# ogni scrittura passa da qui e aggiorna insieme transazioni, lotti aperti
+# e posizione. Metodo di carico: 'average' (costo medio), 'fifo' o 'lifo'.
+LEDGER_METHOD = LOT_METHOD
+LEDGER_METHODS = LOT_METHODS
+
+TRANSACTION_TYPES = ('BUY', 'SELL', 'FEE', 'DIVIDEND')
+
+# Tipi che muovono quantità o costo delle posizioni (i dividendi no)
+POSITION_TYPES = ('BUY', 'SELL', 'FEE')
+
+# Quantità sotto questa soglia valgono zero (residui floating point)
+LEDGER_EPSILON = LOT_EPSILON
+
+LEDGER_DDL = """
+    CREATE TABLE IF NOT EXISTS position_lots (
+        id SERIAL PRIMARY KEY,
+        portfolio_id INTEGER NOT NULL REFERENCES portfolios(id) ON DELETE CASCADE,
+        ticker VARCHAR(20) NOT NULL,
+        transaction_id INTEGER REFERENCES transactions(id) ON DELETE CASCADE,
+        acquired_date DATE,
+        shares NUMERIC NOT NULL,
+        price NUMERIC NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_position_lots_position
+        ON position_lots (portfolio_id, ticker, acquired_date, transaction_id);
+    CREATE INDEX IF NOT EXISTS idx_transactions_ledger
+        ON transactions (portfolio_id, ticker, transaction_date, id);
+"""
+
+# ON CONFLICT (portfolio_id, ticker) richiede un vincolo univoco sulla coppia
+POSITIONS_UNIQUE_DDL = """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_positions_portfolio_ticker
+        ON positions (portfolio_id, ticker);
+"""
+
+# Un acquisto per riga VALUES (tipi espliciti: i NULL non hanno tipo)
+BUY_TEMPLATE = (
+    "(%s::integer, %s::varchar, %s::numeric, %s::numeric, %s::numeric, %s::varchar, "
+    "%s::varchar, %s::varchar, %s::varchar, %s::date, %s::text)"
+)
+
+# Acquisti: upsert posizioni + transazioni BUY + lotti + timestamp portafoglio
+# in un solo statement (additivo, quindi sicuro anche con scritture concorrenti)
+BUY_QUERY = """
+    WITH lots (portfolio_id, ticker, shares, price, fees, currency,
+               company_name, sector, industry, purchase_date, notes) AS (
+        VALUES %s
+    ),
+    aggregated AS (
+        SELECT
+            portfolio_id,
+            ticker,
+            SUM(shares) AS shares,
+            SUM(shares * price + fees) / NULLIF(SUM(shares), 0) AS avg_price,
+            MIN(currency) AS currency,
+            MAX(company_name) AS company_name,
+            MAX(sector) AS sector,
+            MAX(industry) AS industry,
+            MIN(purchase_date) AS purchase_date,
+            STRING_AGG(notes, '; ') AS notes
+        FROM lots
+        GROUP BY portfolio_id, ticker
+    ),
+    upserted AS (
+        INSERT INTO positions (
+            portfolio_id, ticker, shares, avg_price, currency,
+            company_name, sector, industry, purchase_date, notes
+        )
+        SELECT portfolio_id, ticker, shares, COALESCE(avg_price, 0), currency,
+               company_name, sector, industry, purchase_date, notes
+        FROM aggregated
+        ON CONFLICT (portfolio_id, ticker) DO UPDATE SET
+            shares = positions.shares + EXCLUDED.shares,
+            avg_price = COALESCE(
+                (positions.shares * positions.avg_price + EXCLUDED.shares * EXCLUDED.avg_price)
+                    / NULLIF(positions.shares + EXCLUDED.shares, 0),
+                EXCLUDED.avg_price
+            ),
+            company_name = COALESCE(positions.company_name, EXCLUDED.company_name),
+            sector = COALESCE(positions.sector, EXCLUDED.sector),
+            industry = COALESCE(positions.industry, EXCLUDED.industry),
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING id, ticker, shares, avg_price
+    ),
+    recorded AS (
+        INSERT INTO transactions (
+            portfolio_id, ticker, transaction_type, shares, price,
+            currency, transaction_date, fees, notes
+        )
+        SELECT portfolio_id, ticker, 'BUY', shares, price,
+               currency, COALESCE(purchase_date, CURRENT_DATE), fees, notes
+        FROM lots
+        RETURNING id, portfolio_id, ticker, shares, price, fees, transaction_date
+    ),
+    lotted AS (
+        INSERT INTO position_lots (portfolio_id, ticker, transaction_id, acquired_date, shares, price)
+        SELECT portfolio_id, ticker, id, transaction_date, shares, price + fees / shares
+        FROM recorded
+    ),
+    touched AS (
+        UPDATE portfolios SET updated_at = CURRENT_TIMESTAMP
+        WHERE id IN (SELECT DISTINCT portfolio_id FROM lots)
+    )
+    SELECT id, ticker, shares, avg_price FROM upserted ORDER BY ticker
+"""
+
+LEDGER_COLUMNS = ['id', 'portfolio_id', 'ticker', 'transaction_type', 'shares', 'price',
+                  'fees', 'currency', 'transaction_date']
+POSITION_COLUMNS = ['portfolio_id', 'ticker', 'shares', 'avg_price', 'currency', 'purchase_date']
+LOT_COLUMNS = ['portfolio_id', 'ticker', 'transaction_id', 'acquired_date', 'shares', 'price']
+
+REBUILD_STAGING_DDL = """
+    DROP TABLE IF EXISTS pg_temp.ledger_positions, pg_temp.ledger_lots;
+    CREATE TEMP TABLE ledger_positions (
+        portfolio_id INTEGER,
+        ticker VARCHAR(20),
+        shares NUMERIC,
+        avg_price NUMERIC,
+        currency VARCHAR(10),
+        purchase_date DATE
+    ) ON COMMIT DROP;
+    CREATE TEMP TABLE ledger_lots (
+        portfolio_id INTEGER,
+        ticker VARCHAR(20),
+        transaction_id INTEGER,
+        acquired_date DATE,
+        shares NUMERIC,
+        price NUMERIC
+    ) ON COMMIT DROP;
+"""
+
+# Sostituisce lotti e posizioni delle coppie ricostruite in un solo statement
+REBUILD_QUERY = """
+    WITH cleared AS (
+        DELETE FROM position_lots l
+        USING ledger_positions s
+        WHERE l.portfolio_id = s.portfolio_id AND l.ticker = s.ticker
+    ),
+    lotted AS (
+        INSERT INTO position_lots (portfolio_id, ticker, transaction_id, acquired_date, shares, price)
+        SELECT portfolio_id, ticker, transaction_id, acquired_date, shares, price
+        FROM ledger_lots
+        RETURNING id
+    ),
+    upserted AS (
+        INSERT INTO positions (portfolio_id, ticker, shares, avg_price, currency, purchase_date)
+        SELECT portfolio_id, ticker, shares, avg_price, currency, purchase_date
+        FROM ledger_positions
+        WHERE shares > 0
+        ON CONFLICT (portfolio_id, ticker) DO UPDATE SET
+            shares = EXCLUDED.shares,
+            avg_price = EXCLUDED.avg_price,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE positions.shares IS DISTINCT FROM EXCLUDED.shares
+            OR positions.avg_price IS DISTINCT FROM EXCLUDED.avg_price
+        RETURNING id
+    ),
+    closed AS (
+        DELETE FROM positions p
+        USING ledger_positions s
+        WHERE p.portfolio_id = s.portfolio_id AND p.ticker = s.ticker AND s.shares <= 0
+        RETURNING p.id
+    )
+    SELECT
+        (SELECT COUNT(*) FROM upserted) AS positions_updated,
+        (SELECT COUNT(*) FROM closed) AS positions_closed,
+        (SELECT COUNT(*) FROM lotted) AS lots
+"""
+
+ORPHANED_DDL = """
+    CREATE TABLE IF NOT EXISTS transactions_orphaned (LIKE transactions);
+"""
+
+# Allineamento del registro alle posizioni esistenti (passo esplicito:
+# scripts/rebuild_positions.py --align). Prima del registro delete_position
+# cancellava solo la posizione e lasciava i BUY: una ricostruzione (o un
+# import/SELL retrodatato sullo stesso ticker) riporterebbe in vita le
+# posizioni cancellate. Per le coppie il cui saldo non corrisponde alla
+# posizione (o senza posizione) i BUY/SELL vengono archiviati in
+# transactions_orphaned e, se la posizione esiste, sostituiti da un BUY di
+# apertura pari alla posizione corrente; anche le posizioni senza
+# transazioni lo ricevono. DIVIDEND e FEE restano nel registro: il prezzo
+# del BUY di apertura esclude le commissioni FEE successive, che la
+# riesecuzione aggiunge di nuovo al costo.
+LEDGER_ALIGN_QUERY = """
+    WITH ledger AS (
+        SELECT portfolio_id, UPPER(ticker) AS ticker,
+               SUM(CASE transaction_type WHEN 'BUY' THEN shares
+                                         WHEN 'SELL' THEN -shares ELSE 0 END) AS shares
+        FROM transactions
+        WHERE transaction_type IN ('BUY', 'SELL')
+        GROUP BY portfolio_id, UPPER(ticker)
+    ),
+    current_positions AS (
+        SELECT portfolio_id, UPPER(ticker) AS ticker, shares, avg_price, currency,
+               COALESCE(purchase_date, added_at::date, CURRENT_DATE) AS opened
+        FROM positions
+    ),
+    misaligned AS (
+        SELECT COALESCE(p.portfolio_id, l.portfolio_id) AS portfolio_id,
+               COALESCE(p.ticker, l.ticker) AS ticker,
+               p.shares, p.avg_price, p.currency, p.opened
+        FROM ledger l
+        FULL JOIN current_positions p
+            ON p.portfolio_id = l.portfolio_id AND p.ticker = l.ticker
+        WHERE (p.portfolio_id IS NULL AND l.shares > %(epsilon)s)
+            OR (p.portfolio_id IS NOT NULL AND ABS(p.shares - COALESCE(l.shares, 0)) > %(epsilon)s)
+    ),
+    later_fees AS (
+        SELECT m.portfolio_id, m.ticker,
+               SUM(COALESCE(NULLIF(t.fees, 0), t.shares * t.price)) AS amount
+        FROM misaligned m
+        JOIN transactions t
+            ON t.portfolio_id = m.portfolio_id AND UPPER(t.ticker) = m.ticker
+        WHERE t.transaction_type = 'FEE' AND t.transaction_date >= m.opened
+        GROUP BY m.portfolio_id, m.ticker
+    ),
+    archived AS (
+        DELETE FROM transactions t
+        USING misaligned m
+        WHERE t.portfolio_id = m.portfolio_id AND UPPER(t.ticker) = m.ticker
+            AND t.transaction_type IN ('BUY', 'SELL')
+        RETURNING t.*
+    ),
+    saved AS (
+        INSERT INTO transactions_orphaned
+        SELECT * FROM archived
+        RETURNING portfolio_id
+    ),
+    opening AS (
+        INSERT INTO transactions (
+            portfolio_id, ticker, transaction_type, shares, price,
+            currency, transaction_date, fees, notes
+        )
+        SELECT m.portfolio_id, m.ticker, 'BUY', m.shares,
+               GREATEST(m.avg_price - COALESCE(f.amount, 0) / m.shares, 0),
+               m.currency, m.opened, 0, 'Saldo di apertura (allineamento registro)'
+        FROM misaligned m
+        LEFT JOIN later_fees f ON f.portfolio_id = m.portfolio_id AND f.ticker = m.ticker
+        WHERE m.shares > 0
+        RETURNING portfolio_id
+    )
+    SELECT m.portfolio_id, m.ticker, m.shares IS NULL AS orphaned,
+           (SELECT COUNT(*) FROM saved) AS archived,
+           (SELECT COUNT(*) FROM opening) AS opened
+    FROM misaligned m
+"""
+
+_ledger_ready = False
+
+
+def ensure_ledger_tables():
+    """Crea tabella lotti, indici del registro e indice univoco delle posizioni (una volta per processo)."""
+    global _ledger_ready
+    if _ledger_ready:
+        return
+
+    # Un solo tentativo per processo, anche se fallisce: niente DDL ripetuto a ogni lettura
+    _ledger_ready = True
+    try:
+        execute_query(LEDGER_DDL, fetch=False)
+        execute_query(POSITIONS_UNIQUE_DDL, fetch=False)
+    except Exception as e:
+        # Es. posizioni duplicate già presenti: l'upsert fallirà con un errore esplicito
+        print(f"Errore creazione tabelle registro: {e}")
+
+
+def align_ledger_with_positions(dry_run=False):
+    """
+    Allinea il registro alle posizioni correnti (vedi LEDGER_ALIGN_QUERY) e
+    ricostruisce i lotti delle coppie toccate, nella stessa transazione.
+
+    Passo esplicito e distruttivo (scripts/rebuild_positions.py --align):
+    va eseguito una volta prima della prima ricostruzione completa. Una
+    seconda esecuzione non trova coppie disallineate e non modifica nulla.
+
+    Args:
+        dry_run: Se True riporta le coppie coinvolte e annulla tutto (rollback)
+
+    Returns:
+        dict: orphaned (coppie archiviate senza posizione), realigned,
+              archived (BUY/SELL archiviati), opened (BUY di apertura), dry_run
+    """
+    ensure_ledger_tables()
+    report = {'orphaned': [], 'realigned': [], 'archived': 0, 'opened': 0, 'dry_run': dry_run}
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(ORPHANED_DDL)
+        cursor.execute(LEDGER_ALIGN_QUERY, {'epsilon': LEDGER_EPSILON})
+        rows = cursor.fetchall()
+
+        for portfolio_id, ticker, orphaned, archived, opened in rows:
+            report['orphaned' if orphaned else 'realigned'].append((portfolio_id, ticker))
+            report['archived'], report['opened'] = int(archived), int(opened)
+
+        # Lotti coerenti con i BUY di apertura (le posizioni restano invariate)
+        realigned = report['realigned']
+        if realigned:
+            rebuild_positions(sorted({pid for pid, _ in realigned}),
+                              sorted({ticker for _, ticker in realigned}), conn=conn)
+
+        if dry_run:
+            conn.rollback()
+
+    return report
+
+
+# ========================================
+# RIESECUZIONE DEL REGISTRO
+# ========================================
+
+def replay_ledger(transactions, method=LEDGER_METHOD):
+    """
+    Posizioni e lotti aperti ricostruiti dal registro in un solo passaggio.
+
+    Le coppie (portafoglio, ticker) con soli acquisti - il caso comune -
+    vengono calcolate con group-by vettoriali; solo quelle con vendite o
+    commissioni passano da un LotBook (database.lots), in un unico ciclo
+    lineare sulle transazioni ordinate.
+
+    Args:
+        transactions: DataFrame LEDGER_COLUMNS ordinato per portafoglio,
+                      ticker, data, id
+        method: 'average', 'fifo' o 'lifo'
+
+    Returns:
+        tuple: (posizioni POSITION_COLUMNS - una riga per coppia, shares 0
+               se chiusa -, lotti LOT_COLUMNS, lista coppie con vendite
+               oltre la quantità detenuta)
+    """
+    if transactions.empty:
+        return pd.DataFrame(columns=POSITION_COLUMNS), pd.DataFrame(columns=LOT_COLUMNS), []
+
+    pair_index, pairs = pd.MultiIndex.from_frame(transactions[['portfolio_id', 'ticker']]).factorize()
+    types = transactions['transaction_type'].to_numpy()
+    shares = transactions['shares'].to_numpy(dtype=np.float64)
+    prices = transactions['price'].to_numpy(dtype=np.float64)
+    fees = transactions['fees'].to_numpy(dtype=np.float64)
+
+    needs_replay = np.bincount(pair_index, weights=(types != 'BUY').astype(np.float64), minlength=len(pairs)) > 0
+    replay_rows = needs_replay[pair_index]
+
+    # 1. Solo acquisti: un lotto per transazione
+    simple = ~replay_rows & (shares > LEDGER_EPSILON)
+    lot_frames = [pd.DataFrame({
+        'portfolio_id': transactions['portfolio_id'].to_numpy()[simple],
+        'ticker': transactions['ticker'].to_numpy()[simple],
+        'transaction_id': transactions['id'].to_numpy()[simple],
+        'acquired_date': transactions['transaction_date'].to_numpy()[simple],
+        'shares': shares[simple],
+        'price': prices[simple] + fees[simple] / shares[simple],
+    })]
+
+    # 2. Coppie con vendite/commissioni: un LotBook per coppia, un passaggio lineare
+    ids = transactions['id'].to_numpy()
+    dates = transactions['transaction_date'].to_numpy()
+    records = []
+    oversold = []
+    book = None
+    current = None
+
+    def flush(pair):
+        portfolio_id, ticker = pairs[pair]
+        records.extend((portfolio_id, ticker) + lot for lot in book.open_lots())
+        if book.oversold > LEDGER_EPSILON:
+            oversold.append((int(portfolio_id), ticker))
+
+    for i in np.flatnonzero(replay_rows):
+        pair = pair_index[i]
+        if pair != current:
+            if current is not None:
+                flush(current)
+            book = LotBook(method)
+            current = pair
+
+        book.apply(types[i], shares[i], prices[i], fees[i], ids[i], dates[i])
+
+    if current is not None:
+        flush(current)
+
+    lot_frames.append(pd.DataFrame(records, columns=LOT_COLUMNS))
+    lots_df = pd.concat([f for f in lot_frames if not f.empty] or [lot_frames[0]], ignore_index=True)
+    lots_df = lots_df[lots_df['shares'] > LEDGER_EPSILON]
+
+    # Posizioni: somme per coppia sui lotti aperti (0 per le coppie chiuse)
+    by_pair = (lots_df.assign(cost=lots_df['shares'] * lots_df['price'])
+               .groupby(['portfolio_id', 'ticker'])
+               .agg(shares=('shares', 'sum'), cost=('cost', 'sum'), purchase_date=('acquired_date', 'min'))
+               .reindex(pairs, fill_value=0))
+
+    positions = pd.DataFrame({
+        'portfolio_id': pairs.get_level_values(0),
+        'ticker': pairs.get_level_values(1),
+        'shares': by_pair['shares'].to_numpy(dtype=np.float64),
+        'avg_price': np.divide(by_pair['cost'].to_numpy(dtype=np.float64),
+                               by_pair['shares'].to_numpy(dtype=np.float64),
+                               out=np.zeros(len(pairs)), where=by_pair['shares'].to_numpy() > LEDGER_EPSILON),
+        'currency': transactions['currency'].groupby(pair_index).first().reindex(range(len(pairs))).to_numpy(),
+        'purchase_date': by_pair['purchase_date'].where(by_pair['shares'] > LEDGER_EPSILON).to_numpy(),
+    }, columns=POSITION_COLUMNS)
+
+    return positions, lots_df.reset_index(drop=True)[LOT_COLUMNS], oversold
+
+
+# ========================================
+# SCRITTURE INCREMENTALI
+# ========================================
+
+def record_buys(lots):
+    """
+    Registra acquisti (anche di più titoli) in un solo statement.
+
+    I lotti dello stesso ticker vengono aggregati lato server (quantità
+    sommate, prezzo medio ponderato) prima dell'upsert sulle posizioni;
+    ogni lotto resta una transazione BUY e un lotto aperto con la sua data.
+
+    Args:
+        lots: Lista di dict con portfolio_id, ticker, shares, price e opzionali
+              fees, currency, company_name, sector, industry, purchase_date, notes
+
+    Returns:
+        list: Una riga (id, ticker, shares, avg_price) per posizione
+
+    Raises:
+        ValueError: Se una quantità non è positiva
+    """
+    rows = []
+    for lot in lots:
+        if float(lot['shares']) <= 0:
+            raise ValueError(f"Quantità non valida per {lot['ticker']}: {lot['shares']}")
+        rows.append((
+            lot['portfolio_id'],
+            lot['ticker'].upper(),
+            float(lot['shares']),
+            float(lot['price']),
+            float(lot.get('fees') or 0),
+            lot.get('currency') or 'USD',
+            lot.get('company_name'),
+            lot.get('sector'),
+            lot.get('industry'),
+            lot.get('purchase_date'),
+            lot.get('notes'),
+        ))
+
+    if not rows:
+        return []
+
+    ensure_ledger_tables()
+    return execute_values_query(BUY_QUERY, rows, template=BUY_TEMPLATE)
+
+
+def record_transaction(portfolio_id, ticker, tx_type, shares, price, currency='USD',
+                       tx_date=None, fees=0, notes=None, method=None):
+    """
+    Registra una transazione e aggiorna posizione e lotti aperti.
+
+    Gli acquisti passano da record_buys (un solo statement); i dividendi
+    vengono solo registrati (non muovono la posizione). Vendite e
+    commissioni bloccano la riga della posizione, applicano la transazione
+    ai soli lotti aperti del titolo (LotBook) e riscrivono lotti e
+    posizione nella stessa transazione DB. Una transazione retrodatata
+    rispetto all'ultima registrata ricostruisce il titolo dal registro.
+
+    Returns:
+        dict: transaction_id, shares, avg_price della posizione risultante
+
+    Raises:
+        ValueError: Tipo sconosciuto, posizione assente o vendita oltre la
+                    quantità detenuta
+    """
+    method = method or LEDGER_METHOD
+    ticker = ticker.upper()
+    tx_type = tx_type.upper()
+    tx_date = tx_date or date.today()
+
+    if tx_type not in TRANSACTION_TYPES:
+        raise ValueError(f"Tipo transazione non supportato: {tx_type}")
+
+    if tx_type == 'BUY':
+        result = record_buys([{
+            'portfolio_id': portfolio_id, 'ticker': ticker, 'shares': shares, 'price': price,
+            'fees': fees, 'currency': currency, 'purchase_date': tx_date, 'notes': notes,
+        }])
+        return {'transaction_id': None, **result[0]} if result else None
+
+    if tx_type == 'DIVIDEND':
+        result = execute_query("""
+            WITH recorded AS (
+                INSERT INTO transactions (
+                    portfolio_id, ticker, transaction_type, shares, price,
+                    currency, transaction_date, fees, notes
+                ) VALUES (%s, %s, 'DIVIDEND', %s, %s, %s, %s, %s, %s)
+                RETURNING id
+            ),
+            touched AS (
+                UPDATE portfolios SET updated_at = CURRENT_TIMESTAMP WHERE id = %s
+            )
+            SELECT id FROM recorded
+        """, (portfolio_id, ticker, shares or 0, price, currency, tx_date, fees or 0, notes, portfolio_id))
+        return {'transaction_id': result[0]['id'] if result else None, 'ticker': ticker,
+                'shares': None, 'avg_price': None}
+
+    ensure_ledger_tables()
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("""
+            SELECT id, shares, avg_price, currency, purchase_date
+            FROM positions
+            WHERE portfolio_id = %s AND ticker = %s
+            FOR UPDATE
+        """, (portfolio_id, ticker))
+        position = cursor.fetchone()
+
+        if position is None:
+            raise ValueError(f"Nessuna posizione aperta su {ticker}")
+
+        position_id, position_shares, position_price, position_currency, purchase_date = position
+
+        cursor.execute("""
+            SELECT COALESCE(MAX(transaction_date) > %s, FALSE)
+            FROM transactions
+            WHERE portfolio_id = %s AND ticker = %s
+        """, (tx_date, portfolio_id, ticker))
+        backdated = cursor.fetchone()[0]
+
+        cursor.execute("""
+            SELECT transaction_id, acquired_date, shares, price
+            FROM position_lots
+            WHERE portfolio_id = %s AND ticker = %s
+            ORDER BY acquired_date, transaction_id
+            FOR UPDATE
+        """, (portfolio_id, ticker))
+        book = LotBook(method)
+        book.load(cursor.fetchall())
+
+        # Lotti non allineati alla posizione (es. posizione precedente alla
+        # tabella dei lotti): si ricavano dal registro del solo titolo, e se
+        # nemmeno il registro torna, un unico lotto al prezzo medio
+        if abs(book.shares - float(position_shares)) > LEDGER_EPSILON:
+            _, replayed, _ = replay_ledger(load_ledger(cursor, [portfolio_id], [ticker]), method)
+            book = LotBook(method)
+            book.load(replayed[LOT_COLUMNS[2:]].itertuples(index=False, name=None))
+            if abs(book.shares - float(position_shares)) > LEDGER_EPSILON:
+                book = LotBook(method)
+                book.load([(None, purchase_date, position_shares, position_price)])
+
+        book.apply(tx_type, float(shares), float(price), float(fees or 0), None, tx_date)
+        if book.oversold > LEDGER_EPSILON:
+            raise ValueError(f"Quantità in vendita ({shares}) superiore a quella detenuta "
+                             f"({float(position_shares):g}) per {ticker}")
+
+        cursor.execute("""
+            INSERT INTO transactions (
+                portfolio_id, ticker, transaction_type, shares, price,
+                currency, transaction_date, fees, notes
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
+        """, (portfolio_id, ticker, tx_type, shares, price,
+              currency or position_currency, tx_date, fees or 0, notes))
+        transaction_id = cursor.fetchone()[0]
+
+        if backdated:
+            rebuild_positions(portfolio_ids=[portfolio_id], tickers=[ticker], method=method, conn=conn)
+            cursor.execute("SELECT shares, avg_price FROM positions WHERE id = %s", (position_id,))
+            row = cursor.fetchone()
+            new_shares, new_price = (float(row[0]), float(row[1])) if row else (0.0, 0.0)
+        else:
+            new_shares, new_price = book.shares, book.avg_price
+            _write_lots(cursor, conn, portfolio_id, ticker, book.open_lots())
+
+            if new_shares > LEDGER_EPSILON:
+                cursor.execute("""
+                    UPDATE positions SET shares = %s, avg_price = %s, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = %s
+                """, (new_shares, new_price, position_id))
+            else:
+                cursor.execute("DELETE FROM positions WHERE id = %s", (position_id,))
+
+        cursor.execute("UPDATE portfolios SET updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                       (portfolio_id,))
+
+    return {'transaction_id': transaction_id, 'ticker': ticker, 'shares': new_shares, 'avg_price': new_price}
+
+
+def _write_lots(cursor, conn, portfolio_id, ticker, lots):
+    """Sostituisce i lotti aperti di un titolo."""
+    cursor.execute("DELETE FROM position_lots WHERE portfolio_id = %s AND ticker = %s",
+                   (portfolio_id, ticker))
+    if lots:
+        execute_values_query("""
+            INSERT INTO position_lots (portfolio_id, ticker, transaction_id, acquired_date, shares, price)
+            VALUES %s
+        """, [(portfolio_id, ticker, int(lot[0]) if lot[0] is not None else None, lot[1],
+               float(lot[2]), float(lot[3])) for lot in lots],
+            template="(%s, %s, %s::integer, %s::date, %s, %s)", fetch=False, conn=conn)
+
+
+# ========================================
+# RICOSTRUZIONE COMPLETA
+# ========================================
+
+def load_ledger(cursor, portfolio_ids=None, tickers=None):
+    """Transazioni POSITION_TYPES ordinate per portafoglio, ticker, data e id (DataFrame LEDGER_COLUMNS)."""
+    query = """
+        SELECT id, portfolio_id, UPPER(ticker) AS ticker, transaction_type,
+               shares, price, COALESCE(fees, 0) AS fees, currency, transaction_date
+        FROM transactions
+        WHERE transaction_type = ANY(%s)
+    """
+    params = [list(POSITION_TYPES)]
+
+    if portfolio_ids:
+        query += " AND portfolio_id = ANY(%s)"
+        params.append(list(portfolio_ids))
+    if tickers:
+        query += " AND UPPER(ticker) = ANY(%s)"
+        params.append([t.upper() for t in tickers])
+
+    query += " ORDER BY portfolio_id, UPPER(ticker), transaction_date, id"
+
+    cursor.execute(query, params)
+    df = pd.DataFrame(cursor.fetchall(), columns=LEDGER_COLUMNS)
+    for column in ('shares', 'price', 'fees'):
+        df[column] = df[column].astype(np.float64)
+    return df
+
+
+def rebuild_positions(portfolio_ids=None, tickers=None, method=None, conn=None, verbose=False):
+    """
+    Ricostruisce posizioni e lotti aperti rieseguendo il registro.
+
+    - Una query per tutte le transazioni (dei portafogli/ticker indicati)
+    - replay_ledger: group-by vettoriali + un passaggio lineare a lotti
+    - COPY in staging e un solo statement che sostituisce lotti e posizioni
+
+    Le posizioni senza transazioni (precedenti al registro) non vengono toccate;
+    i BUY orfani di posizioni cancellate prima del registro tornerebbero invece
+    in vita: alla prima ricostruzione completa eseguire prima
+    align_ledger_with_positions (scripts/rebuild_positions.py --align).
+
+    Args:
+        portfolio_ids: Portafogli da ricostruire (default: tutti)
+        tickers: Limita ai ticker indicati
+        method: 'average', 'fifo' o 'lifo' (default LEDGER_METHOD)
+        conn: Connessione esistente (default: una nuova dal pool)
+
+    Returns:
+        dict: transactions, pairs, positions_updated, positions_closed, lots,
+              oversold, timings
+    """
+    method = method or LEDGER_METHOD
+    if method not in LEDGER_METHODS:
+        raise ValueError(f"Metodo non supportato: {method}")
+
+    if conn is None:
+        ensure_ledger_tables()
+
+    def log(msg):
+        if verbose:
+            print(f"[{datetime.now()}] {msg}")
+
+    def run(connection):
+        timings = {}
+        t0 = time.perf_counter()
+        cursor = connection.cursor()
+
+        transactions = load_ledger(cursor, portfolio_ids, tickers)
+        timings['load'] = time.perf_counter() - t0
+        report = {'transactions': len(transactions), 'pairs': 0, 'positions_updated': 0,
+                  'positions_closed': 0, 'lots': 0, 'oversold': [], 'timings': timings}
+
+        if transactions.empty:
+            return report
+
+        t1 = time.perf_counter()
+        positions, lots, oversold = replay_ledger(transactions, method)
+        timings['replay'] = time.perf_counter() - t1
+        report['pairs'] = len(positions)
+        report['oversold'] = oversold
+        log(f"Registro rieseguito: {len(transactions)} transazioni, {len(positions)} titoli "
+            f"in {timings['replay']:.2f}s")
+
+        for frame, column in ((positions, 'purchase_date'), (lots, 'acquired_date')):
+            frame[column] = pd.to_datetime(frame[column]).dt.strftime('%Y-%m-%d')
+
+        t1 = time.perf_counter()
+        cursor.execute(REBUILD_STAGING_DDL)
+        copy_rows('ledger_positions', POSITION_COLUMNS, positions, conn=connection)
+        copy_rows('ledger_lots', LOT_COLUMNS, lots, conn=connection)
+        cursor.execute(REBUILD_QUERY)
+        result = dict(zip([desc[0] for desc in cursor.description], cursor.fetchone()))
+        report.update({k: int(v) for k, v in result.items()})
+        timings['write'] = time.perf_counter() - t1
+        timings['total'] = time.perf_counter() - t0
+
+        log(f"Posizioni aggiornate: {report['positions_updated']}, chiuse: {report['positions_closed']}, "
+            f"lotti aperti: {report['lots']} in {timings['total']:.2f}s")
+        if oversold:
+            log(f"Vendite oltre la quantità detenuta: {oversold}")
+
+        return report
+
+    if conn is not None:
+        return run(conn)
+
+    with get_db_connection() as connection:
+        return run(connection)
+
+
+# ========================================
+# COSTO DI CARICO IN VALUTA BASE
+# ========================================
+
+def get_cost_fx(portfolio_ids, base_currency=None):
+    """
+    Cambio medio di carico per posizione: ogni lotto aperto convertito nella
+    valuta base al cambio della sua data di acquisto (storico da
+    get_fx_history), poi rapporto costo in valuta base / costo in valuta.
+
+    Con questo cambio il costo non si muove con il cambio corrente e il
+    P/L in valuta base include l'effetto valuta.
+
+    Returns:
+        dict: (portfolio_id, ticker) -> cambio; assenti le posizioni senza
+              lotti o senza storico dei cambi (i chiamanti usano il cambio
+              corrente)
+    """
+    if not portfolio_ids:
+        return {}
+
+    ensure_ledger_tables()
+    try:
+        rows = execute_query("""
+            SELECT l.portfolio_id, l.ticker, l.acquired_date, l.shares * l.price AS cost, p.currency
+            FROM position_lots l
+            JOIN positions p ON p.portfolio_id = l.portfolio_id AND p.ticker = l.ticker
+            WHERE l.portfolio_id = ANY(%s)
+        """, ([int(pid) for pid in portfolio_ids],)) or []
+    except Exception as e:
+        print(f"Errore lettura lotti per cambio di carico: {e}")
+        return {}
+
+    if not rows:
+        return {}
+
+    lots = pd.DataFrame(rows, columns=['portfolio_id', 'ticker', 'acquired_date', 'cost', 'currency'])
+    lots['cost'] = lots['cost'].astype(np.float64)
+    dates = pd.to_datetime(lots['acquired_date'])
+
+    rates = np.full(len(lots), np.nan, dtype=np.float64)
+    dated = dates.notna().to_numpy()
+    if dated.any():
+        history = get_fx_history(lots['currency'].unique().tolist(), dates.min(), date.today(), base_currency)
+        rates[dated] = lookup_fx(history, lots['currency'][dated].tolist(), dates[dated])
+
+    lots['base_cost'] = lots['cost'] * rates
+    grouped = lots.groupby(['portfolio_id', 'ticker']).agg(
+        cost=('cost', 'sum'), base_cost=('base_cost', lambda s: s.sum(min_count=len(s))))
+    grouped = grouped[(grouped['cost'] > 0) & grouped['base_cost'].notna()]
+
+    return (grouped['base_cost'] / grouped['cost']).to_dict()
@@ -0,0 +1,325 @@
+from database.db_connection import execute_query
+from database.fx import get_fx_vector, missing_currencies
+from collections import OrderedDict, deque
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+# Metodo di carico (lo stesso usato dal registro per le posizioni)
+LOT_METHOD = os.getenv("LEDGER_METHOD", "average").lower()
+LOT_METHODS = ('average', 'fifo', 'lifo')
+
+# Quantità sotto questa soglia valgono zero (residui floating point)
+LOT_EPSILON = 1e-9
+
+LOTS_CACHE_MAXSIZE = 256
+
+OPEN_LOT_COLUMNS = ['ticker', 'transaction_id', 'acquired_date', 'shares', 'unit_cost', 'cost']
+CLOSED_LOT_COLUMNS = ['ticker', 'sell_id', 'lot_id', 'acquired_date', 'sold_date',
+                      'shares', 'cost', 'proceeds', 'realized_pl']
+SUMMARY_COLUMNS = ['ticker', 'currency', 'shares', 'avg_price', 'cost', 'realized_pl',
+                   'dividends', 'fees', 'oversold']
+
+_lots_cache = OrderedDict()  # (portfolio_id, metodo, ultimo id transazione, numero transazioni) -> risultato
+_lots_cache_lock = threading.Lock()
+
+
+class LotBook:
+    """
+    Lotti aperti e risultati realizzati di un titolo.
+
+    Ogni operazione costa O(1) ammortizzato: le vendite consumano i lotti
+    dalla testa (FIFO, e costo medio per le date) o dalla coda (LIFO) e ogni
+    lotto si chiude una volta sola; le commissioni FEE non riscrivono i
+    lotti ma aumentano un aggiustamento per azione comune a tutti.
+
+    Lotto = [transaction_id, data, quantità, prezzo base]; costo unitario =
+    prezzo base + aggiustamento (con 'average' il costo medio del titolo).
+    """
+
+    def __init__(self, method=LOT_METHOD):
+        if method not in LOT_METHODS:
+            raise ValueError(f"Metodo non supportato: {method}")
+
+        self.method = method
+        self.lots = deque()
+        self.adjustment = 0.0   # commissioni FEE per azione sui lotti aperti
+        self.shares = 0.0
+        self.cost = 0.0
+        self.realized = 0.0
+        self.dividends = 0.0
+        self.fees = 0.0
+        self.oversold = 0.0     # quantità vendute oltre quella detenuta
+        self.closed = []        # (sell_id, lot_id, acquisto, vendita, quantità, costo, ricavo)
+
+    @property
+    def avg_price(self):
+        return self.cost / self.shares if self.shares > LOT_EPSILON else 0.0
+
+    def load(self, lots):
+        """Carica lotti aperti già valorizzati: (transaction_id, data, quantità, costo unitario)."""
+        for tx_id, acquired, shares, price in lots:
+            shares, price = float(shares), float(price)
+            self.lots.append([tx_id, acquired, shares, price - self.adjustment])
+            self.shares += shares
+            self.cost += shares * price
+
+    def buy(self, shares, price, fees=0.0, tx_id=None, tx_date=None):
+        """Nuovo lotto; le commissioni entrano nel costo di carico."""
+        if shares <= LOT_EPSILON:
+            return
+        unit_cost = price + fees / shares
+        self.lots.append([tx_id, tx_date, shares, unit_cost - self.adjustment])
+        self.shares += shares
+        self.cost += shares * unit_cost
+        self.fees += fees
+
+    def sell(self, shares, price, fees=0.0, tx_id=None, tx_date=None):
+        """
+        Vendita: consuma i lotti secondo il metodo.
+
+        Returns:
+            float: P/L realizzato (ricavo netto commissioni - costo dei lotti)
+        """
+        sold = min(shares, self.shares)
+        if shares - sold > LOT_EPSILON:
+            self.oversold += shares - sold
+
+        net_price = price - (fees / shares if shares > 0 else 0.0)
+        avg_price = self.avg_price
+        lifo = self.method == 'lifo'
+
+        remaining = sold
+        cost = 0.0
+        while remaining > LOT_EPSILON and self.lots:
+            lot = self.lots[-1] if lifo else self.lots[0]
+            quantity = min(lot[2], remaining)
+            unit_cost = avg_price if self.method == 'average' else lot[3] + self.adjustment
+
+            self.closed.append((tx_id, lot[0], lot[1], tx_date, quantity,
+                                quantity * unit_cost, quantity * net_price))
+            cost += quantity * unit_cost
+            remaining -= quantity
+            lot[2] -= quantity
+
+            if lot[2] <= LOT_EPSILON:
+                if lifo:
+                    self.lots.pop()
+                else:
+                    self.lots.popleft()
+
+        self.shares -= sold
+        self.cost -= cost
+        if not self.lots or self.shares <= LOT_EPSILON:
+            self.shares = self.cost = self.adjustment = 0.0
+            self.lots.clear()
+
+        realized = sold * net_price - cost
+        self.realized += realized
+        self.fees += fees
+        return realized
+
+    def fee(self, amount):
+        """Commissione sul titolo: aumenta il costo dei lotti aperti (o è una perdita se non ce ne sono)."""
+        if self.shares > LOT_EPSILON:
+            self.adjustment += amount / self.shares
+            self.cost += amount
+        else:
+            self.realized -= amount
+        self.fees += amount
+
+    def dividend(self, amount):
+        self.dividends += amount
+
+    def apply(self, tx_type, shares, price, fees=0.0, tx_id=None, tx_date=None):
+        """
+        Applica una riga del registro.
+
+        - BUY / SELL: quantità, prezzo, commissioni
+        - FEE: importo = fees (o shares * price)
+        - DIVIDEND: importo lordo = shares * price (o price se shares è 0),
+          al netto di fees (ritenute)
+        """
+        if tx_type == 'BUY':
+            self.buy(shares, price, fees, tx_id, tx_date)
+        elif tx_type == 'SELL':
+            self.sell(shares, price, fees, tx_id, tx_date)
+        elif tx_type == 'FEE':
+            self.fee(fees or shares * price)
+        elif tx_type == 'DIVIDEND':
+            self.dividend((shares * price if shares > 0 else price) - fees)
+
+    def open_lots(self):
+        """Lotti aperti dal più vecchio: (transaction_id, data, quantità, costo unitario)."""
+        if self.method == 'average':
+            avg_price = self.avg_price
+            return [(lot[0], lot[1], lot[2], avg_price) for lot in self.lots]
+        return [(lot[0], lot[1], lot[2], lot[3] + self.adjustment) for lot in self.lots]
+
+
+# ========================================
+# CONTABILITÀ DEL PORTAFOGLIO
+# ========================================
+
+def load_portfolio_transactions(portfolio_id):
+    """Registro completo del portafoglio in ordine di data (DataFrame)."""
+    rows = execute_query("""
+        SELECT id, UPPER(ticker) AS ticker, transaction_type, shares, price,
+               COALESCE(fees, 0) AS fees, currency, transaction_date
+        FROM transactions
+        WHERE portfolio_id = %s
+        ORDER BY UPPER(ticker), transaction_date, id
+    """, (portfolio_id,)) or []
+
+    df = pd.DataFrame(rows, columns=['id', 'ticker', 'transaction_type', 'shares', 'price',
+                                     'fees', 'currency', 'transaction_date'])
+    for column in ('shares', 'price', 'fees'):
+        df[column] = df[column].astype(np.float64)
+    return df
+
+
+def load_transactions_version(portfolio_id):
+    """Ultimo id e numero di transazioni: cambia con ogni scrittura o cancellazione."""
+    result = execute_query("""
+        SELECT COALESCE(MAX(id), 0) AS last_id, COUNT(*) AS count
+        FROM transactions
+        WHERE portfolio_id = %s
+    """, (portfolio_id,))
+    return (result[0]['last_id'], result[0]['count']) if result else (0, 0)
+
+
+def compute_lots(transactions, method=LOT_METHOD):
+    """
+    Contabilità a lotti di un portafoglio in un solo passaggio lineare.
+
+    Args:
+        transactions: DataFrame di load_portfolio_transactions (ordinato per
+                      ticker, data, id)
+        method: 'average', 'fifo' o 'lifo'
+
+    Returns:
+        dict: summary (per ticker, SUMMARY_COLUMNS), open_lots
+              (OPEN_LOT_COLUMNS), closed_lots (CLOSED_LOT_COLUMNS)
+    """
+    summary, open_rows, closed_rows = [], [], []
+
+    if not transactions.empty:
+        tickers = transactions['ticker'].to_numpy()
+        types = transactions['transaction_type'].to_numpy()
+        shares = transactions['shares'].to_numpy(dtype=np.float64)
+        prices = transactions['price'].to_numpy(dtype=np.float64)
+        fees = transactions['fees'].to_numpy(dtype=np.float64)
+        ids = transactions['id'].to_numpy()
+        dates = transactions['transaction_date'].to_numpy()
+        currencies = transactions['currency'].to_numpy()
+
+        # Confini dei blocchi per ticker (righe contigue)
+        starts = np.flatnonzero(np.r_[True, tickers[1:] != tickers[:-1]])
+        ends = np.r_[starts[1:], len(tickers)]
+
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            ticker = tickers[start]
+            book = LotBook(method)
+            for i in range(start, end):
+                book.apply(types[i], shares[i], prices[i], fees[i], ids[i], dates[i])
+
+            summary.append((ticker, currencies[start], book.shares, book.avg_price, book.cost,
+                            book.realized, book.dividends, book.fees, book.oversold))
+            open_rows.extend((ticker, tx_id, acquired, qty, unit, qty * unit)
+                             for tx_id, acquired, qty, unit in book.open_lots())
+            closed_rows.extend((ticker, sell_id, lot_id, acquired, sold, qty, cost, proceeds, proceeds - cost)
+                               for sell_id, lot_id, acquired, sold, qty, cost, proceeds in book.closed)
+
+    return {
+        'summary': pd.DataFrame(summary, columns=SUMMARY_COLUMNS),
+        'open_lots': pd.DataFrame(open_rows, columns=OPEN_LOT_COLUMNS),
+        'closed_lots': pd.DataFrame(closed_rows, columns=CLOSED_LOT_COLUMNS),
+    }
+
+
+def get_lot_accounting(portfolio_id, method=None):
+    """
+    Contabilità a lotti del portafoglio (vedi compute_lots).
+
+    In cache per (portafoglio, metodo, ultimo id transazione): finché il
+    registro non cambia un rerun costa una sola query aggregata.
+    """
+    method = method or LOT_METHOD
+    key = (portfolio_id, method) + tuple(load_transactions_version(portfolio_id))
+
+    with _lots_cache_lock:
+        if key in _lots_cache:
+            _lots_cache.move_to_end(key)
+            return _lots_cache[key]
+
+    result = compute_lots(load_portfolio_transactions(portfolio_id), method)
+
+    with _lots_cache_lock:
+        _lots_cache[key] = result
+        while len(_lots_cache) > LOTS_CACHE_MAXSIZE:
+            _lots_cache.popitem(last=False)
+
+    return result
+
+
+def clear_lots_cache():
+    """Svuota la cache della contabilità a lotti."""
+    with _lots_cache_lock:
+        _lots_cache.clear()
+
+
+# ========================================
+# P/L REALIZZATO E NON REALIZZATO
+# ========================================
+
+def get_portfolio_realized_pl(portfolio_id, current_prices, method=None, base_currency=None):
+    """
+    P/L realizzato e non realizzato per lotto, per titolo e per portafoglio.
+
+    Args:
+        portfolio_id: ID portafoglio
+        current_prices: dict {ticker: prezzo corrente} (es. dalle posizioni
+                        di calculate_portfolio_performance)
+        method: 'average', 'fifo' o 'lifo' (default LOT_METHOD)
+        base_currency: Valuta dei totali (default BASE_CURRENCY)
+
+    Returns:
+        dict: positions (summary + current_price, current_value,
+              unrealized_pl, total_pl, fx_rate), open_lots (+ unrealized_pl),
+              closed_lots, totals (realized, unrealized, dividends, fees,
+              total nella valuta base, missing_fx: valute senza cambio,
+              escluse dai totali), method
+    """
+    accounting = get_lot_accounting(portfolio_id, method)
+    positions = accounting['summary'].copy()
+    open_lots = accounting['open_lots'].copy()
+
+    positions['current_price'] = positions['ticker'].map(current_prices).fillna(0.0).astype(np.float64)
+    positions['current_value'] = positions['shares'] * positions['current_price']
+    positions['unrealized_pl'] = np.where(positions['shares'] > LOT_EPSILON,
+                                          positions['current_value'] - positions['cost'], 0.0)
+    positions['total_pl'] = positions['realized_pl'] + positions['unrealized_pl'] + positions['dividends']
+    positions['fx_rate'] = get_fx_vector(positions['currency'].tolist(), base_currency)
+
+    lot_prices = open_lots['ticker'].map(current_prices).fillna(0.0).astype(np.float64)
+    open_lots['current_value'] = open_lots['shares'] * lot_prices
+    open_lots['unrealized_pl'] = open_lots['current_value'] - open_lots['cost']
+
+    fx = positions['fx_rate'].to_numpy(dtype=np.float64)
+    valued = np.isfinite(fx)
+    totals = {
+        column: float(positions[source].to_numpy(dtype=np.float64)[valued] @ fx[valued])
+        for column, source in (('realized', 'realized_pl'), ('unrealized', 'unrealized_pl'),
+                               ('dividends', 'dividends'), ('fees', 'fees'))
+    }
+    totals['total'] = totals['realized'] + totals['unrealized'] + totals['dividends']
+    totals['missing_fx'] = missing_currencies(positions['currency'], fx)
+
+    return {
+        'positions': positions,
+        'open_lots': open_lots,
+        'closed_lots': accounting['closed_lots'],
+        'totals': totals,
+        'method': method or LOT_METHOD,
+    }
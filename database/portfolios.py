@@ -1,4 +1,5 @@
-from database.db_connection import execute_query, execute_many
+from database.db_connection import execute_query, get_db_connection
+from database.ledger import record_buys, record_transaction, ensure_ledger_tables
 import pandas as pd
 
 
@@ -36,52 +37,38 @@ def get_user_portfolios(user_id):
 def add_position(portfolio_id, ticker, shares, avg_price, currency='USD', 
                  company_name=None, sector=None, industry=None, 
                  purchase_date=None, notes=None):
-    """Aggiungi o aggiorna posizione."""
-    # Check esistente
-    query_check = """
-        SELECT id, shares, avg_price FROM positions
-        WHERE portfolio_id = %s AND ticker = %s
     """
-    existing = execute_query(query_check, (portfolio_id, ticker.upper()))
-    
-    if existing:
-        # Update (media ponderata)
-        old_shares = float(existing[0]['shares'])
-        old_price = float(existing[0]['avg_price'])
-        
-        new_total_shares = old_shares + shares
-        new_avg_price = ((old_shares * old_price) + (shares * avg_price)) / new_total_shares
-        
-        query_update = """
-            UPDATE positions SET
-                shares = %s,
-                avg_price = %s,
-                updated_at = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """
-        execute_query(query_update, (new_total_shares, new_avg_price, existing[0]['id']), fetch=False)
-        
-        # Registra transazione
-        add_transaction(portfolio_id, ticker, 'BUY', shares, avg_price, currency, purchase_date)
-    else:
-        # Insert
-        query_insert = """
-            INSERT INTO positions (
-                portfolio_id, ticker, shares, avg_price, currency,
-                company_name, sector, industry, purchase_date, notes
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        execute_query(query_insert, (
-            portfolio_id, ticker.upper(), shares, avg_price, currency,
-            company_name, sector, industry, purchase_date, notes
-        ), fetch=False)
-        
-        # Registra transazione
-        add_transaction(portfolio_id, ticker, 'BUY', shares, avg_price, currency, purchase_date)
-    
-    # Update portfolio timestamp
-    execute_query("UPDATE portfolios SET updated_at = CURRENT_TIMESTAMP WHERE id = %s", 
-                  (portfolio_id,), fetch=False)
+    Aggiungi o aggiorna posizione (media ponderata calcolata dal database).
+
+    Upsert della posizione, transazione BUY, lotto aperto e timestamp del
+    portafoglio in un solo statement: un round trip, atomico.
+
+    Returns:
+        dict: id, ticker, shares, avg_price della posizione risultante
+    """
+    result = add_positions(portfolio_id, [{
+        'ticker': ticker, 'shares': shares, 'avg_price': avg_price, 'currency': currency,
+        'company_name': company_name, 'sector': sector, 'industry': industry,
+        'purchase_date': purchase_date, 'notes': notes,
+    }])
+    return result[0] if result else None
+
+
+def add_positions(portfolio_id, lots):
+    """
+    Aggiunge più lotti in un solo statement (vedi ledger.record_buys).
+
+    Args:
+        portfolio_id: ID portafoglio
+        lots: Lista di dict con ticker, shares, avg_price e opzionali
+              currency, company_name, sector, industry, purchase_date, notes
+
+    Returns:
+        list: Una riga (id, ticker, shares, avg_price) per ticker
+    """
+    return record_buys([
+        {**lot, 'portfolio_id': portfolio_id, 'price': lot['avg_price']} for lot in lots
+    ])
 
 
 def get_portfolio_positions(portfolio_id):
@@ -110,28 +97,33 @@ def get_portfolio_positions(portfolio_id):
 
 
 def delete_position(portfolio_id, ticker):
-    """Elimina posizione."""
-    query = "DELETE FROM positions WHERE portfolio_id = %s AND ticker = %s"
-    execute_query(query, (portfolio_id, ticker.upper()), fetch=False)
-    
-    execute_query("UPDATE portfolios SET updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-                  (portfolio_id,), fetch=False)
+    """
+    Elimina posizione con le sue transazioni e i lotti aperti (la posizione
+    è derivata dal registro: lasciare le transazioni la farebbe ricomparire
+    alla prossima ricostruzione).
+    """
+    ensure_ledger_tables()
+    execute_query("""
+        WITH removed_lots AS (
+            DELETE FROM position_lots WHERE portfolio_id = %(portfolio_id)s AND ticker = %(ticker)s
+        ),
+        removed_transactions AS (
+            DELETE FROM transactions WHERE portfolio_id = %(portfolio_id)s AND UPPER(ticker) = %(ticker)s
+        ),
+        removed_position AS (
+            DELETE FROM positions WHERE portfolio_id = %(portfolio_id)s AND ticker = %(ticker)s
+        )
+        UPDATE portfolios SET updated_at = CURRENT_TIMESTAMP WHERE id = %(portfolio_id)s
+    """, {'portfolio_id': portfolio_id, 'ticker': ticker.upper()}, fetch=False)
 
 
 def add_transaction(portfolio_id, ticker, tx_type, shares, price, currency, tx_date=None, fees=0, notes=None):
-    """Registra transazione per tracking P&L."""
-    from datetime import date
-    
-    query = """
-        INSERT INTO transactions (
-            portfolio_id, ticker, transaction_type, shares, price,
-            currency, transaction_date, fees, notes
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
     """
-    execute_query(query, (
-        portfolio_id, ticker.upper(), tx_type, shares, price,
-        currency, tx_date or date.today(), fees, notes
-    ), fetch=False)
+    Registra transazione (BUY, SELL, FEE, DIVIDEND) aggiornando posizione
+    e lotti (vedi ledger.record_transaction).
+    """
+    return record_transaction(portfolio_id, ticker, tx_type, shares, price, currency,
+                              tx_date=tx_date, fees=fees, notes=notes)
 
 def delete_portfolio(portfolio_id):
     """
@@ -143,33 +135,25 @@ def delete_portfolio(portfolio_id):
     Returns:
         bool: True se eliminato con successo, False altrimenti
     """
-    conn = get_db_connection()
-    if not conn:
-        return False
-    
     try:
-        cursor = conn.cursor()
-        
-        # Elimina prima tutte le posizioni associate al portafoglio
-        cursor.execute("""
-            DELETE FROM positions 
-            WHERE portfolio_id = %s
-        """, (portfolio_id,))
-        
-        # Poi elimina il portafoglio
-        cursor.execute("""
-            DELETE FROM portfolios 
-            WHERE id = %s
-        """, (portfolio_id,))
-        
-        conn.commit()
+        # Stessa connessione e stessa transazione: commit o rollback insieme
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            
+            # Elimina prima tutte le posizioni associate al portafoglio
+            cursor.execute("""
+                DELETE FROM positions 
+                WHERE portfolio_id = %s
+            """, (portfolio_id,))
+            
+            # Poi elimina il portafoglio
+            cursor.execute("""
+                DELETE FROM portfolios 
+                WHERE id = %s
+            """, (portfolio_id,))
+            
         return True
         
     except Exception as e:
         print(f"Errore eliminazione portafoglio: {e}")
-        conn.rollback()
         return False
-        
-    finally:
-        cursor.close()
-        conn.close()
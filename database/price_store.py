@@ -0,0 +1,308 @@
+import os
+import re
+import time
+import threading
+import numpy as np
+import pandas as pd
+from database.quotes import fetch_bar_history, normalize_tickers
+
+# Archivio locale delle barre giornaliere: un file binario per ticker,
+# record a dimensione fissa ordinati per data, letti con np.memmap
+PRICE_STORE_DIR = os.getenv("PRICE_STORE_DIR", os.path.join(".cache", "prices"))
+
+# Secondi minimi tra due aggiornamenti remoti dello stesso ticker
+PRICE_STORE_REFRESH_SECONDS = int(os.getenv("PRICE_STORE_REFRESH_SECONDS", "3600"))
+
+BAR_DTYPE = np.dtype([
+    ('date', 'datetime64[D]'),
+    ('open', '<f8'),
+    ('high', '<f8'),
+    ('low', '<f8'),
+    ('close', '<f8'),
+    ('volume', '<f8'),
+])
+BAR_FIELDS = BAR_DTYPE.names
+
+_maps = {}       # ticker -> (mtime_ns, size, memmap)
+_locks = {}      # ticker -> lock di scrittura
+_refreshed = {}  # ticker -> timestamp monotonic ultimo aggiornamento remoto
+_store_lock = threading.Lock()
+
+_EMPTY = np.empty(0, dtype=BAR_DTYPE)
+
+
+def _path(ticker):
+    safe = re.sub(r'[^A-Z0-9._-]', '_', ticker.upper())
+    return os.path.join(PRICE_STORE_DIR, f"{safe}.bars")
+
+
+def _ticker_lock(ticker):
+    with _store_lock:
+        return _locks.setdefault(ticker, threading.Lock())
+
+
+# ========================================
+# LETTURA (ZERO-COPY)
+# ========================================
+
+def read_bars(ticker):
+    """
+    Tutte le barre di un ticker come array strutturato BAR_DTYPE.
+
+    Il file è mappato in memoria in sola lettura e la mappa viene riusata
+    finché il file non cambia: nessuna copia e nessun parsing.
+
+    Returns:
+        np.ndarray: memmap ordinato per data (vuoto se il ticker non c'è)
+    """
+    ticker = ticker.upper()
+    path = _path(ticker)
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return _EMPTY
+
+    # Scarta un eventuale record scritto a metà (append interrotto)
+    count = stat.st_size // BAR_DTYPE.itemsize
+    if count == 0:
+        return _EMPTY
+
+    with _store_lock:
+        cached = _maps.get(ticker)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+
+        bars = np.memmap(path, dtype=BAR_DTYPE, mode='r', shape=(count,))
+        _maps[ticker] = (stat.st_mtime_ns, stat.st_size, bars)
+        return bars
+
+
+def get_range(ticker, start=None, end=None):
+    """
+    Barre tra start ed end (inclusi): una vista sul memmap, senza copie.
+
+    Returns:
+        np.ndarray: Slice dell'array BAR_DTYPE (es. get_range(...)['close'])
+    """
+    bars = read_bars(ticker)
+    dates = bars['date']
+
+    lo = np.searchsorted(dates, np.datetime64(pd.Timestamp(start).date(), 'D')) if start is not None else 0
+    hi = (np.searchsorted(dates, np.datetime64(pd.Timestamp(end).date(), 'D'), side='right')
+          if end is not None else len(bars))
+
+    return bars[lo:hi]
+
+
+def last_bar_date(ticker):
+    """Data dell'ultima barra salvata (None se il ticker non c'è)."""
+    bars = read_bars(ticker)
+    return pd.Timestamp(bars['date'][-1]) if len(bars) else None
+
+
+def bars_to_frame(bars):
+    """DataFrame (date, open, high, low, close, volume) da un array BAR_DTYPE."""
+    frame = pd.DataFrame({field: bars[field] for field in BAR_FIELDS})
+    frame['date'] = pd.to_datetime(frame['date'])
+    return frame
+
+
+# ========================================
+# SCRITTURA (BARRE NUOVE O RIVISTE)
+# ========================================
+
+def _to_records(bars):
+    """Array BAR_DTYPE ordinato e senza date duplicate da DataFrame/lista di dict."""
+    frame = bars if isinstance(bars, pd.DataFrame) else pd.DataFrame(list(bars))
+    if frame.empty:
+        return _EMPTY
+
+    records = np.empty(len(frame), dtype=BAR_DTYPE)
+    records['date'] = pd.to_datetime(frame['date']).to_numpy(dtype='datetime64[D]')
+    for field in BAR_FIELDS[1:]:
+        records[field] = (frame[field].to_numpy(dtype=np.float64) if field in frame
+                          else np.nan)
+
+    records = records[np.argsort(records['date'], kind='stable')]
+    keep = np.ones(len(records), dtype=bool)
+    keep[:-1] = records['date'][1:] != records['date'][:-1]  # tiene l'ultima per data
+    return records[keep]
+
+
+def append_bars(ticker, bars):
+    """
+    Aggiunge le barre nuove di un ticker e sostituisce quelle riviste.
+
+    Il caso normale (solo date successive all'ultima salvata) è un append
+    in coda al file. Se arrivano date precedenti alla prima salvata, o date
+    già salvate con valori diversi (es. la barra di una seduta ancora aperta,
+    salvata a metà giornata), il file viene riscritto per intero con le
+    barre in arrivo al posto di quelle salvate (write su file temporaneo +
+    os.replace: i memmap già aperti restano validi).
+
+    Args:
+        ticker: Simbolo
+        bars: DataFrame o lista di dict con date, open, high, low, close, volume
+
+    Returns:
+        int: Numero di barre aggiunte o sostituite
+    """
+    ticker = ticker.upper()
+    records = _to_records(bars)
+    if not len(records):
+        return 0
+
+    os.makedirs(PRICE_STORE_DIR, exist_ok=True)
+    path = _path(ticker)
+
+    with _ticker_lock(ticker):
+        existing = read_bars(ticker)
+
+        if not len(existing):
+            new = records
+            revised = _EMPTY
+        else:
+            stored = np.isin(records['date'], existing['date'])
+            new = records[~stored]
+
+            # Barre già salvate: contano solo quelle con valori cambiati
+            overlap = records[stored]
+            previous = existing[np.searchsorted(existing['date'], overlap['date'])]
+            changed = np.zeros(len(overlap), dtype=bool)
+            for field in BAR_FIELDS[1:]:
+                a, b = overlap[field], previous[field]
+                changed |= (a != b) & ~(np.isnan(a) & np.isnan(b))
+            revised = overlap[changed]
+
+        if not len(new) and not len(revised):
+            return 0
+
+        if not len(revised) and (not len(existing) or new['date'][0] > existing['date'][-1]):
+            with open(path, 'ab') as f:
+                f.write(new.tobytes())
+        else:
+            kept = np.asarray(existing)[~np.isin(existing['date'], revised['date'])]
+            merged = np.concatenate([kept, revised, new])
+            merged = merged[np.argsort(merged['date'], kind='stable')]
+            tmp_path = f"{path}.tmp"
+            merged.tofile(tmp_path)
+            os.replace(tmp_path, path)
+
+        return len(new) + len(revised)
+
+
+# ========================================
+# AGGIORNAMENTO E MATRICE CHIUSURE
+# ========================================
+
+def update_tickers(tickers, start, end=None, force=False):
+    """
+    Porta l'archivio a coprire [start, end] per tutti i ticker con un solo
+    download bulk, scaricando solo le date mancanti in testa o in coda
+    (più l'ultima barra salvata, che può essere ancora parziale).
+
+    Ogni ticker viene aggiornato dal provider al massimo una volta ogni
+    PRICE_STORE_REFRESH_SECONDS (salvo force).
+
+    Returns:
+        int: Numero di barre aggiunte
+    """
+    start = pd.Timestamp(start).normalize()
+    today = pd.Timestamp.today().normalize()
+    end = pd.Timestamp(end).normalize() if end is not None else today
+    now = time.monotonic()
+
+    stale = []
+    fetch_from = end
+    for ticker in normalize_tickers(tickers):
+        if not force and now - _refreshed.get(ticker, -np.inf) < PRICE_STORE_REFRESH_SECONDS:
+            continue
+
+        bars = read_bars(ticker)
+        if not len(bars):
+            stale.append(ticker)
+            fetch_from = min(fetch_from, start)
+            continue
+
+        first = pd.Timestamp(bars['date'][0])
+        last = pd.Timestamp(bars['date'][-1])
+
+        if first > start:
+            stale.append(ticker)
+            fetch_from = min(fetch_from, start)
+        elif last < end or last >= today:
+            # Si riparte dall'ultima barra salvata (inclusa): se era di una
+            # seduta non ancora chiusa viene sostituita da quella definitiva
+            stale.append(ticker)
+            fetch_from = min(fetch_from, last)
+
+    if not stale:
+        return 0
+
+    try:
+        history = fetch_bar_history(stale, fetch_from, end)
+    except Exception as e:
+        print(f"Errore aggiornamento archivio prezzi: {e}")
+        return 0
+
+    added = 0
+    for ticker in stale:
+        if ticker in history:
+            added += append_bars(ticker, history[ticker])
+        _refreshed[ticker] = now
+
+    return added
+
+
+def get_close_matrix(tickers, start, end=None, refresh=True):
+    """
+    Chiusure giornaliere date x ticker lette dall'archivio locale.
+
+    Args:
+        tickers: Lista di ticker
+        start, end: Intervallo di date (inclusi)
+        refresh: Se True, scarica prima le barre mancanti (update_tickers)
+
+    Returns:
+        pd.DataFrame: Indice date (unione dei giorni di borsa), una colonna
+                      per ticker (NaN dove il ticker non ha barre)
+    """
+    symbols = normalize_tickers(tickers)
+    if refresh:
+        update_tickers(symbols, start, end)
+
+    columns = {}
+    for ticker in symbols:
+        bars = get_range(ticker, start, end)
+        columns[ticker] = pd.Series(bars['close'], index=pd.DatetimeIndex(bars['date']))
+
+    if not columns:
+        return pd.DataFrame()
+
+    return pd.DataFrame(columns).sort_index()
+
+
+def clear_price_store(ticker=None):
+    """Elimina l'archivio di un ticker (o di tutti)."""
+    with _store_lock:
+        if ticker:
+            _maps.pop(ticker.upper(), None)
+            _refreshed.pop(ticker.upper(), None)
+        else:
+            _maps.clear()
+            _refreshed.clear()
+
+    if ticker:
+        paths = [_path(ticker)]
+    elif os.path.isdir(PRICE_STORE_DIR):
+        paths = [os.path.join(PRICE_STORE_DIR, name)
+                 for name in os.listdir(PRICE_STORE_DIR) if name.endswith('.bars')]
+    else:
+        paths = []
+
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,460 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import requests
+import yfinance as yf
+
+# Provider di default: yfinance | fmp | fixture
+QUOTE_PROVIDER = os.getenv("QUOTE_PROVIDER", "yfinance")
+
+# API key FMP (stessa variabile usata in stock_analysis)
+FMP_API_KEY = os.getenv("MY_DATASET_API_KEY", "")
+
+# File JSON {ticker: prezzo} per il provider fixture (test/sviluppo locale)
+QUOTE_FIXTURE_FILE = os.getenv("QUOTE_FIXTURE_FILE", "")
+
+# Massimo numero di simboli per singola richiesta FMP /quote
+FMP_QUOTE_CHUNK = 100
+
+# Richieste parallele al provider per un fetch bulk (blocchi FMP, thread yfinance)
+QUOTE_FETCH_WORKERS = int(os.getenv("QUOTE_FETCH_WORKERS", "4"))
+
+# Cache quotazioni condivisa da tutte le sessioni Streamlit del processo
+QUOTE_CACHE_TTL = int(os.getenv("QUOTE_CACHE_TTL", "60"))              # secondi di freschezza
+QUOTE_CACHE_STALE_TTL = int(os.getenv("QUOTE_CACHE_STALE_TTL", "300"))  # finestra stale-while-revalidate
+QUOTE_CACHE_MAXSIZE = int(os.getenv("QUOTE_CACHE_MAXSIZE", "2000"))     # simboli massimi (LRU)
+
+_fixture_prices = {}
+
+_quote_cache = OrderedDict()  # ticker -> (prezzo, timestamp monotonic)
+_quote_cache_lock = threading.Lock()
+_refreshing = set()
+_quote_cache_stats = {
+    'hits': 0,
+    'stale_hits': 0,
+    'misses': 0,
+    'refreshes': 0,
+    'evictions': 0,
+}
+
+
+# ========================================
+# PROVIDER
+# ========================================
+
+def fetch_quotes_yfinance(symbols, workers=None):
+    """
+    Scarica gli ultimi prezzi con un'unica chiamata yf.download.
+
+    Args:
+        symbols: Lista di ticker (univoci, maiuscoli)
+        workers: Thread di download di yfinance (default: QUOTE_FETCH_WORKERS)
+
+    Returns:
+        dict: {ticker: prezzo} solo per i ticker trovati
+    """
+    data = yf.download(
+        symbols,
+        period="5d",
+        interval="1d",
+        group_by="column",
+        auto_adjust=False,
+        progress=False,
+        threads=max(1, workers or QUOTE_FETCH_WORKERS)
+    )
+
+    if data is None or data.empty:
+        return {}
+
+    closes = data['Close']
+
+    # Con un solo ticker alcune versioni di yfinance ritornano una Series
+    if not hasattr(closes, 'columns'):
+        closes = closes.to_frame(name=symbols[0])
+
+    last = closes.ffill().iloc[-1]
+
+    return {
+        str(ticker).upper(): float(price)
+        for ticker, price in last.items()
+        if price == price  # scarta NaN
+    }
+
+
+def _fetch_fmp_chunk(chunk):
+    url = f"https://financialmodelingprep.com/api/v3/quote/{','.join(chunk)}?apikey={FMP_API_KEY}"
+    response = requests.get(url, timeout=10)
+    response.raise_for_status()
+    data = response.json()
+
+    if not isinstance(data, list):
+        return {}
+    return {
+        quote['symbol'].upper(): float(quote['price'])
+        for quote in data
+        if quote.get('symbol') and quote.get('price') is not None
+    }
+
+
+def fetch_quotes_fmp(symbols, workers=None):
+    """
+    Scarica le quotazioni da FMP con /quote/A,B,C: una richiesta per blocco
+    di FMP_QUOTE_CHUNK simboli, blocchi in parallelo.
+
+    Args:
+        symbols: Lista di ticker (univoci, maiuscoli)
+        workers: Richieste parallele (default: QUOTE_FETCH_WORKERS)
+
+    Returns:
+        dict: {ticker: prezzo} solo per i ticker trovati
+    """
+    if not FMP_API_KEY:
+        raise RuntimeError("API key FMP non configurata")
+
+    chunks = [symbols[i:i + FMP_QUOTE_CHUNK] for i in range(0, len(symbols), FMP_QUOTE_CHUNK)]
+    workers = max(1, min(workers or QUOTE_FETCH_WORKERS, len(chunks)))
+
+    prices = {}
+    if workers == 1:
+        for chunk in chunks:
+            prices.update(_fetch_fmp_chunk(chunk))
+        return prices
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk_prices in executor.map(_fetch_fmp_chunk, chunks):
+            prices.update(chunk_prices)
+
+    return prices
+
+
+def set_fixture_prices(prices):
+    """Imposta i prezzi del provider fixture (sostituisce quelli esistenti)."""
+    global _fixture_prices
+    _fixture_prices = {t.upper(): float(p) for t, p in prices.items()}
+
+
+def fetch_quotes_fixture(symbols, workers=None):
+    """
+    Ritorna prezzi statici da memoria o da QUOTE_FIXTURE_FILE.
+    Nessuna chiamata di rete: pensato per test e sviluppo locale.
+    """
+    if not _fixture_prices and QUOTE_FIXTURE_FILE:
+        with open(QUOTE_FIXTURE_FILE) as f:
+            set_fixture_prices(json.load(f))
+
+    return {s: _fixture_prices[s] for s in symbols if s in _fixture_prices}
+
+
+QUOTE_PROVIDERS = {
+    'yfinance': fetch_quotes_yfinance,
+    'fmp': fetch_quotes_fmp,
+    'fixture': fetch_quotes_fixture,
+}
+
+
+def register_quote_provider(name, fetch_fn):
+    """
+    Registra un provider di quotazioni.
+
+    Args:
+        name: Nome del provider (es. 'yfinance')
+        fetch_fn: Funzione lista ticker -> dict {ticker: prezzo}; se accetta
+                  `workers` riceve il parallelismo richiesto dal chiamante
+    """
+    QUOTE_PROVIDERS[name] = fetch_fn
+
+
+# ========================================
+# ENGINE
+# ========================================
+
+def normalize_tickers(tickers):
+    """Ticker maiuscoli e senza duplicati, mantenendo l'ordine."""
+    return list(dict.fromkeys(str(t).strip().upper() for t in tickers if t))
+
+
+def fetch_quotes(symbols, provider=None, workers=None):
+    """
+    Scarica le quotazioni di tutti i simboli con il provider scelto.
+    In caso di errore ritorna un dict vuoto (i prezzi mancanti valgono 0).
+
+    Args:
+        workers: Richieste parallele del provider (default: QUOTE_FETCH_WORKERS)
+    """
+    provider = provider or QUOTE_PROVIDER
+    fetch_fn = QUOTE_PROVIDERS.get(provider)
+
+    if fetch_fn is None:
+        raise ValueError(f"Provider quotazioni sconosciuto: {provider}")
+
+    if not symbols:
+        return {}
+
+    try:
+        if workers is None:
+            return fetch_fn(symbols)
+        return fetch_fn(symbols, workers=workers)
+    except Exception as e:
+        print(f"Errore recupero quotazioni ({provider}): {e}")
+        return {}
+
+
+def get_price_vector(tickers, provider=None, use_cache=True, workers=None):
+    """
+    Prezzi correnti come vettore NumPy allineato a `tickers`.
+
+    Tutti i simboli non presenti in cache vengono risolti con un'unica
+    chiamata bulk al provider, anche se la lista contiene duplicati.
+
+    Args:
+        tickers: Lista di ticker
+        provider: Nome provider (default: QUOTE_PROVIDER)
+        use_cache: Se False, ignora la cache condivisa
+        workers: Richieste parallele del provider (default: QUOTE_FETCH_WORKERS)
+
+    Returns:
+        np.ndarray: Prezzi float64 (0 per i ticker non trovati)
+    """
+    keys = [str(t).strip().upper() for t in tickers]
+    symbols = normalize_tickers(keys)
+
+    if use_cache:
+        quotes = get_cached_quotes(symbols, provider, workers)
+    else:
+        quotes = fetch_quotes(symbols, provider, workers)
+
+    return np.fromiter(
+        (quotes.get(k, 0.0) for k in keys),
+        dtype=np.float64,
+        count=len(keys)
+    )
+
+
+# ========================================
+# CACHE CONDIVISA (TTL + LRU + STALE-WHILE-REVALIDATE)
+# ========================================
+
+def _store_quotes(quotes):
+    """Salva quotazioni in cache ed elimina le meno usate oltre il limite."""
+    now = time.monotonic()
+
+    with _quote_cache_lock:
+        for symbol, price in quotes.items():
+            _quote_cache[symbol] = (price, now)
+            _quote_cache.move_to_end(symbol)
+
+        while len(_quote_cache) > QUOTE_CACHE_MAXSIZE:
+            _quote_cache.popitem(last=False)
+            _quote_cache_stats['evictions'] += 1
+
+
+def _refresh_quotes(symbols, provider):
+    """Aggiorna in background le quotazioni scadute già servite come stale."""
+    try:
+        quotes = fetch_quotes(symbols, provider)
+        _store_quotes(quotes)
+    finally:
+        with _quote_cache_lock:
+            _refreshing.difference_update(symbols)
+            _quote_cache_stats['refreshes'] += 1
+
+
+def get_cached_quotes(symbols, provider=None, workers=None):
+    """
+    Quotazioni dalla cache di processo, scaricando solo i simboli mancanti.
+
+    - Entro QUOTE_CACHE_TTL il prezzo è servito dalla cache.
+    - Entro QUOTE_CACHE_STALE_TTL ulteriori secondi il prezzo stale è servito
+      subito e un thread in background lo aggiorna (una sola volta per simbolo).
+    - Oltre, il simbolo viene riscaricato insieme agli altri mancanti.
+
+    Args:
+        symbols: Lista di ticker univoci e maiuscoli
+        provider: Nome provider (default: QUOTE_PROVIDER)
+        workers: Richieste parallele per i simboli mancanti
+
+    Returns:
+        dict: {ticker: prezzo}
+    """
+    now = time.monotonic()
+    quotes = {}
+    missing = []
+    to_refresh = []
+
+    with _quote_cache_lock:
+        for symbol in symbols:
+            entry = _quote_cache.get(symbol)
+
+            if entry is not None:
+                price, fetched_at = entry
+                age = now - fetched_at
+
+                if age <= QUOTE_CACHE_TTL:
+                    quotes[symbol] = price
+                    _quote_cache.move_to_end(symbol)
+                    _quote_cache_stats['hits'] += 1
+                    continue
+
+                if age <= QUOTE_CACHE_TTL + QUOTE_CACHE_STALE_TTL:
+                    quotes[symbol] = price
+                    _quote_cache.move_to_end(symbol)
+                    _quote_cache_stats['stale_hits'] += 1
+                    if symbol not in _refreshing:
+                        _refreshing.add(symbol)
+                        to_refresh.append(symbol)
+                    continue
+
+            missing.append(symbol)
+            _quote_cache_stats['misses'] += 1
+
+    if missing:
+        fetched = fetch_quotes(missing, provider, workers)
+        _store_quotes(fetched)
+        quotes.update(fetched)
+
+    if to_refresh:
+        threading.Thread(
+            target=_refresh_quotes,
+            args=(to_refresh, provider),
+            daemon=True
+        ).start()
+
+    return quotes
+
+
+def get_quote_cache_stats():
+    """
+    Statistiche della cache quotazioni.
+
+    Returns:
+        dict: hits, stale_hits, misses, refreshes, evictions, size, hit_ratio
+    """
+    with _quote_cache_lock:
+        stats = dict(_quote_cache_stats)
+        stats['size'] = len(_quote_cache)
+
+    lookups = stats['hits'] + stats['stale_hits'] + stats['misses']
+    stats['hit_ratio'] = (stats['hits'] + stats['stale_hits']) / lookups if lookups else 0
+    return stats
+
+
+def clear_quote_cache():
+    """Svuota la cache quotazioni e azzera i contatori."""
+    with _quote_cache_lock:
+        _quote_cache.clear()
+        for key in _quote_cache_stats:
+            _quote_cache_stats[key] = 0
+
+
+# ========================================
+# STORICO CHIUSURE
+# ========================================
+
+def fetch_close_history(tickers, start, end=None):
+    """
+    Chiusure giornaliere di più ticker con un'unica chiamata yf.download.
+
+    Args:
+        tickers: Lista di ticker
+        start: Prima data (inclusa)
+        end: Ultima data (inclusa, default: oggi)
+
+    Returns:
+        pd.DataFrame: Indice date (datetime64, solo giorni di borsa),
+                      una colonna per ticker (NaN se assente)
+    """
+    symbols = normalize_tickers(tickers)
+    if not symbols:
+        return pd.DataFrame()
+
+    start = pd.Timestamp(start).normalize()
+    end = pd.Timestamp(end).normalize() if end is not None else pd.Timestamp.today().normalize()
+
+    data = yf.download(
+        symbols,
+        start=start.strftime('%Y-%m-%d'),
+        end=(end + pd.Timedelta(days=1)).strftime('%Y-%m-%d'),  # end esclusivo in yfinance
+        interval="1d",
+        group_by="column",
+        auto_adjust=False,
+        progress=False,
+        threads=max(1, workers or QUOTE_FETCH_WORKERS)
+    )
+
+    if data is None or data.empty:
+        return pd.DataFrame(columns=symbols, dtype=np.float64)
+
+    closes = data['Close']
+
+    # Con un solo ticker alcune versioni di yfinance ritornano una Series
+    if not hasattr(closes, 'columns'):
+        closes = closes.to_frame(name=symbols[0])
+
+    closes.columns = [str(c).upper() for c in closes.columns]
+    closes.index = pd.DatetimeIndex(closes.index).tz_localize(None).normalize()
+
+    return closes.reindex(columns=symbols).astype(np.float64).sort_index()
+
+
+def fetch_bar_history(tickers, start, end=None):
+    """
+    Barre giornaliere OHLCV di più ticker con un'unica chiamata yf.download.
+
+    Args:
+        tickers: Lista di ticker
+        start: Prima data (inclusa)
+        end: Ultima data (inclusa, default: oggi)
+
+    Returns:
+        dict: {ticker: DataFrame con date, open, high, low, close, volume}
+              solo per i ticker con dati
+    """
+    symbols = normalize_tickers(tickers)
+    if not symbols:
+        return {}
+
+    start = pd.Timestamp(start).normalize()
+    end = pd.Timestamp(end).normalize() if end is not None else pd.Timestamp.today().normalize()
+
+    data = yf.download(
+        symbols,
+        start=start.strftime('%Y-%m-%d'),
+        end=(end + pd.Timedelta(days=1)).strftime('%Y-%m-%d'),  # end esclusivo in yfinance
+        interval="1d",
+        group_by="ticker",
+        auto_adjust=False,
+        progress=False,
+        threads=max(1, workers or QUOTE_FETCH_WORKERS)
+    )
+
+    if data is None or data.empty:
+        return {}
+
+    dates = pd.DatetimeIndex(data.index).tz_localize(None).normalize()
+    fields = {'Open': 'open', 'High': 'high', 'Low': 'low', 'Close': 'close', 'Volume': 'volume'}
+    result = {}
+
+    for symbol in symbols:
+        # Con un solo ticker alcune versioni di yfinance non usano il MultiIndex
+        if isinstance(data.columns, pd.MultiIndex):
+            if symbol not in data.columns.get_level_values(0):
+                continue
+            frame = data[symbol]
+        else:
+            frame = data
+
+        bars = pd.DataFrame({
+            name: frame[column].to_numpy(dtype=np.float64) for column, name in fields.items()
+        })
+        bars.insert(0, 'date', dates)
+        bars = bars.dropna(subset=['close'])
+
+        if not bars.empty:
+            result[symbol] = bars.reset_index(drop=True)
+
+    return result
@@ -0,0 +1,294 @@
+from database.db_connection import execute_query
+from database.fx import BASE_CURRENCY, get_fx_history, normalize_currency
+from collections import OrderedDict
+from datetime import date, timedelta
+import threading
+import numpy as np
+import pandas as pd
+
+# Risultati in cache per portafoglio e intervallo (processo Streamlit)
+RETURNS_CACHE_MAXSIZE = 256
+
+# Solver XIRR
+XIRR_TOLERANCE = 1e-9
+XIRR_MAX_ITERATIONS = 50
+
+_returns_cache = OrderedDict()  # chiave -> risultato
+_returns_cache_lock = threading.Lock()
+
+
+# ========================================
+# DATI
+# ========================================
+
+def load_snapshot_values(portfolio_id, start, end):
+    """Valori giornalieri da portfolio_snapshots tra start ed end (inclusi)."""
+    rows = execute_query("""
+        SELECT snapshot_date, total_value
+        FROM portfolio_snapshots
+        WHERE portfolio_id = %s AND snapshot_date BETWEEN %s AND %s
+        ORDER BY snapshot_date
+    """, (portfolio_id, start, end)) or []
+
+    dates = np.array([np.datetime64(r['snapshot_date'], 'D') for r in rows], dtype='datetime64[D]')
+    values = np.array([float(r['total_value']) for r in rows], dtype=np.float64)
+    return dates, values
+
+
+def load_cash_flows(portfolio_id, start, end):
+    """
+    Flussi netti giornalieri verso il portafoglio dalle transazioni
+    (BUY = versamento, SELL e DIVIDEND = prelievo, commissioni incluse),
+    convertiti nella valuta base degli snapshot al cambio del giorno.
+    Il dividendo esce dal valore del portafoglio come una vendita: contato
+    come prelievo, entra nel rendimento.
+
+    Returns:
+        tuple: (date, importi) come array
+    """
+    rows = execute_query("""
+        SELECT transaction_date, currency,
+               SUM(CASE WHEN transaction_type = 'BUY'
+                        THEN shares * price + COALESCE(fees, 0)
+                        WHEN transaction_type = 'DIVIDEND'
+                        THEN -(CASE WHEN shares > 0 THEN shares * price ELSE price END - COALESCE(fees, 0))
+                        ELSE -(shares * price - COALESCE(fees, 0)) END) AS amount
+        FROM transactions
+        WHERE portfolio_id = %s
+            AND transaction_type IN ('BUY', 'SELL', 'DIVIDEND')
+            AND transaction_date BETWEEN %s AND %s
+        GROUP BY transaction_date, currency
+        ORDER BY transaction_date
+    """, (portfolio_id, start, end)) or []
+
+    dates = np.array([np.datetime64(r['transaction_date'], 'D') for r in rows], dtype='datetime64[D]')
+    amounts = np.array([float(r['amount']) for r in rows], dtype=np.float64)
+    currencies = [normalize_currency(r['currency']) for r in rows]
+
+    if any(c != BASE_CURRENCY for c in currencies):
+        fx = get_fx_history(currencies, start, end)
+        index = pd.DatetimeIndex(dates)
+        fx = fx.reindex(fx.index.union(index.unique())).ffill().bfill().reindex(index)
+        amounts = amounts * fx.to_numpy(dtype=np.float64)[np.arange(len(rows)),
+                                                          fx.columns.get_indexer(currencies)]
+
+    # Una riga per data
+    dates, inverse = np.unique(dates, return_inverse=True)
+    amounts = np.bincount(inverse, weights=amounts, minlength=len(dates))
+    return dates, amounts
+
+
+def load_returns_version(portfolio_id, start, end):
+    """
+    Versione dei dati di input in un solo round trip: cambia se cambia
+    uno snapshot dell'intervallo o se viene registrata una transazione.
+    """
+    result = execute_query("""
+        SELECT
+            (SELECT COUNT(*) || ':' || COALESCE(MAX(snapshot_date)::text, '') || ':' ||
+                    COALESCE(SUM(total_value), 0)::text
+             FROM portfolio_snapshots
+             WHERE portfolio_id = %s AND snapshot_date BETWEEN %s AND %s) AS snapshots,
+            (SELECT COALESCE(MAX(id), 0) || ':' || COUNT(*)
+             FROM transactions
+             WHERE portfolio_id = %s) AS transactions
+    """, (portfolio_id, start, end, portfolio_id))
+
+    return (result[0]['snapshots'], result[0]['transactions']) if result else None
+
+
+# ========================================
+# CALCOLO
+# ========================================
+
+def flows_per_period(dates, flow_dates, flow_amounts):
+    """
+    Somma dei flussi tra due valorizzazioni consecutive: il flusso del giorno
+    d finisce nel primo snapshot con data >= d (l'acquisto è già nel valore).
+    Il primo snapshot non riceve flussi (è il capitale iniziale).
+    """
+    flows = np.zeros(len(dates), dtype=np.float64)
+    if not len(flow_dates) or not len(dates):
+        return flows
+
+    index = np.searchsorted(dates, flow_dates, side='left')
+    keep = (index > 0) & (index < len(dates))
+    np.add.at(flows, index[keep], flow_amounts[keep])
+    return flows
+
+
+def daily_twr(values, flows):
+    """
+    Rendimento time-weighted con correzione per i flussi.
+
+    r_t = (V_t - F_t) / V_{t-1} - 1, poi prodotto cumulato dei (1 + r_t).
+
+    Returns:
+        tuple: (rendimenti giornalieri, TWR cumulato) allineati ai valori
+    """
+    returns = np.zeros(len(values), dtype=np.float64)
+    if len(values) < 2:
+        return returns, returns.copy()
+
+    previous = values[:-1]
+    np.divide(values[1:] - flows[1:], previous, out=returns[1:], where=previous > 0)
+    returns[1:] = np.where(previous > 0, returns[1:] - 1, 0.0)
+
+    return returns, np.cumprod(1 + returns) - 1
+
+
+def xirr(dates, amounts, guess=0.1):
+    """
+    Tasso interno di rendimento annuo per flussi a date irregolari.
+
+    Newton sul valore attuale (NPV e derivata vettoriali); se non converge
+    ripiega sulla bisezione in [-99.99%, 1000%].
+
+    Args:
+        dates: Date dei flussi (datetime64[D])
+        amounts: Importi (negativi = uscite dell'investitore)
+
+    Returns:
+        float: Tasso annuo (0.12 = 12%) o None se non esiste
+    """
+    amounts = np.asarray(amounts, dtype=np.float64)
+    if len(amounts) < 2 or not (np.any(amounts > 0) and np.any(amounts < 0)):
+        return None
+
+    years = (np.asarray(dates, dtype='datetime64[D]') - np.datetime64(dates[0], 'D')).astype(np.float64) / 365.0
+
+    def npv(rate):
+        return np.sum(amounts * (1 + rate) ** -years)
+
+    def d_npv(rate):
+        return np.sum(-years * amounts * (1 + rate) ** (-years - 1))
+
+    rate = guess
+    for _ in range(XIRR_MAX_ITERATIONS):
+        derivative = d_npv(rate)
+        if derivative == 0 or not np.isfinite(derivative):
+            break
+        step = npv(rate) / derivative
+        rate -= step
+        if rate <= -1 or not np.isfinite(rate):
+            break
+        if abs(step) < XIRR_TOLERANCE:
+            return float(rate)
+
+    # Bisezione
+    low, high = -0.9999, 10.0
+    f_low, f_high = npv(low), npv(high)
+    if np.sign(f_low) == np.sign(f_high):
+        return None
+
+    for _ in range(200):
+        mid = (low + high) / 2
+        f_mid = npv(mid)
+        if abs(f_mid) < XIRR_TOLERANCE or high - low < XIRR_TOLERANCE:
+            return float(mid)
+        if np.sign(f_mid) == np.sign(f_low):
+            low, f_low = mid, f_mid
+        else:
+            high = mid
+
+    return float((low + high) / 2)
+
+
+def compute_returns(dates, values, flow_dates, flow_amounts):
+    """
+    TWR e XIRR da valorizzazioni giornaliere e flussi.
+
+    Returns:
+        dict: dates, values, flows, daily_returns, twr_series, twr,
+              twr_annualized, xirr (annuo), mwr (sul periodo), net_flows,
+              simple_return
+    """
+    flows = flows_per_period(dates, flow_dates, flow_amounts)
+    daily_returns, twr_series = daily_twr(values, flows)
+
+    result = {
+        'dates': dates,
+        'values': values,
+        'flows': flows,
+        'daily_returns': daily_returns,
+        'twr_series': twr_series,
+        'twr': None,
+        'twr_annualized': None,
+        'xirr': None,
+        'mwr': None,
+        'net_flows': float(flows.sum()),
+        'simple_return': None,
+    }
+
+    if len(values) < 2 or values[0] <= 0:
+        return result
+
+    span_days = int((dates[-1] - dates[0]).astype(np.int64))
+    twr = float(twr_series[-1])
+    result['twr'] = twr
+    result['twr_annualized'] = (1 + twr) ** (365.0 / span_days) - 1 if span_days >= 365 else None
+    result['simple_return'] = float((values[-1] - values[0]) / values[0])
+
+    # Flussi dal punto di vista dell'investitore: capitale iniziale e
+    # versamenti in uscita, valore finale in entrata
+    period_flows = flows[1:]
+    cash_flows = np.concatenate([[-values[0]], -period_flows[period_flows != 0], [values[-1]]])
+    cash_dates = np.concatenate([dates[:1], dates[1:][period_flows != 0], dates[-1:]])
+    rate = xirr(cash_dates, cash_flows)
+    result['xirr'] = rate
+    result['mwr'] = (1 + rate) ** (span_days / 365.0) - 1 if rate is not None else None
+
+    return result
+
+
+# ========================================
+# API CON CACHE
+# ========================================
+
+def get_portfolio_returns(portfolio_id, days=90, end=None):
+    """
+    Rendimenti TWR/XIRR di un portafoglio sugli ultimi `days` giorni.
+
+    Il risultato è in cache per (portafoglio, intervallo, versione dei dati):
+    un rerun della pagina costa una sola query aggregata.
+
+    Returns:
+        dict: vedi compute_returns
+    """
+    end = end or date.today()
+    start = end - timedelta(days=days)
+
+    key = (portfolio_id, start, end, load_returns_version(portfolio_id, start, end))
+
+    with _returns_cache_lock:
+        if key in _returns_cache:
+            _returns_cache.move_to_end(key)
+            return _returns_cache[key]
+
+    dates, values = load_snapshot_values(portfolio_id, start, end)
+    flow_dates, flow_amounts = load_cash_flows(portfolio_id, start, end)
+    result = compute_returns(dates, values, flow_dates, flow_amounts)
+
+    with _returns_cache_lock:
+        _returns_cache[key] = result
+        while len(_returns_cache) > RETURNS_CACHE_MAXSIZE:
+            _returns_cache.popitem(last=False)
+
+    return result
+
+
+def returns_to_frame(result):
+    """DataFrame giornaliero (date, valore, flussi, rendimento, TWR cumulato) per i grafici."""
+    return pd.DataFrame({
+        'date': pd.to_datetime(result['dates']),
+        'total_value': result['values'],
+        'flow': result['flows'],
+        'daily_return': result['daily_returns'],
+        'twr': result['twr_series'],
+    })
+
+
+def clear_returns_cache():
+    """Svuota la cache dei rendimenti."""
+    with _returns_cache_lock:
+        _returns_cache.clear()
@@ -0,0 +1,268 @@
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, timedelta
+from statistics import NormalDist
+import numpy as np
+import pandas as pd
+from database.price_store import get_close_matrix
+from database.quotes import normalize_tickers
+
+# Benchmark per il beta
+RISK_BENCHMARK = os.getenv("RISK_BENCHMARK", "SPY")
+
+# Tasso privo di rischio annuo per Sharpe/Sortino
+RISK_FREE_RATE = float(os.getenv("RISK_FREE_RATE", "0.02"))
+
+TRADING_DAYS = 252
+ROLLING_WINDOW = 21          # giorni per la volatilità mobile
+VAR_CONFIDENCE = 0.95
+
+RISK_CACHE_MAXSIZE = 128
+
+_risk_cache = OrderedDict()  # (ticker set, window, benchmark, giorno) -> matrice rendimenti
+_risk_cache_lock = threading.Lock()
+
+
+# ========================================
+# MATRICE RENDIMENTI (CACHE)
+# ========================================
+
+def get_returns_matrix(tickers, window=TRADING_DAYS, benchmark=RISK_BENCHMARK):
+    """
+    Rendimenti giornalieri degli ultimi `window` giorni di borsa per i ticker
+    e il benchmark, dall'archivio prezzi locale.
+
+    In cache per (insieme di ticker, window, benchmark) e giorno corrente:
+    la pagina e il prompt AI condividono lo stesso calcolo.
+
+    Returns:
+        dict: dates, tickers, returns (giorni x ticker), benchmark (vettore
+              o None), ticker_volatility, ticker_beta, correlation
+    """
+    symbols = tuple(sorted(normalize_tickers(tickers)))
+    key = (symbols, window, benchmark, date.today())
+
+    with _risk_cache_lock:
+        if key in _risk_cache:
+            _risk_cache.move_to_end(key)
+            return _risk_cache[key]
+
+    end = date.today()
+    start = end - timedelta(days=int(window * 1.5) + 10)  # giorni di calendario per `window` sedute
+    all_symbols = list(symbols) + ([benchmark] if benchmark and benchmark not in symbols else [])
+
+    closes = get_close_matrix(all_symbols, start, end).reindex(columns=all_symbols)
+    returns = closes.ffill().pct_change().iloc[1:].tail(window)
+
+    # Titoli quotati dopo l'inizio della finestra: rendimento nullo prima della quotazione
+    matrix = returns[list(symbols)].to_numpy(dtype=np.float64)
+    matrix = np.nan_to_num(matrix, nan=0.0, posinf=0.0, neginf=0.0)
+
+    bench = None
+    if benchmark:
+        bench = np.nan_to_num(returns[benchmark].to_numpy(dtype=np.float64))
+
+    result = {
+        'dates': returns.index.to_numpy(),
+        'tickers': list(symbols),
+        'returns': matrix,
+        'benchmark': bench,
+        'ticker_volatility': annualized_volatility(matrix),
+        'ticker_beta': beta(matrix, bench) if bench is not None else None,
+        'correlation': correlation_matrix(matrix, list(symbols)),
+    }
+
+    with _risk_cache_lock:
+        _risk_cache[key] = result
+        while len(_risk_cache) > RISK_CACHE_MAXSIZE:
+            _risk_cache.popitem(last=False)
+
+    return result
+
+
+def clear_risk_cache():
+    """Svuota la cache delle matrici di rendimento."""
+    with _risk_cache_lock:
+        _risk_cache.clear()
+
+
+# ========================================
+# METRICHE (VETTORIALI)
+# ========================================
+
+def annualized_volatility(returns):
+    """Deviazione standard annualizzata (per colonna se 2D)."""
+    if len(returns) < 2:
+        return np.zeros(returns.shape[1:]) if returns.ndim > 1 else 0.0
+    return np.std(returns, axis=0, ddof=1) * np.sqrt(TRADING_DAYS)
+
+
+def rolling_volatility(returns, window=ROLLING_WINDOW):
+    """
+    Volatilità mobile annualizzata di una serie con somme cumulate
+    (O(n), nessun loop sulle finestre). I primi window-1 valori sono NaN.
+    """
+    n = len(returns)
+    out = np.full(n, np.nan)
+    if n < window or window < 2:
+        return out
+
+    s1 = np.concatenate([[0.0], np.cumsum(returns)])
+    s2 = np.concatenate([[0.0], np.cumsum(returns ** 2)])
+    sums = s1[window:] - s1[:-window]
+    squares = s2[window:] - s2[:-window]
+    variance = (squares - sums ** 2 / window) / (window - 1)
+    out[window - 1:] = np.sqrt(np.maximum(variance, 0.0)) * np.sqrt(TRADING_DAYS)
+    return out
+
+
+def max_drawdown(returns):
+    """
+    Massimo drawdown della serie cumulata.
+
+    Returns:
+        tuple: (drawdown massimo <= 0, serie dei drawdown)
+    """
+    if not len(returns):
+        return 0.0, np.zeros(0)
+    wealth = np.cumprod(1 + returns)
+    drawdowns = wealth / np.maximum.accumulate(wealth) - 1
+    return float(drawdowns.min()), drawdowns
+
+
+def sharpe_ratio(returns, risk_free=RISK_FREE_RATE):
+    """Sharpe annualizzato."""
+    excess = returns - risk_free / TRADING_DAYS
+    std = np.std(excess, ddof=1) if len(excess) > 1 else 0.0
+    return float(np.mean(excess) / std * np.sqrt(TRADING_DAYS)) if std > 0 else None
+
+
+def sortino_ratio(returns, risk_free=RISK_FREE_RATE):
+    """Sortino annualizzato (solo la deviazione dei rendimenti sotto il target)."""
+    excess = returns - risk_free / TRADING_DAYS
+    downside = np.sqrt(np.mean(np.minimum(excess, 0.0) ** 2)) if len(excess) else 0.0
+    return float(np.mean(excess) / downside * np.sqrt(TRADING_DAYS)) if downside > 0 else None
+
+
+def beta(returns, benchmark_returns):
+    """Beta verso il benchmark (per colonna se 2D)."""
+    var = np.var(benchmark_returns, ddof=1) if len(benchmark_returns) > 1 else 0.0
+    if var <= 0:
+        return np.zeros(returns.shape[1:]) if returns.ndim > 1 else 0.0
+
+    centered = returns - returns.mean(axis=0)
+    bench = benchmark_returns - benchmark_returns.mean()
+    cov = bench @ centered / (len(bench) - 1)
+    return cov / var
+
+
+def value_at_risk(returns, confidence=VAR_CONFIDENCE):
+    """
+    VaR giornaliero (perdita positiva) storico e parametrico (normale).
+
+    Returns:
+        tuple: (VaR storico, VaR parametrico)
+    """
+    if len(returns) < 2:
+        return None, None
+
+    historical = -np.percentile(returns, (1 - confidence) * 100)
+    z = NormalDist().inv_cdf(1 - confidence)
+    parametric = -(np.mean(returns) + z * np.std(returns, ddof=1))
+    return float(historical), float(parametric)
+
+
+def correlation_matrix(returns, tickers):
+    """Matrice di correlazione tra i titoli (DataFrame ticker x ticker)."""
+    if returns.shape[0] < 2 or returns.shape[1] == 0:
+        return pd.DataFrame(index=tickers, columns=tickers, dtype=np.float64)
+
+    std = returns.std(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = np.corrcoef(returns, rowvar=False) if returns.shape[1] > 1 else np.ones((1, 1))
+    corr = np.atleast_2d(corr)
+    corr[std == 0, :] = np.nan
+    corr[:, std == 0] = np.nan
+    return pd.DataFrame(corr, index=tickers, columns=tickers)
+
+
+# ========================================
+# RISCHIO DI PORTAFOGLIO
+# ========================================
+
+def compute_portfolio_risk(tickers, weights, window=TRADING_DAYS, benchmark=RISK_BENCHMARK):
+    """
+    Metriche di rischio del portafoglio con i pesi correnti.
+
+    Args:
+        tickers: Ticker delle posizioni
+        weights: Pesi (o valori correnti) allineati ai ticker
+        window: Giorni di borsa considerati
+
+    Returns:
+        dict: volatility, rolling_volatility, max_drawdown, drawdowns,
+              sharpe, sortino, beta, var_historical, var_parametric,
+              correlation, ticker_volatility, ticker_beta, dates, observations
+              (None se mancano i prezzi storici)
+    """
+    weights_by_ticker = {}
+    for ticker, weight in zip(tickers, weights):
+        ticker = ticker.upper()
+        weights_by_ticker[ticker] = weights_by_ticker.get(ticker, 0.0) + float(weight)
+
+    total = sum(weights_by_ticker.values())
+    if not weights_by_ticker or total <= 0:
+        return None
+
+    matrix = get_returns_matrix(list(weights_by_ticker), window=window, benchmark=benchmark)
+    if len(matrix['dates']) < 2:
+        return None
+
+    w = np.array([weights_by_ticker[t] for t in matrix['tickers']], dtype=np.float64) / total
+    portfolio = matrix['returns'] @ w
+
+    drawdown, drawdowns = max_drawdown(portfolio)
+    var_historical, var_parametric = value_at_risk(portfolio)
+    bench = matrix['benchmark']
+
+    return {
+        'dates': matrix['dates'],
+        'observations': len(portfolio),
+        'volatility': float(annualized_volatility(portfolio)),
+        'rolling_volatility': rolling_volatility(portfolio),
+        'max_drawdown': drawdown,
+        'drawdowns': drawdowns,
+        'sharpe': sharpe_ratio(portfolio),
+        'sortino': sortino_ratio(portfolio),
+        'beta': float(beta(portfolio, bench)) if bench is not None else None,
+        'benchmark': benchmark,
+        'var_historical': var_historical,
+        'var_parametric': var_parametric,
+        'var_confidence': VAR_CONFIDENCE,
+        'correlation': matrix['correlation'],
+        'ticker_volatility': dict(zip(matrix['tickers'], np.atleast_1d(matrix['ticker_volatility']).tolist())),
+        'ticker_beta': (dict(zip(matrix['tickers'], np.atleast_1d(matrix['ticker_beta']).tolist()))
+                        if matrix['ticker_beta'] is not None else {}),
+    }
+
+
+def get_portfolio_risk(perf, window=TRADING_DAYS):
+    """
+    Rischio del portafoglio da un risultato di calculate_portfolio_performance
+    (pesi = valori correnti delle posizioni).
+    """
+    df = perf.get('positions_df') if perf else None
+    if df is None or df.empty:
+        return None
+
+    # Posizioni senza cambio: valore NaN, fuori dai pesi
+    df = df[np.isfinite(df['current_value'].to_numpy(dtype=np.float64))]
+    if df.empty:
+        return None
+
+    try:
+        return compute_portfolio_risk(df['ticker'].tolist(), df['current_value'].to_numpy(), window=window)
+    except Exception as e:
+        print(f"Errore calcolo rischio: {e}")
+        return None
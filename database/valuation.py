@@ -0,0 +1,174 @@
+import numpy as np
+import pandas as pd
+
+# Colonne del DataFrame ritornato da value_positions
+VALUATION_COLUMNS = [
+    'ticker', 'company_name', 'sector', 'currency',
+    'shares', 'avg_price', 'current_price', 'fx_rate',
+    'invested', 'current_value', 'gain_loss', 'gain_loss_pct', 'weight'
+]
+
+
+def _as_array(values, length, default=1.0):
+    """Vettore float64 di lunghezza `length` (scalare/None -> costante)."""
+    if values is None:
+        return np.full(length, default, dtype=np.float64)
+    arr = np.asarray(values, dtype=np.float64)
+    if arr.ndim == 0:
+        return np.full(length, float(arr), dtype=np.float64)
+    return arr
+
+
+def _safe_pct(numerator, denominator):
+    """numerator / denominator * 100, 0 dove il denominatore è <= 0."""
+    return np.divide(
+        numerator * 100, denominator,
+        out=np.zeros_like(numerator, dtype=np.float64),
+        where=denominator > 0
+    )
+
+
+def _cost_fx(cost_fx_rates, fx):
+    """Cambi per il costo: quelli di carico dove disponibili, altrimenti il corrente."""
+    if cost_fx_rates is None:
+        return fx
+    cost_fx = _as_array(cost_fx_rates, len(fx))
+    return np.where(np.isfinite(cost_fx) & np.isfinite(fx), cost_fx, fx)
+
+
+def value_positions(positions, prices, fx_rates=None, cost_fx_rates=None):
+    """
+    Valorizza tutte le posizioni in un'unica passata NumPy.
+
+    Args:
+        positions: DataFrame o lista di dict con ticker, shares, avg_price
+                   (opzionali: company_name, sector, currency)
+        prices: Prezzi correnti allineati alle posizioni (valuta del titolo)
+        fx_rates: Tassi di conversione verso la valuta base (default: 1);
+                  NaN = cambio mancante
+        cost_fx_rates: Cambi di carico (alle date di acquisto) per il costo;
+                       NaN o assente = cambio corrente
+
+    Returns:
+        pd.DataFrame: Una riga per posizione con colonne VALUATION_COLUMNS.
+                      invested/current_value/gain_loss sono in valuta base
+                      (NaN per le posizioni senza cambio, escluse dai pesi).
+    """
+    df = positions if isinstance(positions, pd.DataFrame) else pd.DataFrame(list(positions))
+
+    if df.empty:
+        return pd.DataFrame(columns=VALUATION_COLUMNS)
+
+    n = len(df)
+    shares = df['shares'].to_numpy(dtype=np.float64)
+    avg_price = df['avg_price'].to_numpy(dtype=np.float64)
+    price = _as_array(prices, n, default=0.0)
+    fx = _as_array(fx_rates, n)
+    cost_fx = _cost_fx(cost_fx_rates, fx)
+
+    invested = shares * avg_price * cost_fx
+    current_value = shares * price * fx
+    gain_loss = current_value - invested
+
+    total_value = np.nansum(current_value)
+    weight = current_value / total_value * 100 if total_value > 0 else np.zeros(n)
+
+    return pd.DataFrame({
+        'ticker': df['ticker'].to_numpy(),
+        'company_name': df['company_name'].to_numpy() if 'company_name' in df else None,
+        'sector': df['sector'].to_numpy() if 'sector' in df else None,
+        'currency': df['currency'].to_numpy() if 'currency' in df else None,
+        'shares': shares,
+        'avg_price': avg_price,
+        'current_price': price,
+        'fx_rate': fx,
+        'invested': invested,
+        'current_value': current_value,
+        'gain_loss': gain_loss,
+        'gain_loss_pct': _safe_pct(gain_loss, invested),
+        'weight': weight,
+    }, columns=VALUATION_COLUMNS)
+
+
+def summarize_valuation(valuation_df):
+    """
+    Totali del portafoglio da un DataFrame di value_positions.
+
+    Le posizioni senza cambio (fx_rate NaN) restano fuori dai totali, che
+    in quel caso sono parziali: missing_fx elenca le valute mancanti.
+
+    Returns:
+        dict: total_cost, current_value, gain_loss, gain_loss_pct, missing_fx
+    """
+    valued = np.isfinite(valuation_df['fx_rate'].to_numpy(dtype=np.float64))
+    total_cost = float(valuation_df['invested'].to_numpy(dtype=np.float64)[valued].sum())
+    current_value = float(valuation_df['current_value'].to_numpy(dtype=np.float64)[valued].sum())
+    gain_loss = current_value - total_cost
+
+    return {
+        'total_cost': total_cost,
+        'current_value': current_value,
+        'gain_loss': gain_loss,
+        'gain_loss_pct': (gain_loss / total_cost * 100) if total_cost > 0 else 0,
+        'missing_fx': sorted(set(valuation_df.loc[~valued, 'currency'].dropna())),
+    }
+
+
+def rollup(valuation_df, by='sector'):
+    """
+    Aggrega valore, costo e peso per una colonna (settore, valuta, ...).
+
+    Returns:
+        pd.DataFrame: by, current_value, invested, gain_loss, weight, positions
+    """
+    if valuation_df.empty:
+        return pd.DataFrame(columns=[by, 'current_value', 'invested', 'gain_loss', 'weight', 'positions'])
+
+    keys = valuation_df[by].fillna('Unknown')
+    grouped = valuation_df.groupby(keys, sort=False).agg(
+        current_value=('current_value', 'sum'),
+        invested=('invested', 'sum'),
+        gain_loss=('gain_loss', 'sum'),
+        weight=('weight', 'sum'),
+        positions=('ticker', 'size'),
+    )
+    return grouped.rename_axis(by).reset_index().sort_values('current_value', ascending=False)
+
+
+def value_portfolios(portfolio_ids, shares, avg_prices, prices, fx_rates=None, cost_fx_rates=None):
+    """
+    Totali per portafoglio da array colonnari di tutte le posizioni.
+
+    Args:
+        portfolio_ids: ID portafoglio per ogni posizione
+        shares, avg_prices, prices: Array allineati alle posizioni
+        fx_rates: Tassi verso la valuta base (default: 1; NaN = mancante)
+        cost_fx_rates: Cambi di carico per il costo (default: fx_rates)
+
+    Returns:
+        dict di array allineati a 'portfolio_id': total_value, total_cost,
+        gain_loss, gain_loss_pct, complete (False se manca il cambio di
+        almeno una posizione: totali non affidabili)
+    """
+    portfolio_ids = np.asarray(portfolio_ids)
+    shares = np.asarray(shares, dtype=np.float64)
+    fx = _as_array(fx_rates, len(shares))
+    cost_fx = np.nan_to_num(_cost_fx(cost_fx_rates, fx), nan=0.0)
+
+    ids, inverse = np.unique(portfolio_ids, return_inverse=True)
+    missing = np.bincount(inverse, weights=(~np.isfinite(fx)).astype(np.float64), minlength=len(ids)) > 0
+    fx = np.nan_to_num(fx, nan=0.0)
+    total_value = np.bincount(inverse, weights=shares * np.asarray(prices, dtype=np.float64) * fx,
+                              minlength=len(ids))
+    total_cost = np.bincount(inverse, weights=shares * np.asarray(avg_prices, dtype=np.float64) * cost_fx,
+                             minlength=len(ids))
+    gain_loss = total_value - total_cost
+
+    return {
+        'portfolio_id': ids,
+        'total_value': total_value,
+        'total_cost': total_cost,
+        'gain_loss': gain_loss,
+        'gain_loss_pct': _safe_pct(gain_loss, total_cost),
+        'complete': ~missing,
+    }
@@ -0,0 +1,348 @@
+import os
+import time
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import anthropic
+from database.portfolios import get_portfolio_positions
+from database.analytics import calculate_portfolio_performance, save_analysis, find_recent_analysis
+from database.risk import get_portfolio_risk
+from database.fx import currency_symbol
+
+# Logica dell'analisi AI senza dipendenze da Streamlit:
+# usata dalla pagina portfolio_analysis e dal worker scripts/analysis_worker.py
+
+CLAUDE_MODEL = "claude-sonnet-4-20250514"
+CLAUDE_MAX_TOKENS = 4000
+CLAUDE_TEMPERATURE = 0.7
+
+# Cache analisi: riusa un'analisi se il portafoglio non è cambiato
+AI_ANALYSIS_MAX_AGE_HOURS = float(os.getenv("AI_ANALYSIS_MAX_AGE_HOURS", "24"))
+# Variazione relativa dei prezzi sotto la quale il fingerprint non cambia
+AI_ANALYSIS_PRICE_TOLERANCE = float(os.getenv("AI_ANALYSIS_PRICE_TOLERANCE", "0.01"))
+
+DEFAULT_ANALYSIS_TYPE = "Completa (Diversificazione + Rischi + Suggerimenti)"
+
+ANALYSIS_PROMPTS = {
+    "Completa (Diversificazione + Rischi + Suggerimenti)": """Sei un analista finanziario esperto in value investing e gestione di portafoglio.
+
+Analizza questo portafoglio in modo completo e dettagliato:
+
+{portfolio_text}
+
+Fornisci un'analisi strutturata che includa:
+
+1. **📊 Diversificazione** (30% dell'analisi)
+   - Distribuzione settoriale (è adeguata?)
+   - Concentrazione geografica (se rilevante)
+   - Rischio concentrazione su singoli titoli
+   - Correlazioni tra asset
+
+2. **⚠️ Analisi Rischi** (25% dell'analisi)
+   - Esposizione a rischi specifici (settoriali, geografici, valutari)
+   - Volatilità attesa del portafoglio
+   - Rischi macro (tassi, inflazione, recessione)
+   - Eventi specifici che potrebbero impattare
+
+3. **🏆 Qualità Titoli** (25% dell'analisi)
+   - Valutazione qualitativa delle aziende
+   - Presenza di moat economici
+   - Solidità bilanci e cash flow
+   - Management quality (se rilevante)
+
+4. **💡 Suggerimenti Operativi** (20% dell'analisi)
+   - Titoli da ridurre o aumentare
+   - Nuovi settori da considerare
+   - Strategie di ribilanciamento
+   - Timing suggerito
+
+5. **🎯 Voto Complessivo** (1-10/10)
+   - Voto numerico con spiegazione dettagliata
+   - Profilo rischio/rendimento
+   - Adeguatezza per investitore medio
+
+Sii specifico, actionable e usa un tono professionale ma accessibile.""",
+    
+    "Focus Diversificazione": """Analizza la DIVERSIFICAZIONE di questo portafoglio:
+
+{portfolio_text}
+
+Focus su:
+- Distribuzione settoriale ottimale
+- Correlazioni tra asset
+- Concentrazione geografica
+- Suggerimenti per migliorare diversificazione
+- Voto diversificazione (1-10)""",
+    
+    "Focus Rischi": """Analizza i RISCHI di questo portafoglio:
+
+{portfolio_text}
+
+Focus su:
+- Rischi settoriali specifici
+- Esposizione a rischi macro
+- Volatilità attesa
+- Scenari negativi possibili
+- Strategie di mitigazione""",
+    
+    "Focus Value Investing": """Analizza questo portafoglio dal punto di vista VALUE INVESTING (Benjamin Graham, Warren Buffett):
+
+{portfolio_text}
+
+Focus su:
+- Margini di sicurezza
+- Qualità delle aziende (moat)
+- Valutazioni attuali
+- Opportunità di valore
+- Titoli sopravvalutati da ridurre""",
+    
+    "Confronto con Benchmark": """Confronta questo portafoglio con benchmark standard (S&P 500, indici settoriali):
+
+{portfolio_text}
+
+Focus su:
+- Performance vs benchmark
+- Beta e volatilità
+- Esposizione settoriale vs indici
+- Alpha generation
+- Suggerimenti per battere il mercato"""
+}
+
+
+def compute_analysis_fingerprint(df, perf, analysis_type, include_macro):
+    """
+    Hash degli input di prepare_portfolio_for_ai.
+    
+    I prezzi sono discretizzati in bucket logaritmici di ampiezza
+    AI_ANALYSIS_PRICE_TOLERANCE: piccole oscillazioni non cambiano il
+    fingerprint, una variazione reale sì.
+    """
+    positions = df.sort_values('ticker')
+    prices = np.array(
+        [perf['current_prices'].get(ticker, 0) for ticker in positions['ticker']],
+        dtype=np.float64
+    )
+    buckets = np.where(
+        prices > 0,
+        np.round(np.log(np.where(prices > 0, prices, 1)) / np.log1p(AI_ANALYSIS_PRICE_TOLERANCE)),
+        -1
+    ).astype(np.int64)
+    
+    payload = {
+        'analysis_type': analysis_type,
+        'include_macro': bool(include_macro),
+        'model': CLAUDE_MODEL,
+        'positions': [
+            [ticker, round(float(shares), 6), round(float(avg_price), 4), int(bucket)]
+            for ticker, shares, avg_price, bucket in zip(
+                positions['ticker'], positions['shares'], positions['avg_price'], buckets
+            )
+        ]
+    }
+    
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def prepare_portfolio_for_ai(df, perf, analysis_type, include_macro):
+    """Prepara dati portafoglio per Claude."""
+    
+    base_sym = currency_symbol(perf.get('base_currency'))
+    
+    output = f"""# PORTAFOGLIO DA ANALIZZARE
+
+## Metriche Generali
+- **Numero Posizioni**: {len(df)}
+- **Valuta Base**: {perf.get('base_currency', 'USD')}
+- **Valore Totale**: {base_sym}{perf['current_value']:,.2f}
+- **Costo Totale**: {base_sym}{perf['total_cost']:,.2f}
+- **Gain/Loss**: {base_sym}{perf['gain_loss']:,.2f} ({perf['gain_loss_pct']:+.2f}%)
+"""
+    
+    if perf.get('missing_fx'):
+        output += (f"- **Nota**: totali parziali, esclusi i titoli in {', '.join(perf['missing_fx'])} "
+                   f"(cambio non disponibile)\n")
+    
+    output += """
+## Composizione Dettagliata
+
+"""
+    
+    for _, row in df.iterrows():
+        current_price = perf['current_prices'].get(row['ticker'], 0)
+        current_value = row['shares'] * current_price
+        gain_loss = current_value - row['total_cost']
+        gain_loss_pct = (gain_loss / row['total_cost'] * 100) if row['total_cost'] > 0 else 0
+        sym = currency_symbol(row.get('currency'))
+        
+        output += f"""### {row['ticker']} - {row.get('company_name', 'N/A')}
+- **Azioni**: {row['shares']:.2f}
+- **Prezzo Medio Acquisto**: {sym}{row['avg_price']:.2f}
+- **Prezzo Corrente**: {sym}{current_price:.2f}
+- **Valore Posizione**: {sym}{current_value:,.2f}
+- **Peso Portafoglio**: {row['weight_%']:.1f}%
+- **P/L Posizione**: {sym}{gain_loss:,.2f} ({gain_loss_pct:+.2f}%)
+"""
+        
+        if pd.notna(row.get('sector')):
+            output += f"- **Settore**: {row['sector']}\n"
+        if pd.notna(row.get('industry')):
+            output += f"- **Industria**: {row['industry']}\n"
+        if pd.notna(row.get('notes')):
+            output += f"- **Note**: {row['notes']}\n"
+        
+        output += "\n"
+    
+    # Distribuzione settoriale
+    if 'sector' in df.columns and df['sector'].notna().any():
+        output += "\n## Distribuzione Settoriale\n\n"
+        sector_weights = df.groupby('sector')['weight_%'].sum().sort_values(ascending=False)
+        for sector, weight in sector_weights.items():
+            if pd.notna(sector):
+                output += f"- **{sector}**: {weight:.1f}%\n"
+    
+    # Metriche di rischio calcolate sullo storico prezzi (ultimo anno)
+    risk = get_portfolio_risk(perf)
+    if risk:
+        output += f"\n## Metriche di Rischio (ultimi {risk['observations']} giorni di borsa)\n\n"
+        output += f"- **Volatilità Annua**: {risk['volatility'] * 100:.1f}%\n"
+        output += f"- **Max Drawdown**: {risk['max_drawdown'] * 100:.1f}%\n"
+        if risk['sharpe'] is not None:
+            output += f"- **Sharpe**: {risk['sharpe']:.2f}\n"
+        if risk['sortino'] is not None:
+            output += f"- **Sortino**: {risk['sortino']:.2f}\n"
+        if risk['beta'] is not None:
+            output += f"- **Beta vs {risk['benchmark']}**: {risk['beta']:.2f}\n"
+        if risk['var_historical'] is not None:
+            output += (f"- **VaR giornaliero {risk['var_confidence']:.0%}**: "
+                       f"{risk['var_historical'] * 100:.2f}% storico, "
+                       f"{risk['var_parametric'] * 100:.2f}% parametrico\n")
+        
+        # Coppie di titoli più correlate
+        corr = risk['correlation']
+        if len(corr) > 1:
+            upper = corr.where(np.triu(np.ones(corr.shape, dtype=bool), k=1)).stack()
+            top_pairs = upper.sort_values(ascending=False).head(5)
+            if not top_pairs.empty:
+                output += "- **Correlazioni più alte**: " + ", ".join(
+                    f"{a}/{b} {value:.2f}" for (a, b), value in top_pairs.items()
+                ) + "\n"
+    
+    # Contesto macro (opzionale)
+    if include_macro:
+        from datetime import datetime
+        output += f"\n## Contesto Temporale\n\n"
+        output += f"- **Data Analisi**: {datetime.now().strftime('%d/%m/%Y')}\n"
+        output += "- **Contesto**: Considera il contesto economico attuale (tassi, inflazione, mercati)\n"
+    
+    return output
+
+
+def get_anthropic_api_key():
+    """
+    API key Anthropic: variabile d'ambiente ANTHROPIC_API_KEY, altrimenti
+    st.secrets se disponibile (app Streamlit).
+    """
+    api_key = os.getenv("ANTHROPIC_API_KEY")
+    if api_key:
+        return api_key
+    
+    try:
+        import streamlit as st
+        return st.secrets.get("ANTHROPIC_API_KEY")
+    except Exception:
+        return None
+
+
+def build_analysis_prompt(portfolio_text, analysis_type):
+    """Prompt completo per il tipo di analisi richiesto."""
+    prompt_template = ANALYSIS_PROMPTS.get(analysis_type, ANALYSIS_PROMPTS[DEFAULT_ANALYSIS_TYPE])
+    return prompt_template.format(portfolio_text=portfolio_text)
+
+
+def stream_claude_analysis(prompt, on_text=None, api_key=None):
+    """
+    Genera l'analisi con l'API Claude in streaming.
+    
+    Args:
+        prompt: Prompt completo (build_analysis_prompt)
+        on_text: Callback opzionale chiamata con ogni nuovo frammento di testo
+        api_key: API key (default: get_anthropic_api_key())
+        
+    Returns:
+        tuple: (testo analisi, dict con first_token_seconds e total_seconds)
+        
+    Raises:
+        RuntimeError: se l'API key non è configurata
+    """
+    api_key = api_key or get_anthropic_api_key()
+    if not api_key:
+        raise RuntimeError("API Key Anthropic non configurata")
+    
+    client = anthropic.Anthropic(api_key=api_key)
+    timings = {'first_token_seconds': None, 'total_seconds': None}
+    
+    start = time.perf_counter()
+    chunks = []
+    
+    with client.messages.stream(
+        model=CLAUDE_MODEL,
+        max_tokens=CLAUDE_MAX_TOKENS,
+        temperature=CLAUDE_TEMPERATURE,
+        messages=[{"role": "user", "content": prompt}]
+    ) as stream:
+        for text in stream.text_stream:
+            if timings['first_token_seconds'] is None:
+                timings['first_token_seconds'] = time.perf_counter() - start
+            chunks.append(text)
+            
+            if on_text is not None:
+                on_text(text)
+    
+    timings['total_seconds'] = time.perf_counter() - start
+    
+    return "".join(chunks), timings
+
+
+def run_portfolio_analysis(portfolio_id, analysis_type, include_macro=True, force_refresh=False):
+    """
+    Esegue un'analisi completa fuori da Streamlit (worker): carica posizioni
+    e performance, riusa un'analisi recente con lo stesso fingerprint oppure
+    chiama Claude e salva il risultato in portfolio_analyses.
+    
+    Returns:
+        dict: analysis_id, cached (bool), timings
+        
+    Raises:
+        ValueError: se il portafoglio è vuoto
+    """
+    df = get_portfolio_positions(portfolio_id)
+    if df.empty:
+        raise ValueError(f"Portafoglio {portfolio_id} vuoto")
+    
+    perf = calculate_portfolio_performance(portfolio_id)
+    fingerprint = compute_analysis_fingerprint(df, perf, analysis_type, include_macro)
+    
+    if not force_refresh:
+        cached = find_recent_analysis(portfolio_id, fingerprint, max_age_hours=AI_ANALYSIS_MAX_AGE_HOURS)
+        if cached:
+            return {'analysis_id': cached['id'], 'cached': True, 'timings': None}
+    
+    portfolio_text = prepare_portfolio_for_ai(df, perf, analysis_type, include_macro)
+    analysis, timings = stream_claude_analysis(build_analysis_prompt(portfolio_text, analysis_type))
+    
+    analysis_id = save_analysis(
+        portfolio_id=portfolio_id,
+        analysis_data={
+            'analysis_text': analysis,
+            'model_used': CLAUDE_MODEL,
+            'fingerprint': fingerprint,
+            'timings': timings
+        },
+        analysis_type=analysis_type
+    )
+    
+    if analysis_id is None:
+        raise RuntimeError("Salvataggio analisi fallito")
+    
+    return {'analysis_id': analysis_id, 'cached': False, 'timings': timings}
@@ -14,7 +14,8 @@ def show(user_id):
     Imposta un prezzo target per un titolo. Quando il prezzo raggiunge il target, 
     l'alert viene triggerato e disattivato automaticamente.
     
-    **Nota**: Gli alert vengono controllati ad ogni accesso all'app.
+    **Nota**: Gli alert vengono controllati periodicamente in background, 
+    anche quando l'app è chiusa.
     """)
     
     # === CREA ALERT ===
@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+from modules.fmp_client import get_http_session
+
+# Directory della cache su disco (montare un disco persistente su Render)
+FMP_CACHE_DIR = os.getenv("FMP_CACHE_DIR", os.path.join(os.getcwd(), ".cache", "fmp"))
+
+# Dimensione massima del file cache (MB): oltre, elimina le voci meno usate
+FMP_CACHE_MAX_MB = float(os.getenv("FMP_CACHE_MAX_MB", "256"))
+
+# TTL per endpoint (secondi). Endpoint non elencati non vengono salvati su disco.
+FMP_CACHE_TTLS = {
+    'income-statement': 7 * 86400,
+    'balance-sheet-statement': 7 * 86400,
+    'cash-flow-statement': 7 * 86400,
+    'ratios': 7 * 86400,
+    'analyst-estimates': 86400,
+    'insider': 6 * 3600,
+    'profile': 86400,
+    'historical-price-full': 6 * 3600,
+    'earning_calendar': 86400,
+    'stock_dividend': 86400,
+}
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+def _get_conn():
+    """Connessione SQLite per thread (i fetch concorrenti usano thread diversi)."""
+    global _schema_ready
+
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        os.makedirs(FMP_CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(
+            os.path.join(FMP_CACHE_DIR, "responses.sqlite3"),
+            timeout=30,
+            isolation_level=None  # autocommit
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+
+    if not _schema_ready:
+        with _schema_lock:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    cache_key TEXT PRIMARY KEY,
+                    endpoint TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed_at)")
+            _schema_ready = True
+
+    return conn
+
+
+def make_cache_key(endpoint, ticker, period=None, limit=None):
+    """Chiave cache: endpoint/ticker/period/limit."""
+    return f"{endpoint}|{ticker.upper()}|{period or ''}|{limit or ''}"
+
+
+def cache_get(endpoint, ticker, period=None, limit=None):
+    """
+    Legge una risposta dalla cache su disco.
+
+    Returns:
+        Dati JSON decodificati, o None se assenti o scaduti
+    """
+    ttl = FMP_CACHE_TTLS.get(endpoint)
+    if not ttl:
+        return None
+
+    key = make_cache_key(endpoint, ticker, period, limit)
+
+    try:
+        conn = _get_conn()
+        row = conn.execute(
+            "SELECT payload, created_at FROM responses WHERE cache_key = ?", (key,)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        payload, created_at = row
+        now = time.time()
+
+        if now - created_at > ttl:
+            conn.execute("DELETE FROM responses WHERE cache_key = ?", (key,))
+            return None
+
+        conn.execute("UPDATE responses SET accessed_at = ? WHERE cache_key = ?", (now, key))
+        return json.loads(zlib.decompress(payload))
+
+    except Exception as e:
+        print(f"Errore lettura cache FMP {key}: {e}")
+        return None
+
+
+def cache_set(endpoint, ticker, data, period=None, limit=None):
+    """Salva una risposta (compressa zlib) nella cache su disco."""
+    if not FMP_CACHE_TTLS.get(endpoint):
+        return
+
+    key = make_cache_key(endpoint, ticker, period, limit)
+    payload = zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'), 6)
+    now = time.time()
+
+    try:
+        conn = _get_conn()
+        conn.execute("""
+            INSERT OR REPLACE INTO responses
+            (cache_key, endpoint, payload, size, created_at, accessed_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (key, endpoint, payload, len(payload), now, now))
+        _evict_if_needed(conn)
+
+    except Exception as e:
+        print(f"Errore scrittura cache FMP {key}: {e}")
+
+
+def _evict_if_needed(conn):
+    """Elimina le voci meno usate finché la cache torna sotto il 90% del limite."""
+    max_bytes = FMP_CACHE_MAX_MB * 1024 * 1024
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    if total <= max_bytes:
+        return
+
+    target = max_bytes * 0.9
+    rows = conn.execute("SELECT cache_key, size FROM responses ORDER BY accessed_at").fetchall()
+
+    to_delete = []
+    for cache_key, size in rows:
+        if total <= target:
+            break
+        to_delete.append((cache_key,))
+        total -= size
+
+    conn.executemany("DELETE FROM responses WHERE cache_key = ?", to_delete)
+
+
+def _is_cacheable(data):
+    """Salva solo risposte valide (FMP ritorna errori come dict 'Error Message')."""
+    if isinstance(data, dict):
+        return bool(data) and 'Error Message' not in data
+    return bool(data)
+
+
+def fetch_json_cached(url, endpoint, ticker, period=None, limit=None, timeout=10):
+    """
+    GET JSON con cache persistente su disco.
+
+    Se la risposta è in cache e non scaduta non tocca la rete; altrimenti
+    scarica con la sessione keep-alive e salva il risultato.
+    Gli errori HTTP vengono propagati al chiamante.
+    """
+    cached = cache_get(endpoint, ticker, period, limit)
+    if cached is not None:
+        return cached
+
+    response = get_http_session().get(url, timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+
+    if _is_cacheable(data):
+        cache_set(endpoint, ticker, data, period, limit)
+
+    return data
+
+
+def clear_fmp_cache():
+    """Svuota la cache su disco."""
+    _get_conn().execute("DELETE FROM responses")
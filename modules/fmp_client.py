@@ -0,0 +1,85 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from streamlit.runtime.scriptrunner import get_script_run_ctx, add_script_run_ctx
+except ImportError:  # Streamlit non disponibile (script/cron)
+    get_script_run_ctx = None
+    add_script_run_ctx = None
+
+# Numero massimo di richieste FMP in parallelo (e di connessioni keep-alive)
+FMP_MAX_WORKERS = int(os.getenv("FMP_MAX_WORKERS", "13"))
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """
+    Sessione HTTP condivisa con connessioni keep-alive riutilizzate.
+    Evita un nuovo handshake TLS per ogni chiamata FMP.
+    """
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=4,
+                    pool_maxsize=FMP_MAX_WORKERS
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+
+    return _session
+
+
+def _timed_call(fn, args, kwargs):
+    """Esegue fn e ritorna (risultato, secondi impiegati)."""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def fetch_concurrently(calls, max_workers=None):
+    """
+    Esegue in parallelo più chiamate di fetch indipendenti.
+
+    Le funzioni mantengono il proprio @st.cache_data (e quindi il proprio TTL):
+    il contesto Streamlit viene propagato ai thread così cache e messaggi
+    di errore funzionano come nelle chiamate sequenziali.
+
+    Args:
+        calls: dict {nome: (funzione, args)} o {nome: (funzione, args, kwargs)}
+        max_workers: Thread massimi (default: FMP_MAX_WORKERS)
+
+    Returns:
+        tuple: (dict {nome: risultato}, dict {nome: secondi})
+    """
+    ctx = get_script_run_ctx() if get_script_run_ctx else None
+
+    def attach_ctx():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+
+    workers = max(1, min(max_workers or FMP_MAX_WORKERS, len(calls)))
+    results = {}
+    timings = {}
+
+    with ThreadPoolExecutor(max_workers=workers, initializer=attach_ctx) as executor:
+        futures = {}
+        for name, call in calls.items():
+            fn, args = call[0], call[1]
+            kwargs = call[2] if len(call) > 2 else {}
+            futures[name] = executor.submit(_timed_call, fn, args, kwargs)
+
+        for name, future in futures.items():
+            results[name], timings[name] = future.result()
+
+    return results, timings
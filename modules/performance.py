@@ -1,11 +1,15 @@
 import streamlit as st
-from database.portfolios import get_user_portfolios, get_portfolio_positions
+from database.portfolios import get_user_portfolios
 from database.analytics import (
     calculate_portfolio_performance,
     get_portfolio_history,
-    get_position_pl,
+    get_portfolio_pl,
     save_portfolio_snapshot
 )
+from database.backfill import backfill_snapshots
+from database.returns import get_portfolio_returns
+from database.risk import get_portfolio_risk
+from database.fx import currency_symbol
 import plotly.graph_objects as go
 import plotly.express as px
 import pandas as pd
@@ -34,30 +38,40 @@ def show(user_id):
         st.warning("Nessuna posizione nel portafoglio")
         return
     
+    # Totali convertiti nella valuta base
+    sym = currency_symbol(perf['base_currency'])
+    
     # === METRICHE PRINCIPALI ===
     st.markdown("### 📊 Panoramica")
+    st.caption(f"Importi in {perf['base_currency']}: valori al cambio corrente, costi al cambio "
+               "della data di acquisto (il P/L include l'effetto valuta)")
+    if perf['missing_fx']:
+        st.warning(f"Totali parziali: cambio non disponibile per {', '.join(perf['missing_fx'])}. "
+                   "Le posizioni in queste valute sono escluse e lo snapshot non viene salvato.")
     
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        st.metric("Investito", f"${perf['total_cost']:,.2f}")
+        st.metric("Investito", f"{sym}{perf['total_cost']:,.2f}")
     
     with col2:
-        st.metric("Valore Corrente", f"${perf['current_value']:,.2f}")
+        st.metric("Valore Corrente", f"{sym}{perf['current_value']:,.2f}")
     
     with col3:
         st.metric(
             "Gain/Loss", 
-            f"${perf['gain_loss']:,.2f}",
+            f"{sym}{perf['gain_loss']:,.2f}",
             delta=f"{perf['gain_loss_pct']:+.2f}%"
         )
     
     with col4:
         # Salva snapshot
         if st.button("💾 Salva Snapshot"):
-            save_portfolio_snapshot(portfolio_id)
-            st.success("✅ Snapshot salvato!")
-            st.rerun()
+            if save_portfolio_snapshot(portfolio_id):
+                st.success("✅ Snapshot salvato!")
+                st.rerun()
+            else:
+                st.warning("Snapshot non salvato (portafoglio vuoto o cambio mancante)")
     
     st.markdown("---")
     
@@ -99,7 +113,7 @@ def show(user_id):
         fig.update_layout(
             title=f"Performance {period}",
             xaxis_title="Data",
-            yaxis_title="Valore ($)",
+            yaxis_title=f"Valore ({perf['base_currency']})",
             hovermode='x unified',
             template='plotly_white',
             height=400
@@ -107,93 +121,178 @@ def show(user_id):
         
         st.plotly_chart(fig, use_container_width=True)
         
-        # Metriche periodo
+        # Metriche periodo (rendimenti corretti per versamenti e prelievi)
         if len(df_history) >= 2:
             first_value = df_history.iloc[0]['total_value']
             last_value = df_history.iloc[-1]['total_value']
-            period_return = ((last_value - first_value) / first_value * 100)
+            returns = get_portfolio_returns(portfolio_id, days=days)
             
-            col1, col2, col3 = st.columns(3)
+            col1, col2, col3, col4 = st.columns(4)
             
             with col1:
-                st.metric("Valore Inizio Periodo", f"${first_value:,.2f}")
+                st.metric("Valore Inizio Periodo", f"{sym}{first_value:,.2f}")
             with col2:
-                st.metric("Valore Fine Periodo", f"${last_value:,.2f}")
+                st.metric("Valore Fine Periodo", f"{sym}{last_value:,.2f}")
             with col3:
-                st.metric("Rendimento Periodo", f"{period_return:+.2f}%", 
-                         delta=f"{period_return:+.2f}%")
+                if returns['twr'] is not None:
+                    twr_pct = returns['twr'] * 100
+                    st.metric("Rendimento TWR", f"{twr_pct:+.2f}%", delta=f"{twr_pct:+.2f}%",
+                              help="Time-weighted: esclude l'effetto di acquisti e vendite")
+                else:
+                    st.metric("Rendimento TWR", "N/A")
+            with col4:
+                if returns['mwr'] is not None:
+                    mwr_pct = returns['mwr'] * 100
+                    st.metric("Rendimento MWR", f"{mwr_pct:+.2f}%",
+                              help=f"Money-weighted (XIRR annuo: {returns['xirr'] * 100:+.2f}%)")
+                else:
+                    st.metric("Rendimento MWR", "N/A")
+            
+            if returns['net_flows']:
+                st.caption(f"Flussi netti nel periodo (acquisti - vendite): {sym}{returns['net_flows']:,.2f}")
     else:
         st.info("📊 Non ci sono dati storici ancora. Salva snapshot giornalmente per tracciare la performance.")
     
+    # Ricostruzione storico dalle transazioni (solo date mancanti)
+    if st.button("🔄 Ricostruisci storico dalle transazioni"):
+        with st.spinner("Ricostruzione storico in corso..."):
+            report = backfill_snapshots(portfolio_ids=[portfolio_id], verbose=False)
+        st.success(f"✅ {report['snapshots']} snapshot ricostruiti")
+        st.rerun()
+    
+    st.markdown("---")
+    
+    # === RISCHIO ===
+    st.markdown("### ⚠️ Analisi Rischio (ultimo anno)")
+    
+    risk = get_portfolio_risk(perf)
+    
+    if risk:
+        col1, col2, col3, col4 = st.columns(4)
+        
+        with col1:
+            st.metric("Volatilità Annua", f"{risk['volatility'] * 100:.1f}%")
+            st.metric("Max Drawdown", f"{risk['max_drawdown'] * 100:.1f}%")
+        with col2:
+            st.metric("Sharpe", f"{risk['sharpe']:.2f}" if risk['sharpe'] is not None else "N/A")
+            st.metric("Sortino", f"{risk['sortino']:.2f}" if risk['sortino'] is not None else "N/A")
+        with col3:
+            st.metric(f"Beta vs {risk['benchmark']}",
+                      f"{risk['beta']:.2f}" if risk['beta'] is not None else "N/A")
+        with col4:
+            if risk['var_historical'] is not None:
+                st.metric(f"VaR {risk['var_confidence']:.0%} (1g) storico", f"{risk['var_historical'] * 100:.2f}%")
+                st.metric(f"VaR {risk['var_confidence']:.0%} (1g) parametrico", f"{risk['var_parametric'] * 100:.2f}%")
+        
+        col1, col2 = st.columns(2)
+        
+        with col1:
+            fig_vol = go.Figure(go.Scatter(
+                x=pd.to_datetime(risk['dates']),
+                y=risk['rolling_volatility'] * 100,
+                mode='lines',
+                name='Volatilità 21g'
+            ))
+            fig_vol.add_trace(go.Scatter(
+                x=pd.to_datetime(risk['dates']),
+                y=risk['drawdowns'] * 100,
+                mode='lines',
+                name='Drawdown',
+                line=dict(color='red')
+            ))
+            fig_vol.update_layout(
+                title="Volatilità Mobile e Drawdown (%)",
+                template='plotly_white',
+                height=350,
+                hovermode='x unified'
+            )
+            st.plotly_chart(fig_vol, use_container_width=True)
+        
+        with col2:
+            if len(risk['correlation']) > 1:
+                fig_corr = px.imshow(
+                    risk['correlation'],
+                    text_auto='.2f',
+                    color_continuous_scale='RdBu_r',
+                    zmin=-1,
+                    zmax=1,
+                    title="Correlazione tra Titoli"
+                )
+                fig_corr.update_layout(height=350)
+                st.plotly_chart(fig_corr, use_container_width=True)
+    else:
+        st.info("Storico prezzi non disponibile per calcolare le metriche di rischio.")
+    
     st.markdown("---")
     
     # === P/L PER POSIZIONE ===
     st.markdown("### 💰 P/L per Posizione")
     
-    df = get_portfolio_positions(portfolio_id)
+    df = perf['positions_df']
     
     if not df.empty:
+        # Prezzi già recuperati da calculate_portfolio_performance
         pl_data = []
         
-        for _, row in df.iterrows():
-            ticker = row['ticker']
-            pl = get_position_pl(portfolio_id, ticker)
-            
-            if pl:
-                pl_data.append({
-                    'Ticker': ticker,
-                    'Azioni': pl['shares'],
-                    'Prezzo Medio': f"${pl['avg_price']:.2f}",
-                    'Prezzo Attuale': f"${pl['current_price']:.2f}",
-                    'Costo': f"${pl['total_cost']:,.2f}",
-                    'Valore': f"${pl['current_value']:,.2f}",
-                    'Gain/Loss': f"${pl['gain_loss']:+,.2f}",
-                    'Gain/Loss %': f"{pl['gain_loss_pct']:+.2f}%"
-                })
+        for pl in get_portfolio_pl(portfolio_id, perf['current_prices']):
+            # Importi nella valuta del titolo
+            sym = currency_symbol(pl['currency'])
+            pl_data.append({
+                'Ticker': pl['ticker'],
+                'Valuta': pl['currency'],
+                'Azioni': pl['shares'],
+                'Prezzo Medio': f"{sym}{pl['avg_price']:.2f}",
+                'Prezzo Attuale': f"{sym}{pl['current_price']:.2f}",
+                'Costo': f"{sym}{pl['total_cost']:,.2f}",
+                'Valore': f"{sym}{pl['current_value']:,.2f}",
+                'Gain/Loss': f"{sym}{pl['gain_loss']:+,.2f}",
+                'Gain/Loss %': f"{pl['gain_loss_pct']:+.2f}%"
+            })
         
         df_pl = pd.DataFrame(pl_data)
         st.dataframe(df_pl, use_container_width=True, hide_index=True)
         
-        # Grafico P/L
-        fig_pl = go.Figure()
-        
-        # Converti string a float per grafico
-        df_pl['gain_loss_numeric'] = df_pl['Gain/Loss'].str.replace('$', '').str.replace(',', '').astype(float)
-        
-        colors = ['green' if x >= 0 else 'red' for x in df_pl['gain_loss_numeric']]
-        
-        fig_pl.add_trace(go.Bar(
-            x=df_pl['Ticker'],
-            y=df_pl['gain_loss_numeric'],
-            marker_color=colors,
-            text=df_pl['Gain/Loss %'],
-            textposition='outside'
-        ))
-        
-        fig_pl.update_layout(
-            title="Gain/Loss per Titolo",
-            xaxis_title="Ticker",
-            yaxis_title="Gain/Loss ($)",
-            template='plotly_white',
-            height=400
-        )
-        
-        st.plotly_chart(fig_pl, use_container_width=True)
+        # Grafico e classifica in valuta base (le posizioni senza cambio restano fuori)
+        base_sym = currency_symbol(perf['base_currency'])
+        df_base = df[['ticker', 'gain_loss', 'gain_loss_pct']].dropna(subset=['gain_loss'])
         
-        # Best & Worst performers
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            st.markdown("#### 🏆 Top Performer")
-            best_idx = df_pl['gain_loss_numeric'].idxmax()
-            best = df_pl.iloc[best_idx]
-            st.success(f"**{best['Ticker']}**: {best['Gain/Loss']} ({best['Gain/Loss %']})")
-        
-        with col2:
-            st.markdown("#### 📉 Worst Performer")
-            worst_idx = df_pl['gain_loss_numeric'].idxmin()
-            worst = df_pl.iloc[worst_idx]
-            st.error(f"**{worst['Ticker']}**: {worst['Gain/Loss']} ({worst['Gain/Loss %']})")
+        if not df_base.empty:
+            fig_pl = go.Figure()
+            
+            colors = ['green' if x >= 0 else 'red' for x in df_base['gain_loss']]
+            
+            fig_pl.add_trace(go.Bar(
+                x=df_base['ticker'],
+                y=df_base['gain_loss'],
+                marker_color=colors,
+                text=[f"{x:+.2f}%" for x in df_base['gain_loss_pct']],
+                textposition='outside'
+            ))
+            
+            fig_pl.update_layout(
+                title=f"Gain/Loss per Titolo (in {perf['base_currency']})",
+                xaxis_title="Ticker",
+                yaxis_title=f"Gain/Loss ({perf['base_currency']})",
+                template='plotly_white',
+                height=400
+            )
+            
+            st.plotly_chart(fig_pl, use_container_width=True)
+            
+            # Best & Worst performers
+            col1, col2 = st.columns(2)
+            
+            with col1:
+                st.markdown("#### 🏆 Top Performer")
+                best = df_base.loc[df_base['gain_loss'].idxmax()]
+                st.success(f"**{best['ticker']}**: {base_sym}{best['gain_loss']:+,.2f} "
+                           f"({best['gain_loss_pct']:+.2f}%)")
+            
+            with col2:
+                st.markdown("#### 📉 Worst Performer")
+                worst = df_base.loc[df_base['gain_loss'].idxmin()]
+                st.error(f"**{worst['ticker']}**: {base_sym}{worst['gain_loss']:+,.2f} "
+                         f"({worst['gain_loss_pct']:+.2f}%)")
     
     st.markdown("---")
     
@@ -203,15 +302,12 @@ def show(user_id):
     col1, col2 = st.columns(2)
     
     with col1:
-        # Per settore
-        if 'sector' in df.columns:
-            sector_df = df.groupby('sector').agg({
-                'total_cost': 'sum'
-            }).reset_index()
-            
+        # Per settore (valori convertiti nella valuta base)
+        sector_df = perf['sector_allocation']
+        if not sector_df.empty:
             fig_sector = px.pie(
                 sector_df,
-                values='total_cost',
+                values='invested',
                 names='sector',
                 title='Allocazione per Settore',
                 hole=0.4
@@ -219,17 +315,14 @@ def show(user_id):
             st.plotly_chart(fig_sector, use_container_width=True)
     
     with col2:
-        # Per valuta
-        if 'currency' in df.columns:
-            currency_df = df.groupby('currency').agg({
-                'total_cost': 'sum'
-            }).reset_index()
-            
+        # Per valuta (valori convertiti nella valuta base)
+        currency_df = perf['currency_allocation']
+        if not currency_df.empty:
             fig_currency = px.pie(
                 currency_df,
-                values='total_cost',
+                values='current_value',
                 names='currency',
-                title='Allocazione per Valuta',
+                title=f"Allocazione per Valuta ({perf['base_currency']})",
                 hole=0.4
             )
             st.plotly_chart(fig_currency, use_container_width=True)
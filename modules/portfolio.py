@@ -1,9 +1,12 @@
 import streamlit as st
 from database.portfolios import (
-    create_portfolio, get_user_portfolios, get_portfolio_positions,
-    add_position, delete_position, delete_portfolio
+    create_portfolio, get_user_portfolios,
+    add_position, add_transaction, delete_position, delete_portfolio
 )
 from database.analytics import calculate_portfolio_performance
+from database.fx import currency_symbol
+from database.importer import import_positions_csv
+from database.lots import get_portfolio_realized_pl, LOT_METHOD, LOT_METHODS
 import pandas as pd
 import plotly.express as px
 
@@ -14,14 +17,13 @@ def show(user_id):
     st.title("📊 I Miei Portafogli")
     
     # Tabs
-    tab1, tab2 = st.tabs(["📋 I Miei Portafogli", "➕ Nuovo Portafoglio"])
+    tab1, tab2, tab3 = st.tabs(["📋 I Miei Portafogli", "➕ Nuovo Portafoglio", "📥 Importa CSV"])
+    
+    portfolios = get_user_portfolios(user_id) or []
     
     with tab1:
-        portfolios = get_user_portfolios(user_id)
-        
         if not portfolios:
             st.info("👋 Non hai ancora portafogli. Creane uno nel tab 'Nuovo Portafoglio'!")
-            return
         
         for portfolio in portfolios:
             with st.expander(f"📁 {portfolio['portfolio_name']}", expanded=True):
@@ -33,17 +35,24 @@ def show(user_id):
                     
                     # Performance real-time
                     perf = calculate_portfolio_performance(portfolio['id'])
+                    sym = currency_symbol(perf['base_currency'])
+                    
                     if perf:
-                        st.metric("Valore Corrente", f"${perf['current_value']:,.2f}")
-                        st.metric("P/L", f"${perf['gain_loss']:,.2f}", 
+                        st.metric("Valore Corrente", f"{sym}{perf['current_value']:,.2f}")
+                        st.metric("P/L", f"{sym}{perf['gain_loss']:,.2f}", 
                                  delta=f"{perf['gain_loss_pct']:+.2f}%")
+                        if perf['missing_fx']:
+                            st.warning(f"Totale parziale: cambio non disponibile per "
+                                       f"{', '.join(perf['missing_fx'])}")
                 
                 with col2:
                     if st.button("🔄 Aggiorna", key=f"refresh_{portfolio['id']}"):
                         from database.analytics import save_portfolio_snapshot
-                        save_portfolio_snapshot(portfolio['id'])
-                        st.success("Snapshot salvato!")
-                        st.rerun()
+                        if save_portfolio_snapshot(portfolio['id']):
+                            st.success("Snapshot salvato!")
+                            st.rerun()
+                        else:
+                            st.warning("Snapshot non salvato (portafoglio vuoto o cambio mancante)")
                 
                 with col3:
                     if st.button("🗑️ Elimina", key=f"del_{portfolio['id']}"):
@@ -53,33 +62,29 @@ def show(user_id):
                 
                 st.markdown("---")
                 
-                # Posizioni
-                df = get_portfolio_positions(portfolio['id'])
+                # Posizioni (già valorizzate in un'unica passata)
+                df = perf['positions_df']
                 
                 if not df.empty:
-                    # Aggiungi prezzi correnti e P/L
-                    if perf:
-                        current_prices = perf['current_prices']
-                        df['current_price'] = df['ticker'].map(current_prices)
-                        df['current_value'] = df['shares'] * df['current_price']
-                        df['gain_loss'] = df['current_value'] - df['total_cost']
-                        df['gain_loss_pct'] = ((df['current_price'] - df['avg_price']) / df['avg_price'] * 100)
-                    
                     # Tabella
                     display_df = df[[
                         'ticker', 'company_name', 'shares', 'avg_price', 
-                        'current_price', 'total_cost', 'current_value', 
-                        'gain_loss', 'gain_loss_pct', 'weight_%'
+                        'current_price', 'invested', 'current_value', 
+                        'gain_loss', 'gain_loss_pct', 'weight'
                     ]].copy()
                     
-                    # Formattazione
-                    display_df['avg_price'] = display_df['avg_price'].apply(lambda x: f"${x:.2f}")
-                    display_df['current_price'] = display_df['current_price'].apply(lambda x: f"${x:.2f}")
-                    display_df['total_cost'] = display_df['total_cost'].apply(lambda x: f"${x:,.2f}")
-                    display_df['current_value'] = display_df['current_value'].apply(lambda x: f"${x:,.2f}")
-                    display_df['gain_loss'] = display_df['gain_loss'].apply(lambda x: f"${x:+,.2f}")
+                    # Formattazione: prezzi nella valuta del titolo, importi nella valuta base
+                    display_df['avg_price'] = [
+                        f"{currency_symbol(c)}{x:.2f}" for x, c in zip(df['avg_price'], df['currency'])
+                    ]
+                    display_df['current_price'] = [
+                        f"{currency_symbol(c)}{x:.2f}" for x, c in zip(df['current_price'], df['currency'])
+                    ]
+                    display_df['invested'] = display_df['invested'].apply(lambda x: f"{sym}{x:,.2f}")
+                    display_df['current_value'] = display_df['current_value'].apply(lambda x: f"{sym}{x:,.2f}")
+                    display_df['gain_loss'] = display_df['gain_loss'].apply(lambda x: f"{sym}{x:+,.2f}")
                     display_df['gain_loss_pct'] = display_df['gain_loss_pct'].apply(lambda x: f"{x:+.2f}%")
-                    display_df['weight_%'] = display_df['weight_%'].apply(lambda x: f"{x:.1f}%")
+                    display_df['weight'] = display_df['weight'].apply(lambda x: f"{x:.1f}%")
                     
                     # Rinomina colonne
                     display_df.columns = [
@@ -104,8 +109,8 @@ def show(user_id):
                         st.plotly_chart(fig, use_container_width=True)
                     
                     with col2:
-                        if 'sector' in df.columns:
-                            sector_df = df.groupby('sector')['current_value'].sum().reset_index()
+                        sector_df = perf['sector_allocation']
+                        if not sector_df.empty:
                             fig2 = px.pie(
                                 sector_df,
                                 values='current_value',
@@ -141,6 +146,9 @@ def show(user_id):
                             mime="text/csv",
                             key=f"export_{portfolio['id']}"
                         )
+                    
+                    show_transaction_form(portfolio, df)
+                    show_realized_pl(portfolio, df, sym)
                 else:
                     st.info("Portafoglio vuoto. Aggiungi titoli dalla sezione 'Analisi Titoli'")
     
@@ -160,3 +168,200 @@ def show(user_id):
                     st.rerun()
                 else:
                     st.error("Inserisci un nome")
+    
+    with tab3:
+        show_import(portfolios)
+
+
+def show_transaction_form(portfolio, df):
+    """Vendite e dividendi su una posizione esistente."""
+    with st.form(f"tx_form_{portfolio['id']}"):
+        st.markdown("##### 💱 Registra Vendita / Dividendo")
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            tx_type = st.radio("Tipo", ["SELL", "DIVIDEND"], horizontal=True,
+                               format_func=lambda t: "Vendita" if t == "SELL" else "Dividendo")
+            ticker = st.selectbox("Ticker", df['ticker'].tolist())
+        with col2:
+            shares = st.number_input("Azioni (0 per dividendo come importo totale)",
+                                     min_value=0.0, step=1.0, format="%.4f")
+            price = st.number_input("Prezzo / dividendo per azione", min_value=0.0, format="%.4f")
+        with col3:
+            tx_date = st.date_input("Data", value=pd.Timestamp.now().date())
+            fees = st.number_input("Commissioni / ritenute", min_value=0.0, format="%.2f")
+        
+        submit = st.form_submit_button("Registra", use_container_width=True)
+    
+    if not submit:
+        return
+    
+    if price <= 0 or (tx_type == "SELL" and shares <= 0):
+        st.error("Inserisci quantità e prezzo")
+        return
+    
+    currency = df.loc[df['ticker'] == ticker, 'currency'].iloc[0]
+    try:
+        add_transaction(portfolio['id'], ticker, tx_type, shares, price, currency,
+                        tx_date=tx_date, fees=fees)
+        st.success(f"{'Vendita' if tx_type == 'SELL' else 'Dividendo'} su {ticker} registrato!")
+        st.rerun()
+    except ValueError as e:
+        st.error(str(e))
+
+
+def show_realized_pl(portfolio, df, sym):
+    """P/L realizzato e non realizzato dai lotti, con metodo di carico selezionabile."""
+    st.markdown("#### 🧾 P/L Realizzato")
+    
+    labels = {'fifo': 'FIFO', 'lifo': 'LIFO', 'average': 'Costo medio'}
+    method = st.selectbox("Metodo di carico", LOT_METHODS, index=LOT_METHODS.index(LOT_METHOD),
+                          format_func=labels.get, key=f"lot_method_{portfolio['id']}")
+    
+    pl = get_portfolio_realized_pl(portfolio['id'], dict(zip(df['ticker'], df['current_price'])), method)
+    totals = pl['totals']
+    
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Realizzato", f"{sym}{totals['realized']:+,.2f}")
+    col2.metric("Non realizzato", f"{sym}{totals['unrealized']:+,.2f}")
+    col3.metric("Dividendi", f"{sym}{totals['dividends']:,.2f}")
+    col4.metric("Totale", f"{sym}{totals['total']:+,.2f}")
+    st.caption("Importi per titolo nella valuta del titolo; totali convertiti al cambio corrente")
+    if totals['missing_fx']:
+        st.caption(f"Totali parziali: cambio non disponibile per {', '.join(totals['missing_fx'])}")
+    
+    positions = pl['positions']
+    if positions.empty:
+        st.caption("Nessuna transazione registrata per questo portafoglio")
+        return
+    
+    display_df = positions[['ticker', 'shares', 'avg_price', 'realized_pl', 'unrealized_pl',
+                            'dividends', 'fees', 'total_pl']].copy()
+    for column in ('avg_price', 'realized_pl', 'unrealized_pl', 'dividends', 'fees', 'total_pl'):
+        display_df[column] = [
+            f"{currency_symbol(c)}{x:,.2f}" for x, c in zip(positions[column], positions['currency'])
+        ]
+    display_df.columns = ['Ticker', 'Azioni', 'Costo Medio', 'Realizzato', 'Non Realizzato',
+                          'Dividendi', 'Commissioni', 'Totale']
+    st.dataframe(display_df, use_container_width=True, hide_index=True)
+    
+    if (positions['oversold'] > 0).any():
+        st.warning("Vendite oltre la quantità detenuta: "
+                   + ", ".join(positions.loc[positions['oversold'] > 0, 'ticker']))
+    
+    closed = pl['closed_lots']
+    if not closed.empty:
+        with st.expander(f"Lotti chiusi ({len(closed)})"):
+            closed_df = closed[['ticker', 'acquired_date', 'sold_date', 'shares',
+                                'cost', 'proceeds', 'realized_pl']].copy()
+            closed_df.columns = ['Ticker', 'Acquisto', 'Vendita', 'Azioni',
+                                 'Costo', 'Ricavo', 'P/L']
+            st.dataframe(closed_df, use_container_width=True, hide_index=True)
+
+
+def show_import(portfolios):
+    """Import di transazioni da CSV o export del broker: anteprima e conferma."""
+    st.subheader("Importa Transazioni da CSV")
+    
+    if not portfolios:
+        st.info("Crea prima un portafoglio nel tab 'Nuovo Portafoglio'")
+        return
+    
+    st.caption(
+        "Colonne obbligatorie: ticker, quantità, prezzo. Opzionali: data, tipo (BUY/SELL), "
+        "valuta, commissioni, note. Separatore ',' o ';', numeri in formato italiano o inglese. "
+        "Quantità negative senza tipo = vendite."
+    )
+    
+    portfolio_names = {p['portfolio_name']: p['id'] for p in portfolios}
+    
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        selected_portfolio = st.selectbox("Portafoglio di destinazione", list(portfolio_names.keys()),
+                                          key="import_portfolio")
+    with col2:
+        default_currency = st.selectbox("Valuta predefinita", ["USD", "EUR", "GBP", "CHF"],
+                                        key="import_currency")
+    with col3:
+        decimal_labels = {"Automatico": None, "Virgola (1.234,56)": ",", "Punto (1,234.56)": "."}
+        decimal_label = st.selectbox("Separatore decimale", list(decimal_labels), key="import_decimal",
+                                     help="Automatico: dedotto dal file; i valori ambigui come "
+                                          "'1,234' vengono scartati se il file non lo chiarisce")
+    
+    uploaded = st.file_uploader("File CSV", type=["csv", "txt"], key="import_file")
+    if uploaded is None:
+        return
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        preview = st.button("🔍 Anteprima", use_container_width=True, key="import_preview")
+    with col2:
+        confirm = st.button("📥 Importa", type="primary", use_container_width=True, key="import_confirm")
+    
+    if not (preview or confirm):
+        return
+    
+    try:
+        uploaded.seek(0)
+        with st.spinner("Importazione in corso..." if confirm else "Analisi del file..."):
+            report = import_positions_csv(
+                portfolio_names[selected_portfolio], uploaded,
+                dry_run=not confirm, default_currency=default_currency,
+                decimal=decimal_labels[decimal_label]
+            )
+    except ValueError as e:
+        st.error(str(e))
+        return
+    except Exception as e:
+        st.error(f"Errore import: {e}")
+        return
+    
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Righe lette", f"{report['rows']:,}")
+    col2.metric("Righe valide", f"{report['valid']:,}")
+    col3.metric("Righe scartate", f"{report['error_count']:,}")
+    if report['decimal'] is None:
+        st.caption("Separatore decimale non determinato dal file: i valori ambigui (es. '1,234') "
+                   "sono tra le righe scartate. Sceglilo sopra per importarli.")
+    
+    if confirm:
+        st.success(
+            f"✅ Importate {report['transactions']} transazioni: "
+            f"{report['positions_updated']} posizioni aggiornate, {report['positions_closed']} chiuse"
+        )
+    else:
+        st.info("Anteprima: nessuna modifica salvata. Premi 'Importa' per confermare.")
+    
+    if report['rejected']:
+        st.warning(f"⚠️ {report['rejected']} vendite superiori alla quantità detenuta scartate "
+                   f"(vedi righe scartate)")
+    if report['oversold']:
+        st.warning(f"⚠️ Vendite superiori alla quantità detenuta già nel registro: "
+                   f"{', '.join(report['oversold'])}")
+    
+    diff = report['diff']
+    if not diff.empty:
+        st.markdown("#### Variazioni Posizioni")
+        display_diff = diff[[
+            'ticker', 'action', 'lots', 'shares_before', 'shares_after',
+            'avg_price_before', 'avg_price_after'
+        ]].copy()
+        display_diff.columns = [
+            'Ticker', 'Esito', 'Lotti', 'Azioni Prima', 'Azioni Dopo',
+            'Prezzo Medio Prima', 'Prezzo Medio Dopo'
+        ]
+        st.dataframe(display_diff, use_container_width=True, hide_index=True)
+    
+    errors = report['errors']
+    if report['error_count']:
+        st.markdown("#### Righe Scartate")
+        st.dataframe(errors, use_container_width=True, hide_index=True)
+        if report['error_count'] > len(errors):
+            st.caption(f"Mostrate le prime {len(errors)} righe su {report['error_count']}")
+        st.download_button(
+            "📥 Scarica errori",
+            errors.to_csv(index=False),
+            file_name="errori_import.csv",
+            mime="text/csv",
+            key="import_errors"
+        )
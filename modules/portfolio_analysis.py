@@ -1,7 +1,33 @@
 import streamlit as st
+import pandas as pd
+import time
 from database.portfolios import get_user_portfolios, get_portfolio_positions
-from database.analytics import calculate_portfolio_performance, save_analysis, get_portfolio_analyses
-import anthropic
+from database.analytics import (
+    calculate_portfolio_performance, save_analysis, get_portfolio_analyses, find_recent_analysis
+)
+from database.jobs import (
+    enqueue_analysis_job, get_analysis_jobs, get_worker_heartbeat_age,
+    ACTIVE_STATUSES, ANALYSIS_WORKER_TIMEOUT
+)
+from database.fx import currency_symbol
+from modules.ai_analysis import (
+    CLAUDE_MODEL, AI_ANALYSIS_MAX_AGE_HOURS, compute_analysis_fingerprint,
+    prepare_portfolio_for_ai, build_analysis_prompt, stream_claude_analysis
+)
+
+# Intervallo minimo (secondi) tra due aggiornamenti del testo in streaming
+STREAM_RENDER_INTERVAL = 0.1
+# Intervallo (secondi) di aggiornamento dello stato dei job in background
+ANALYSIS_POLL_INTERVAL = 3
+# Oltre questa attesa (secondi) lo stato si aggiorna solo a mano
+ANALYSIS_POLL_TIMEOUT = 600
+
+JOB_STATUS_LABELS = {
+    'queued': '⏳ In coda',
+    'running': '🤖 In esecuzione',
+    'done': '✅ Completata',
+    'failed': '❌ Fallita'
+}
 
 
 def show(user_id):
@@ -37,16 +63,18 @@ def show(user_id):
     with col1:
         st.metric("Titoli", len(df))
     with col2:
-        st.metric("Valore", f"${perf['current_value']:,.2f}")
+        st.metric("Valore", f"{currency_symbol(perf['base_currency'])}{perf['current_value']:,.2f}")
     with col3:
-        st.metric("P/L", f"${perf['gain_loss']:,.2f}")
+        st.metric("P/L", f"{currency_symbol(perf['base_currency'])}{perf['gain_loss']:,.2f}")
     with col4:
         st.metric("P/L %", f"{perf['gain_loss_pct']:+.2f}%")
+    if perf.get('missing_fx'):
+        st.warning(f"Totali parziali: cambio non disponibile per {', '.join(perf['missing_fx'])}")
     
     with st.expander("📋 Vedi Dettagli Portafoglio"):
         display_df = df[['ticker', 'company_name', 'shares', 'avg_price', 'total_cost', 'weight_%']].copy()
-        display_df['avg_price'] = display_df['avg_price'].apply(lambda x: f"${x:.2f}")
-        display_df['total_cost'] = display_df['total_cost'].apply(lambda x: f"${x:,.2f}")
+        display_df['avg_price'] = [f"{currency_symbol(c)}{x:.2f}" for x, c in zip(df['avg_price'], df['currency'])]
+        display_df['total_cost'] = [f"{currency_symbol(c)}{x:,.2f}" for x, c in zip(df['total_cost'], df['currency'])]
         display_df['weight_%'] = display_df['weight_%'].apply(lambda x: f"{x:.1f}%")
         display_df.columns = ['Ticker', 'Azienda', 'Azioni', 'Prezzo', 'Valore', 'Peso']
         st.dataframe(display_df, use_container_width=True, hide_index=True)
@@ -74,41 +102,96 @@ def show(user_id):
         include_news = st.checkbox("Includi Analisi News Recenti", value=False)
         include_macro = st.checkbox("Includi Contesto Macro", value=True)
     
+    force_refresh = st.checkbox(
+        "Forza nuova analisi",
+        value=False,
+        help=f"Altrimenti viene riusata un'analisi delle ultime {AI_ANALYSIS_MAX_AGE_HOURS:g} ore "
+             f"se il portafoglio non è cambiato"
+    )
+    run_in_background = st.checkbox(
+        "Esegui in background",
+        value=True,
+        help="L'analisi viene eseguita dal worker: puoi cambiare pagina e tornare più tardi"
+    )
+    
     # === BOTTONE ANALISI ===
     if st.button("🚀 Analizza con Claude", type="primary", use_container_width=True):
         
-        with st.spinner("🤖 Claude sta analizzando il tuo portafoglio..."):
+        fingerprint = compute_analysis_fingerprint(df, perf, analysis_type, include_macro)
+        cached = None if force_refresh else find_recent_analysis(
+            portfolio_id, fingerprint, max_age_hours=AI_ANALYSIS_MAX_AGE_HOURS
+        )
+        
+        st.markdown("---")
+        st.markdown("### 📋 Risultato Analisi")
+        
+        if cached:
+            analysis = cached['analysis_data'].get('analysis_text')
+            st.caption(f"♻️ Analisi riutilizzata del {format_analysis_date(cached['created_at'])} "
+                       f"(portafoglio invariato)")
+            st.markdown(analysis)
+        elif run_in_background:
+            analysis = None
+            job_id = enqueue_analysis_job(
+                portfolio_id, user_id, analysis_type,
+                include_macro=include_macro, force_refresh=force_refresh
+            )
             
+            if job_id:
+                st.session_state.setdefault('analysis_job_ids', set()).add(job_id)
+                st.success("⏳ Analisi in coda: il risultato comparirà qui sotto appena pronto")
+            else:
+                st.error("❌ Impossibile accodare l'analisi")
+        else:
             # Prepara dati per Claude
             portfolio_text = prepare_portfolio_for_ai(df, perf, analysis_type, include_macro)
             
-            # Chiama Claude
-            analysis = call_claude_api(portfolio_text, analysis_type)
+            # Chiama Claude: il testo compare man mano che viene generato
+            placeholder = st.empty()
+            placeholder.info("🤖 Claude sta analizzando il tuo portafoglio...")
+            analysis, timings = call_claude_api(portfolio_text, analysis_type, placeholder=placeholder)
             
             if analysis:
-                st.markdown("---")
-                st.markdown("### 📋 Risultato Analisi")
-                
-                st.markdown(analysis)
+                st.caption(f"⏱️ Primo token in {timings['first_token_seconds']:.1f}s, "
+                           f"analisi completa in {timings['total_seconds']:.1f}s")
                 
-                # Salva nel database
+                # Salva nel database (a stream completato)
                 save_analysis(
                     portfolio_id=portfolio_id,
-                    analysis_text=analysis,
-                    analysis_type=analysis_type,
-                    model_used="claude-sonnet-4-20250514"
-                )
-                
-                # Download
-                st.download_button(
-                    "📥 Scarica Report Completo",
-                    analysis,
-                    file_name=f"analisi_{selected_name}_{pd.Timestamp.now().strftime('%Y%m%d_%H%M')}.txt",
-                    mime="text/plain"
+                    analysis_data={
+                        'analysis_text': analysis,
+                        'model_used': CLAUDE_MODEL,
+                        'fingerprint': fingerprint,
+                        'timings': timings
+                    },
+                    analysis_type=analysis_type
                 )
+        
+        if analysis:
+            # Download
+            st.download_button(
+                "📥 Scarica Report Completo",
+                analysis,
+                file_name=f"analisi_{selected_name}_{pd.Timestamp.now().strftime('%Y%m%d_%H%M')}.txt",
+                mime="text/plain"
+            )
     
     st.markdown("---")
     
+    # === ANALISI IN BACKGROUND ===
+    jobs, polling = background_job_state(portfolio_id)
+    completed_ids = {job['analysis_id'] for job in jobs if job['status'] == 'done'}
+    
+    if jobs:
+        st.markdown("### ⏳ Analisi in Background")
+        
+        # Solo questo blocco si aggiorna periodicamente, senza bloccare la pagina
+        st.fragment(run_every=ANALYSIS_POLL_INTERVAL if polling else None)(show_background_jobs)(
+            portfolio_id, polling
+        )
+        
+        st.markdown("---")
+    
     # === STORICO ANALISI ===
     st.markdown("### 📚 Storico Analisi")
     
@@ -116,14 +199,18 @@ def show(user_id):
     
     if past_analyses:
         for i, analysis in enumerate(past_analyses):
+            data = analysis['analysis_data']
+            analysis_text = data.get('analysis_text', '') if isinstance(data, dict) else str(data)
+            
             with st.expander(
-                f"📄 Analisi del {analysis['created_at'][:16]} - {analysis['analysis_type'] or 'Generale'}"
+                f"📄 Analisi del {format_analysis_date(analysis['created_at'])} - {analysis['analysis_type'] or 'Generale'}",
+                expanded=analysis['id'] in completed_ids
             ):
-                st.markdown(analysis['analysis_text'])
+                st.markdown(analysis_text)
                 
                 st.download_button(
                     "📥 Scarica",
-                    analysis['analysis_text'],
+                    analysis_text,
                     file_name=f"analisi_{i+1}.txt",
                     key=f"download_analysis_{i}"
                 )
@@ -131,172 +218,97 @@ def show(user_id):
         st.info("Nessuna analisi passata. Crea la tua prima analisi!")
 
 
-def prepare_portfolio_for_ai(df, perf, analysis_type, include_macro):
-    """Prepara dati portafoglio per Claude."""
+def background_job_state(portfolio_id):
+    """
+    Job accodati in questa sessione e se ha senso continuare il polling:
+    solo con job attivi, un worker vivo e un'attesa sotto ANALYSIS_POLL_TIMEOUT.
     
-    output = f"""# PORTAFOGLIO DA ANALIZZARE
-
-## Metriche Generali
-- **Numero Posizioni**: {len(df)}
-- **Valore Totale**: ${perf['current_value']:,.2f}
-- **Costo Totale**: ${perf['total_cost']:,.2f}
-- **Gain/Loss**: ${perf['gain_loss']:,.2f} ({perf['gain_loss_pct']:+.2f}%)
-
-## Composizione Dettagliata
-
-"""
+    Returns:
+        tuple: (job, polling)
+    """
+    tracked_jobs = st.session_state.get('analysis_job_ids', set())
+    if not tracked_jobs:
+        return [], False
     
-    for _, row in df.iterrows():
-        current_price = perf['current_prices'].get(row['ticker'], 0)
-        current_value = row['shares'] * current_price
-        gain_loss = current_value - row['total_cost']
-        gain_loss_pct = (gain_loss / row['total_cost'] * 100) if row['total_cost'] > 0 else 0
-        
-        output += f"""### {row['ticker']} - {row.get('company_name', 'N/A')}
-- **Azioni**: {row['shares']:.2f}
-- **Prezzo Medio Acquisto**: ${row['avg_price']:.2f}
-- **Prezzo Corrente**: ${current_price:.2f}
-- **Valore Posizione**: ${current_value:,.2f}
-- **Peso Portafoglio**: {row['weight_%']:.1f}%
-- **P/L Posizione**: ${gain_loss:,.2f} ({gain_loss_pct:+.2f}%)
-"""
-        
-        if pd.notna(row.get('sector')):
-            output += f"- **Settore**: {row['sector']}\n"
-        if pd.notna(row.get('industry')):
-            output += f"- **Industria**: {row['industry']}\n"
-        if pd.notna(row.get('notes')):
-            output += f"- **Note**: {row['notes']}\n"
-        
-        output += "\n"
-    
-    # Distribuzione settoriale
-    if 'sector' in df.columns and df['sector'].notna().any():
-        output += "\n## Distribuzione Settoriale\n\n"
-        sector_weights = df.groupby('sector')['weight_%'].sum().sort_values(ascending=False)
-        for sector, weight in sector_weights.items():
-            if pd.notna(sector):
-                output += f"- **{sector}**: {weight:.1f}%\n"
-    
-    # Contesto macro (opzionale)
-    if include_macro:
-        from datetime import datetime
-        output += f"\n## Contesto Temporale\n\n"
-        output += f"- **Data Analisi**: {datetime.now().strftime('%d/%m/%Y')}\n"
-        output += "- **Contesto**: Considera il contesto economico attuale (tassi, inflazione, mercati)\n"
-    
-    return output
-
-
-def call_claude_api(portfolio_text, analysis_type):
-    """Chiama Claude API per analisi."""
+    jobs = [job for job in get_analysis_jobs(portfolio_id) if job['id'] in tracked_jobs]
+    pending = [job for job in jobs if job['status'] in ACTIVE_STATUSES]
+    if not pending:
+        return jobs, False
     
-    # Verifica API key
-    if "ANTHROPIC_API_KEY" not in st.secrets:
-        st.error("❌ API Key Anthropic non configurata!")
-        return None
+    heartbeat_age = get_worker_heartbeat_age()
+    worker_alive = heartbeat_age is not None and heartbeat_age <= ANALYSIS_WORKER_TIMEOUT
+    waited = min(float(job['age_seconds']) for job in pending)
     
-    try:
-        client = anthropic.Anthropic(api_key=st.secrets["ANTHROPIC_API_KEY"])
-        
-        # Crea prompt personalizzato in base al tipo di analisi
-        prompts = {
-            "Completa (Diversificazione + Rischi + Suggerimenti)": """Sei un analista finanziario esperto in value investing e gestione di portafoglio.
-
-Analizza questo portafoglio in modo completo e dettagliato:
-
-{portfolio_text}
-
-Fornisci un'analisi strutturata che includa:
-
-1. **📊 Diversificazione** (30% dell'analisi)
-   - Distribuzione settoriale (è adeguata?)
-   - Concentrazione geografica (se rilevante)
-   - Rischio concentrazione su singoli titoli
-   - Correlazioni tra asset
-
-2. **⚠️ Analisi Rischi** (25% dell'analisi)
-   - Esposizione a rischi specifici (settoriali, geografici, valutari)
-   - Volatilità attesa del portafoglio
-   - Rischi macro (tassi, inflazione, recessione)
-   - Eventi specifici che potrebbero impattare
-
-3. **🏆 Qualità Titoli** (25% dell'analisi)
-   - Valutazione qualitativa delle aziende
-   - Presenza di moat economici
-   - Solidità bilanci e cash flow
-   - Management quality (se rilevante)
-
-4. **💡 Suggerimenti Operativi** (20% dell'analisi)
-   - Titoli da ridurre o aumentare
-   - Nuovi settori da considerare
-   - Strategie di ribilanciamento
-   - Timing suggerito
-
-5. **🎯 Voto Complessivo** (1-10/10)
-   - Voto numerico con spiegazione dettagliata
-   - Profilo rischio/rendimento
-   - Adeguatezza per investitore medio
-
-Sii specifico, actionable e usa un tono professionale ma accessibile.""",
-            
-            "Focus Diversificazione": """Analizza la DIVERSIFICAZIONE di questo portafoglio:
-
-{portfolio_text}
-
-Focus su:
-- Distribuzione settoriale ottimale
-- Correlazioni tra asset
-- Concentrazione geografica
-- Suggerimenti per migliorare diversificazione
-- Voto diversificazione (1-10)""",
-            
-            "Focus Rischi": """Analizza i RISCHI di questo portafoglio:
+    return jobs, worker_alive and waited <= ANALYSIS_POLL_TIMEOUT
 
-{portfolio_text}
 
-Focus su:
-- Rischi settoriali specifici
-- Esposizione a rischi macro
-- Volatilità attesa
-- Scenari negativi possibili
-- Strategie di mitigazione""",
-            
-            "Focus Value Investing": """Analizza questo portafoglio dal punto di vista VALUE INVESTING (Benjamin Graham, Warren Buffett):
+def show_background_jobs(portfolio_id, polling):
+    """Stato dei job in background (eseguito come fragment)."""
+    jobs, still_polling = background_job_state(portfolio_id)
+    
+    # Job concluso o polling da fermare: rerun completo (storico aggiornato,
+    # fragment ricreato con o senza aggiornamento automatico)
+    if polling and not still_polling:
+        st.rerun()
+    
+    for job in jobs:
+        label = JOB_STATUS_LABELS.get(job['status'], job['status'])
+        st.write(f"{label} - {job['analysis_type']} (richiesta alle "
+                 f"{pd.Timestamp(job['created_at']).strftime('%H:%M:%S')})")
+        if job['status'] == 'failed' and job['error']:
+            st.caption(f"Errore: {job['error']}")
+    
+    if not still_polling and any(job['status'] in ACTIVE_STATUSES for job in jobs):
+        st.warning("Nessun worker attivo o attesa troppo lunga: l'analisi resta in coda. "
+                   "Avvia scripts/analysis_worker.py e aggiorna lo stato.")
+        if st.button("🔄 Aggiorna stato", key="refresh_analysis_jobs"):
+            st.rerun()
 
-{portfolio_text}
 
-Focus su:
-- Margini di sicurezza
-- Qualità delle aziende (moat)
-- Valutazioni attuali
-- Opportunità di valore
-- Titoli sopravvalutati da ridurre""",
-            
-            "Confronto con Benchmark": """Confronta questo portafoglio con benchmark standard (S&P 500, indici settoriali):
+def format_analysis_date(created_at):
+    """Data analisi leggibile (datetime dal DB o stringa)."""
+    return pd.Timestamp(created_at).strftime('%d/%m/%Y %H:%M')
 
-{portfolio_text}
 
-Focus su:
-- Performance vs benchmark
-- Beta e volatilità
-- Esposizione settoriale vs indici
-- Alpha generation
-- Suggerimenti per battere il mercato"""
-        }
-        
-        prompt_template = prompts.get(analysis_type, prompts["Completa (Diversificazione + Rischi + Suggerimenti)"])
-        prompt = prompt_template.format(portfolio_text=portfolio_text)
+def call_claude_api(portfolio_text, analysis_type, placeholder=None):
+    """
+    Chiama Claude API per analisi in streaming.
+    
+    Args:
+        portfolio_text: Dati portafoglio da prepare_portfolio_for_ai
+        analysis_type: Tipo di analisi (sceglie il prompt)
+        placeholder: st.empty() in cui mostrare il testo man mano che arriva
         
-        response = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=4000,
-            temperature=0.7,
-            messages=[{"role": "user", "content": prompt}]
+    Returns:
+        tuple: (testo analisi o None, dict con first_token_seconds e total_seconds)
+    """
+    chunks = []
+    last_render = [0.0]
+    
+    def render(text):
+        chunks.append(text)
+        now = time.perf_counter()
+        # Ridisegna al massimo ogni STREAM_RENDER_INTERVAL secondi
+        if placeholder is not None and now - last_render[0] >= STREAM_RENDER_INTERVAL:
+            placeholder.markdown("".join(chunks) + " ▌")
+            last_render[0] = now
+    
+    try:
+        analysis, timings = stream_claude_analysis(
+            build_analysis_prompt(portfolio_text, analysis_type),
+            on_text=render
         )
         
-        return response.content[0].text
+        if placeholder is not None:
+            placeholder.markdown(analysis)
+        
+        print(f"Analisi Claude: primo token {timings['first_token_seconds'] or 0:.2f}s, "
+              f"totale {timings['total_seconds']:.2f}s")
+        
+        return analysis, timings
         
     except Exception as e:
+        if placeholder is not None:
+            placeholder.empty()
         st.error(f"❌ Errore chiamata Claude: {str(e)}")
-        return None
+        return None, {'first_token_seconds': None, 'total_seconds': None}
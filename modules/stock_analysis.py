@@ -1,10 +1,13 @@
 import streamlit as st
 # Importa TUTTE le funzioni dal tuo codice esistente
-import requests
 import pandas as pd
 import plotly.graph_objects as go
 import plotly.express as px
 from datetime import datetime
+import time
+from modules.fmp_client import get_http_session, fetch_concurrently
+from modules.fmp_cache import fetch_json_cached
+from database.price_store import append_bars, bars_to_frame, get_range, last_bar_date
 
 # COPIA TUTTE LE TUE FUNZIONI dal file allegato
 # (fetch_data, fetch_company_profile, format_currency, ecc.)
@@ -153,9 +156,7 @@ def fetch_data(ticker, api_key, endpoint, period="annual", limit=10):
         url = f"{base_url}/{endpoint}/{ticker}?period={period}&limit={limit}&apikey={api_key}"
     
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        data = fetch_json_cached(url, endpoint, ticker, period, limit)
         return data if isinstance(data, list) else []
     except Exception as e:
         st.error(f"Errore nel recupero dati {endpoint}: {str(e)}")
@@ -166,9 +167,7 @@ def fetch_company_profile(ticker, api_key):
     """Recupera il profilo dell'azienda"""
     url = f"https://financialmodelingprep.com/api/v3/profile/{ticker}?apikey={api_key}"
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        data = fetch_json_cached(url, "profile", ticker)
         return data[0] if isinstance(data, list) and len(data) > 0 else None
     except Exception as e:
         st.error(f"Errore nel recupero profilo: {str(e)}")
@@ -179,7 +178,7 @@ def fetch_quote(ticker, api_key):
     """Recupera la quotazione in tempo reale"""
     url = f"https://financialmodelingprep.com/api/v3/quote/{ticker}?apikey={api_key}"
     try:
-        response = requests.get(url, timeout=10)
+        response = get_http_session().get(url, timeout=10)
         response.raise_for_status()
         data = response.json()
         return data[0] if isinstance(data, list) and len(data) > 0 else None
@@ -189,25 +188,32 @@ def fetch_quote(ticker, api_key):
 
 @st.cache_data(ttl=3600)
 def fetch_historical_prices(ticker, api_key):
-    """Recupera i prezzi storici dell'ultimo anno"""
-    url = f"https://financialmodelingprep.com/api/v3/historical-price-full/{ticker}?apikey={api_key}"
+    """
+    Recupera i prezzi storici dell'ultimo anno dall'archivio locale.
+    Il JSON FMP viene scaricato solo se mancano barre recenti o se l'ultima
+    barra salvata è di oggi (seduta forse non ancora chiusa); nell'archivio
+    finiscono le barre nuove e quelle riviste.
+    """
+    today = pd.Timestamp.today().normalize()
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        if 'historical' in data:
-            return data['historical'][:365]
-        return []
+        last = last_bar_date(ticker)
+        if last is None or last < today - pd.offsets.BDay(1) or last >= today:
+            url = f"https://financialmodelingprep.com/api/v3/historical-price-full/{ticker}?apikey={api_key}"
+            data = fetch_json_cached(url, "historical-price-full", ticker)
+            if 'historical' in data:
+                append_bars(ticker, data['historical'])
+        
+        return bars_to_frame(get_range(ticker, start=today - pd.Timedelta(days=365)))
     except Exception as e:
         st.error(f"Errore nel recupero prezzi storici: {str(e)}")
-        return []
+        return pd.DataFrame()
 
 @st.cache_data(ttl=3600)
 def fetch_company_news(ticker, api_key, limit=20):
     """Recupera le news della società"""
     url = f"https://financialmodelingprep.com/api/v3/stock_news?tickers={ticker}&limit={limit}&apikey={api_key}"
     try:
-        response = requests.get(url, timeout=10)
+        response = get_http_session().get(url, timeout=10)
         response.raise_for_status()
         data = response.json()
         return data if isinstance(data, list) else []
@@ -220,9 +226,7 @@ def fetch_earnings_calendar(ticker, api_key):
     """Recupera il calendario degli earnings"""
     url = f"https://financialmodelingprep.com/api/v3/historical/earning_calendar/{ticker}?apikey={api_key}"
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        data = fetch_json_cached(url, "earning_calendar", ticker)
         return data if isinstance(data, list) else []
     except Exception as e:
         st.error(f"Errore nel recupero calendario earnings: {str(e)}")
@@ -233,9 +237,7 @@ def fetch_dividends_calendar(ticker, api_key):
     """Recupera lo storico dividendi"""
     url = f"https://financialmodelingprep.com/api/v3/historical-price-full/stock_dividend/{ticker}?apikey={api_key}"
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        data = fetch_json_cached(url, "stock_dividend", ticker)
         if 'historical' in data:
             return data['historical'][:20]  # Ultimi 20 dividendi
         return []
@@ -378,7 +380,7 @@ def create_line_chart(df, x_col, y_cols, title, yaxis_title="Valore", currency=N
 
 def create_mini_price_chart(historical_data, currency="USD"):
     """Crea un mini grafico dei prezzi dell'ultimo anno"""
-    if not historical_data:
+    if historical_data is None or len(historical_data) == 0:
         return None
     
     df = pd.DataFrame(historical_data)
@@ -447,21 +449,45 @@ if st.session_state.analyzed:
         st.error("⚠️ Inserisci un ticker valido")
     else:
         with st.spinner(f"Recupero dati per {ticker}..."):
-            company_profile = fetch_company_profile(ticker, api_key)
-            quote = fetch_quote(ticker, api_key)
-            historical_prices = fetch_historical_prices(ticker, api_key)
+            # Tutte le chiamate FMP partono in parallelo (latenza ~ max invece di somma)
+            fetch_start = time.perf_counter()
+            
+            fetched, fetch_timings = fetch_concurrently({
+                'company_profile': (fetch_company_profile, (ticker, api_key)),
+                'quote': (fetch_quote, (ticker, api_key)),
+                'historical_prices': (fetch_historical_prices, (ticker, api_key)),
+                'income_data': (fetch_data, (ticker, api_key, "income-statement", period, limit)),
+                'balance_data': (fetch_data, (ticker, api_key, "balance-sheet-statement", period, limit)),
+                'cashflow_data': (fetch_data, (ticker, api_key, "cash-flow-statement", period, limit)),
+                'ratios_data': (fetch_data, (ticker, api_key, "ratios", period, limit)),
+                'estimates_data': (fetch_data, (ticker, api_key, "analyst-estimates", period, min(5, limit))),
+                'insider_data': (fetch_data, (ticker, api_key, "insider"), {'limit': 50}),
+                # Nuove funzioni per le tab aggiuntive
+                'news_data': (fetch_company_news, (ticker, api_key), {'limit': 20}),
+                'earnings_calendar': (fetch_earnings_calendar, (ticker, api_key)),
+                'dividends_data': (fetch_dividends_calendar, (ticker, api_key)),
+            })
+            
+            fetch_total = time.perf_counter() - fetch_start
+            st.session_state.fetch_timings = {**fetch_timings, 'totale': fetch_total}
+            print(f"[{ticker}] Fetch FMP in {fetch_total:.2f}s - " + ", ".join(
+                f"{name}: {secs:.2f}s" for name, secs in sorted(fetch_timings.items(), key=lambda x: -x[1])
+            ))
+            
+            company_profile = fetched['company_profile']
+            quote = fetched['quote']
+            historical_prices = fetched['historical_prices']
             
-            income_data = fetch_data(ticker, api_key, "income-statement", period, limit)
-            balance_data = fetch_data(ticker, api_key, "balance-sheet-statement", period, limit)
-            cashflow_data = fetch_data(ticker, api_key, "cash-flow-statement", period, limit)
-            ratios_data = fetch_data(ticker, api_key, "ratios", period, limit)
-            estimates_data = fetch_data(ticker, api_key, "analyst-estimates", period, min(5, limit))
-            insider_data = fetch_data(ticker, api_key, "insider", limit=50)
+            income_data = fetched['income_data']
+            balance_data = fetched['balance_data']
+            cashflow_data = fetched['cashflow_data']
+            ratios_data = fetched['ratios_data']
+            estimates_data = fetched['estimates_data']
+            insider_data = fetched['insider_data']
             
-            # Nuove funzioni per le tab aggiuntive
-            news_data = fetch_company_news(ticker, api_key, limit=20)
-            earnings_calendar = fetch_earnings_calendar(ticker, api_key)
-            dividends_data = fetch_dividends_calendar(ticker, api_key)
+            news_data = fetched['news_data']
+            earnings_calendar = fetched['earnings_calendar']
+            dividends_data = fetched['dividends_data']
             
             if not income_data:
                 st.error("❌ Nessun dato trovato. Verifica il ticker e la tua API key.")
@@ -482,7 +508,7 @@ if st.session_state.analyzed:
                         st.markdown(f"**{ticker}** • {company_profile.get('exchangeShortName', 'N/A')}")
                     
                     with col_chart:
-                        if historical_prices:
+                        if historical_prices is not None and len(historical_prices) > 0:
                             chart_result = create_mini_price_chart(historical_prices, currency)
                             if chart_result:
                                 mini_chart, change_1y = chart_result
@@ -2,7 +2,8 @@ import streamlit as st
 from database.db_connection import init_connection_pool
 from auth.wordpress_auth import require_auth, get_current_user, logout
 from database.users import get_user_stats
-from database.analytics import check_alerts
+from database.alerts import get_pending_alert_events, acknowledge_alert_events
+from database.fx import currency_symbol
 
 # Configurazione pagina
 st.set_page_config(
@@ -65,12 +66,16 @@ def main():
         
         st.markdown("---")
         
-        # Check alerts
-        alerts = check_alerts(user['id'])
+        # Alert scattati (valutati in background da scripts/alert_evaluator.py)
+        alerts = get_pending_alert_events(user['id'])
         if alerts:
-            st.warning(f"🔔 {len(alerts)} Alert attivi!")
+            st.warning(f"🔔 {len(alerts)} Alert scattati!")
             for alert in alerts:
-                st.caption(f"• {alert['ticker']}: ${alert['current_price']:.2f}")
+                sym = currency_symbol(alert['currency']) if alert['currency'] else ''
+                st.caption(f"• {alert['ticker']}: {sym}{alert['trigger_price']:.2f}")
+            if st.button("✔️ Segna come letti", use_container_width=True):
+                acknowledge_alert_events(user['id'])
+                st.rerun()
         
         st.markdown("---")
         
@@ -0,0 +1,40 @@
+import os
+import sys
+import time
+import argparse
+from datetime import datetime
+
+# Aggiungi path al modulo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.alerts import ensure_alert_events_table, evaluate_all_alerts
+
+def run_alert_evaluator(interval=60, once=False):
+    """Valuta periodicamente gli alert attivi di tutti gli utenti."""
+
+    print(f"[{datetime.now()}] Avvio valutazione alert (intervallo {interval}s)...")
+
+    ensure_alert_events_table()
+
+    while True:
+        started = time.monotonic()
+
+        try:
+            evaluate_all_alerts()
+        except Exception as e:
+            print(f"Errore valutazione alert: {e}")
+
+        if once:
+            return
+
+        time.sleep(max(0, interval - (time.monotonic() - started)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Valutazione alert prezzi in background")
+    parser.add_argument("--interval", type=int, default=60,
+                        help="Secondi tra due valutazioni (default: 60)")
+    parser.add_argument("--once", action="store_true",
+                        help="Esegui una sola valutazione ed esci (es. da cron)")
+    args = parser.parse_args()
+
+    run_alert_evaluator(interval=args.interval, once=args.once)
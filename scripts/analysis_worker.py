@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# Aggiungi path al modulo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.jobs import (
+    ensure_analysis_jobs_table, claim_analysis_jobs, complete_analysis_job,
+    fail_analysis_job, requeue_stale_jobs, record_worker_heartbeat, worker_name
+)
+from modules.ai_analysis import run_portfolio_analysis
+
+def process_job(job):
+    """Esegue un job di analisi e ne registra l'esito."""
+
+    started = time.monotonic()
+
+    try:
+        result = run_portfolio_analysis(
+            job['portfolio_id'],
+            job['analysis_type'],
+            include_macro=job['include_macro'],
+            force_refresh=job['force_refresh']
+        )
+        complete_analysis_job(job['id'], result['analysis_id'])
+
+        origin = "cache" if result['cached'] else "Claude"
+        print(f"[{datetime.now()}] Job {job['id']} completato ({origin}) "
+              f"in {time.monotonic() - started:.1f}s")
+
+    except ValueError as e:
+        # Errore sui dati (es. portafoglio vuoto): inutile ritentare
+        fail_analysis_job(job['id'], e, retry=False)
+        print(f"[{datetime.now()}] Job {job['id']} fallito: {e}")
+
+    except Exception as e:
+        fail_analysis_job(job['id'], e)
+        print(f"[{datetime.now()}] Job {job['id']} errore (tentativo {job['attempts']}): {e}")
+
+def run_analysis_worker(concurrency=4, poll_interval=2, once=False, maintenance_interval=30):
+    """
+    Prende in carico i job in coda ed esegue fino a `concurrency` analisi in parallelo.
+
+    Ogni `maintenance_interval` secondi registra l'heartbeat del worker e
+    rimette in coda i job rimasti 'running' di worker terminati.
+    """
+
+    worker = worker_name()
+    print(f"[{datetime.now()}] Avvio worker analisi {worker} (concorrenza {concurrency})...")
+
+    ensure_analysis_jobs_table()
+
+    running = set()
+    last_maintenance = None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            if last_maintenance is None or time.monotonic() - last_maintenance >= maintenance_interval:
+                try:
+                    record_worker_heartbeat(worker)
+                    requeued = requeue_stale_jobs()
+                    if requeued:
+                        print(f"[{datetime.now()}] Job rimessi in coda: {requeued}")
+                except Exception as e:
+                    print(f"Errore manutenzione coda analisi: {e}")
+                last_maintenance = time.monotonic()
+
+            running = {future for future in running if not future.done()}
+            free = concurrency - len(running)
+
+            jobs = []
+            if free > 0:
+                try:
+                    jobs = claim_analysis_jobs(limit=free, worker=worker)
+                except Exception as e:
+                    print(f"Errore lettura coda analisi: {e}")
+
+            for job in jobs:
+                running.add(executor.submit(process_job, job))
+
+            if once and not running:
+                return
+
+            # Coda vuota o worker saturo: attendi prima del prossimo giro
+            if not jobs or len(running) >= concurrency:
+                time.sleep(poll_interval)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Worker per le analisi AI in coda")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Analisi eseguite in parallelo (default: 4)")
+    parser.add_argument("--poll-interval", type=float, default=2,
+                        help="Secondi tra due controlli della coda (default: 2)")
+    parser.add_argument("--once", action="store_true",
+                        help="Svuota la coda ed esci (es. da cron)")
+    args = parser.parse_args()
+
+    run_analysis_worker(concurrency=args.concurrency, poll_interval=args.poll_interval, once=args.once)
@@ -0,0 +1,36 @@
+import os
+import sys
+import argparse
+from datetime import datetime
+
+# Aggiungi path al modulo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.backfill import backfill_snapshots
+
+def run_backfill(portfolio_ids=None, start=None, end=None, overwrite=False):
+    """Ricostruisce gli snapshot storici dal registro transazioni."""
+
+    print(f"[{datetime.now()}] Inizio ricostruzione snapshot storici...")
+
+    report = backfill_snapshots(portfolio_ids=portfolio_ids, start=start, end=end, overwrite=overwrite)
+
+    if not report['transactions']:
+        return
+
+    timings = report['timings']
+    print(f"Snapshot inseriti: {report['snapshots']} "
+          f"({report['portfolios']} portafogli, {report['tickers']} ticker, {report['dates']} giorni)")
+    print("Tempi: " + ", ".join(f"{phase} {secs:.2f}s" for phase, secs in timings.items()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ricostruzione snapshot storici dalle transazioni")
+    parser.add_argument("--portfolio", type=int, action="append", dest="portfolio_ids",
+                        help="ID portafoglio (ripetibile, default: tutti gli attivi)")
+    parser.add_argument("--start", help="Prima data YYYY-MM-DD (default: prima transazione)")
+    parser.add_argument("--end", help="Ultima data YYYY-MM-DD (default: ieri)")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Riscrivi anche le date già presenti")
+    args = parser.parse_args()
+
+    run_backfill(portfolio_ids=args.portfolio_ids, start=args.start, end=args.end, overwrite=args.overwrite)
@@ -0,0 +1,54 @@
+import os
+import sys
+import argparse
+from datetime import datetime
+
+# Aggiungi path al modulo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.importer import import_positions_csv, IMPORT_CHUNK_SIZE
+
+def run_import(portfolio_id, path, dry_run=False, currency='USD', decimal=None, chunk_size=IMPORT_CHUNK_SIZE):
+    """Importa un CSV o un export del broker in un portafoglio."""
+
+    print(f"[{datetime.now()}] Import {path} nel portafoglio {portfolio_id}"
+          f"{' (anteprima)' if dry_run else ''}...")
+
+    report = import_positions_csv(
+        portfolio_id, path, dry_run=dry_run, default_currency=currency,
+        decimal=decimal, chunk_size=chunk_size, verbose=True
+    )
+
+    print(f"Righe: {report['rows']} (valide {report['valid']}, scartate {report['error_count']})")
+    print(f"Separatore decimale: {report['decimal'] or 'non determinato (valori ambigui scartati)'}")
+
+    if not report['diff'].empty:
+        print(report['diff'].to_string(index=False))
+
+    if report['rejected']:
+        print(f"Vendite oltre la quantità detenuta scartate: {report['rejected']}")
+
+    if report['oversold']:
+        print(f"Vendite oltre la quantità detenuta già nel registro: {', '.join(report['oversold'])}")
+
+    if report['error_count']:
+        print(report['errors'].head(50).to_string(index=False))
+
+    if not dry_run:
+        print(f"Transazioni: {report['transactions']}, posizioni aggiornate: "
+              f"{report['positions_updated']}, chiuse: {report['positions_closed']}")
+
+    print("Tempi: " + ", ".join(f"{phase} {secs:.2f}s" for phase, secs in report['timings'].items()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import transazioni da CSV / export broker")
+    parser.add_argument("file", help="Percorso del file CSV")
+    parser.add_argument("--portfolio", type=int, required=True, help="ID portafoglio di destinazione")
+    parser.add_argument("--dry-run", action="store_true", help="Mostra solo il diff, senza scrivere")
+    parser.add_argument("--currency", default="USD", help="Valuta per le righe senza valuta")
+    parser.add_argument("--decimal", choices=[",", "."], help="Separatore decimale (default: dedotto dal file)")
+    parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE, help="Righe per blocco")
+    args = parser.parse_args()
+
+    run_import(args.portfolio, args.file, dry_run=args.dry_run, currency=args.currency,
+               decimal=args.decimal, chunk_size=args.chunk_size)
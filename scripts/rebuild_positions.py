@@ -0,0 +1,68 @@
+import os
+import sys
+import argparse
+from datetime import datetime
+
+# Aggiungi path al modulo
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.ledger import rebuild_positions, align_ledger_with_positions, LEDGER_METHOD, LEDGER_METHODS
+
+def run_align(dry_run=False):
+    """Allinea una volta il registro alle posizioni correnti (transazioni precedenti al registro)."""
+
+    print(f"[{datetime.now()}] Allineamento registro alle posizioni"
+          f"{' (anteprima)' if dry_run else ''}...")
+
+    report = align_ledger_with_positions(dry_run=dry_run)
+
+    for portfolio_id, ticker in report['orphaned']:
+        print(f"Posizione cancellata: {ticker} (portafoglio {portfolio_id}) -> BUY/SELL archiviati")
+    for portfolio_id, ticker in report['realigned']:
+        print(f"Saldo diverso dalla posizione: {ticker} (portafoglio {portfolio_id}) -> BUY di apertura")
+
+    print(f"Coppie: {len(report['orphaned'])} archiviate, {len(report['realigned'])} riallineate; "
+          f"transazioni in transactions_orphaned: {report['archived']}, BUY di apertura: {report['opened']}"
+          f"{' (annullato)' if dry_run else ''}")
+
+def run_rebuild(portfolio_ids=None, tickers=None, method=LEDGER_METHOD):
+    """Ricostruisce posizioni e lotti aperti dal registro transazioni."""
+
+    print(f"[{datetime.now()}] Ricostruzione posizioni dal registro (metodo {method})...")
+
+    report = rebuild_positions(portfolio_ids=portfolio_ids, tickers=tickers, method=method, verbose=True)
+
+    if not report['transactions']:
+        print("Nessuna transazione da elaborare")
+        return
+
+    print(f"Transazioni: {report['transactions']}, titoli: {report['pairs']}, "
+          f"posizioni aggiornate: {report['positions_updated']}, chiuse: {report['positions_closed']}, "
+          f"lotti aperti: {report['lots']}")
+
+    for portfolio_id, ticker in report['oversold']:
+        print(f"Attenzione: vendite oltre la quantità detenuta per {ticker} (portafoglio {portfolio_id})")
+
+    print("Tempi: " + ", ".join(f"{phase} {secs:.2f}s" for phase, secs in report['timings'].items()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ricostruzione posizioni dal registro transazioni")
+    parser.add_argument("--portfolio", type=int, action="append", dest="portfolio_ids",
+                        help="ID portafoglio (ripetibile, default: tutti)")
+    parser.add_argument("--ticker", action="append", dest="tickers",
+                        help="Ticker (ripetibile, default: tutti)")
+    parser.add_argument("--method", choices=LEDGER_METHODS, default=LEDGER_METHOD,
+                        help="Metodo di carico (default: LEDGER_METHOD)")
+    parser.add_argument("--align", action="store_true",
+                        help="Prima allinea il registro alle posizioni correnti (una volta, "
+                             "archivia i BUY/SELL delle posizioni cancellate prima del registro)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Con --align: mostra solo le coppie coinvolte, senza scrivere")
+    args = parser.parse_args()
+
+    if args.align:
+        run_align(dry_run=args.dry_run)
+        if args.dry_run:
+            sys.exit(0)
+
+    run_rebuild(portfolio_ids=args.portfolio_ids, tickers=args.tickers, method=args.method)